@@ -1,27 +1,53 @@
 from __future__ import annotations
+import asyncio
+import heapq
 import json
 import logging
 import os
 import time
-import uuid
+from collections import Counter as TallyCounter
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Optional, Tuple
 
 
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse, PlainTextResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+from pydantic import BaseModel, Field
 
 from prometheus_client import (
     Counter, Gauge, Histogram, CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST
 )
 
 import redis.asyncio as redis
-from app.lua_limiter_async import AsyncLuaLimiter
+from app.binary_server import BinaryAllowServer
+from app.breaker import CLOSED, BreakerLimiter
+from app.client import Decision
+from app.coalesce import BucketCoalescer
+from app.consumers import TopConsumers
+from app.deny_cache import DenyCache
+from app.keys import (
+    bucket_ttl_seconds, composite_owner, floor_time, idem_key_for, legacy_idem_key_for, offender_keys,
+    parse_idem_record,
+)
+from app.lease import LeaseManager
+from app.lua_limiter_async import AsyncLuaLimiter, AutoPipeline, bundled_limiter
+from app.memory_limiter import AsyncMemoryLimiter
+from app.offender_rollup import OffenderRollup, offender_cover
+from app.obs_middleware import ObsMiddleware, current_timings, new_request_id, note_redis_call
+from app.peek import BucketPeeker, current_subtokens, parse_bucket, read_bucket
+from app.policy import PolicyLoader, fold_decisions
+from app.resource_registry import ResourceRegistry
+from app.sharding import ShardedLuaLimiter, cluster_limiter, ring_limiter
 from app.settings import settings
 
-# Optional per-resource overrides
-RESOURCE_CFG: Dict[str, Tuple[int, float]] = {}  # {"read": (10, 5.0)}
+# Per-resource limits from the policy ConfigMap; policy.active is swapped on reload
+policy = PolicyLoader(
+    settings.POLICY_PATH,
+    scale=settings.SCALE,
+    default_capacity=settings.DEFAULT_CAPACITY,
+    default_rate=settings.DEFAULT_RATE_TOKENS_PER_SEC,
+)
 
 # ---------- Logging (JSON) ----------
 logger = logging.getLogger("rate_limiter")
@@ -30,20 +56,10 @@ _handler = logging.StreamHandler()
 _handler.setFormatter(logging.Formatter("%(message)s"))
 logger.addHandler(_handler)
 
-# ---------- Redis & Lua ----------
-r: redis.Redis = redis.from_url(settings.REDIS_URL, decode_responses=False)
-
-with open(os.path.join(os.path.dirname(__file__), "limiter.lua"), "r") as f:
-    LUA_SOURCE = f.read()
-
-limiter = AsyncLuaLimiter(r, LUA_SOURCE)
-
-app = FastAPI(title="Redis Lua Token Bucket")
-
 # ---------- Prometheus ----------
 registry = CollectorRegistry()
 REQ_TOTAL = Counter("requests_total", "Total /allow", ["result"], registry=registry)
-ACTIVE_KEYS = Gauge("acitive_keys", "Active rl:* buckets", registry=registry)
+ACTIVE_KEYS = Gauge("active_keys", "Active rl:* buckets (last complete sampler pass)", registry=registry)
 REQ_LAT = Histogram(
     "request_latency_seconds",
     "Latency",
@@ -52,171 +68,874 @@ REQ_LAT = Histogram(
     buckets=(0.001,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0),
 )
 
+DENY_CACHE_HITS = Counter("deny_cache_hits_total", "Denies answered from the local deny cache", registry=registry)
+DENY_CACHE_SIZE = Gauge("deny_cache_entries", "Entries in the local deny cache", registry=registry)
+COALESCED_BATCH = Histogram(
+    "coalesced_batch_size",
+    "/allow calls per script call on one bucket (app/coalesce.py)",
+    registry=registry,
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+LEASE_OPS = Gauge("lease_ops", "Lease-mode operations since start (local|acquire|release)", ["op"], registry=registry)
+
+# Where the time goes: script round trips, per-request Redis totals, background Redis work
+_REDIS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+LUA_CALLS = Counter(
+    "lua_calls_total",
+    "Script round trips by script and command (evalsha|noscript|eval; noscript = EVALSHA cache miss, retried as EVAL)",
+    ["script", "command"],
+    registry=registry,
+)
+LUA_CALL_LAT = Histogram(
+    "lua_call_seconds", "Duration of one script round trip", ["script"], registry=registry, buckets=_REDIS_BUCKETS,
+)
+REQ_REDIS_CALLS = Histogram(
+    "request_redis_calls", "Redis round trips per HTTP request", registry=registry,
+    buckets=(0, 1, 2, 3, 4, 6, 10, 20),
+)
+REQ_REDIS_LAT = Histogram(
+    "request_redis_seconds", "Redis time per HTTP request that made Redis calls", registry=registry,
+    buckets=_REDIS_BUCKETS,
+)
+BACKGROUND_LAT = Histogram(
+    "background_redis_seconds",
+    "Duration of background Redis work (active_keys|offender_flush|resource_registry_flush)",
+    ["task"],
+    registry=registry,
+    buckets=_REDIS_BUCKETS + (0.5, 1.0, 2.5),
+)
+PIPELINE_BATCH = Histogram(
+    "pipeline_batch_size",
+    "Script calls per auto-pipeline flush",
+    registry=registry,
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512),
+)
+PIPELINE_QUEUE_DELAY = Histogram(
+    "pipeline_queue_delay_seconds",
+    "Time the oldest script call of a flush waited in the auto-pipeline queue",
+    registry=registry,
+    buckets=(0.00001, 0.00005) + _REDIS_BUCKETS,
+)
+BREAKER_STATE = Gauge("breaker_state", "Redis circuit breaker per node: 0 closed, 1 half-open, 2 open", ["node"], registry=registry)
+BREAKER_FALLBACKS = Counter(
+    "breaker_fallback_decisions_total", "Decisions made locally while Redis was over budget or down", ["node"], registry=registry,
+)
+BREAKER_OVERRUNS = Counter(
+    "redis_budget_overruns_total", "Script calls abandoned after BREAKER_BUDGET_MS", ["node"], registry=registry,
+)
+BREAKER_DEBTS_DROPPED = Counter(
+    "breaker_debts_dropped_total", "Local charges not reconciled: over BREAKER_MAX_DEBTS buckets", ["node"], registry=registry,
+)
+_lua_children: Dict[Tuple[str, str], tuple] = {}
+
+def observe_lua_call(script: str, command: str, seconds: float) -> None:
+    children = _lua_children.get((script, command))
+    if children is None:
+        children = _lua_children[(script, command)] = (
+            LUA_CALLS.labels(script=script, command=command), LUA_CALL_LAT.labels(script=script),
+        )
+    children[0].inc()
+    children[1].observe(seconds)
+    note_redis_call(seconds)
+
+# ---------- Redis & Lua ----------
+# `r` is the control connection (offenders, admin). Buckets live on BUCKET_NODES:
+# the same server in single mode, every primary behind `r` in cluster mode, or
+# the REDIS_URLS ring members in ring mode.
+if settings.REDIS_MODE == "cluster":
+    if "{{{user}}}" not in settings.BUCKET_KEY_FMT:
+        raise ValueError("REDIS_MODE=cluster needs a hash-tagged BUCKET_KEY_FMT, e.g. 'rl:{{{user}}}:{resource}'")
+    r = redis.RedisCluster.from_url(settings.REDIS_URL, decode_responses=False)
+else:
+    r = redis.from_url(settings.REDIS_URL, decode_responses=False)
+
+# `rr` serves admin/observability reads from its own pool, so dashboards don't queue
+# behind /allow for connections: on REDIS_REPLICA_URL when set, on the shards'
+# replicas in cluster mode. Replicas are read-only and may lag by a few ms.
+REPLICA_READS = bool(settings.REDIS_REPLICA_URL) and settings.REDIS_MODE != "cluster"
+if settings.REDIS_MODE == "cluster":
+    rr = redis.RedisCluster.from_url(settings.REDIS_URL, decode_responses=False, read_from_replicas=True)
+else:
+    rr = redis.from_url(
+        settings.REDIS_REPLICA_URL or settings.REDIS_URL,
+        decode_responses=False,
+        max_connections=settings.READ_MAX_CONNECTIONS,
+    )
+
+def observe_pipeline_flush(commands: int, queue_delay: float) -> None:
+    PIPELINE_BATCH.observe(commands)
+    PIPELINE_QUEUE_DELAY.observe(queue_delay)
+
+def _node_label(client) -> str:
+    if settings.REDIS_MODE == "cluster":
+        return "cluster"
+    kw = client.connection_pool.connection_kwargs
+    return kw.get("path") or f"{kw.get('host', 'localhost')}:{kw.get('port', 6379)}/{kw.get('db', 0)}"
+
+def _count_local_offense(user_id: str) -> None:
+    # Denies the breaker decided locally, which the script would have counted
+    note_offense(user_id)
+
+def _lua_limiter(client: redis.Redis) -> AsyncLuaLimiter:
+    # Cluster clients route per command; auto-pipelining is for single and ring nodes
+    pipeline = AutoPipeline(
+        client,
+        max_batch=settings.PIPELINE_MAX_BATCH,
+        max_delay_ms=settings.PIPELINE_MAX_DELAY_MS,
+        on_flush=observe_pipeline_flush,
+    ) if settings.PIPELINE_ENABLED and settings.REDIS_MODE != "cluster" else None
+    lim = bundled_limiter(client, on_call=observe_lua_call, pipeline=pipeline)
+    if not settings.BREAKER_ENABLED:
+        return lim
+    node = _node_label(client)
+    BREAKER_STATE.labels(node=node).set(CLOSED)
+    return BreakerLimiter(
+        lim,
+        budget_ms=settings.BREAKER_BUDGET_MS,
+        failure_threshold=settings.BREAKER_FAILURE_THRESHOLD,
+        reset_seconds=settings.BREAKER_RESET_SECONDS,
+        local_share=settings.BREAKER_LOCAL_SHARE,
+        max_debts=settings.BREAKER_MAX_DEBTS,
+        on_state=BREAKER_STATE.labels(node=node).set,
+        on_fallback=BREAKER_FALLBACKS.labels(node=node).inc,
+        on_overrun=BREAKER_OVERRUNS.labels(node=node).inc,
+        on_debt_dropped=BREAKER_DEBTS_DROPPED.labels(node=node).inc,
+        on_local_deny=_count_local_offense,
+    )
+
+BUCKET_NODES: List[redis.Redis] = [r]
+# BACKEND=memory keeps buckets in-process (edge deployments, tests without Redis)
+if settings.BACKEND == "memory":
+    limiter = AsyncMemoryLimiter()
+elif settings.REDIS_MODE == "ring":
+    limiter, BUCKET_NODES = ring_limiter(settings.REDIS_URLS, _lua_limiter)
+elif settings.REDIS_MODE == "cluster":
+    limiter = cluster_limiter(r, _lua_limiter)
+else:
+    limiter = _lua_limiter(r)
+
+# Sharded buckets cannot share a script call with the offender ZSETs, so their
+# denies are tallied in-process and flushed to the control node instead.
+SHARDED = settings.BACKEND != "memory" and settings.REDIS_MODE != "single"
+
+# Idempotency records from before they moved next to the bucket key live on the
+# one node they could have been written to (see IDEM_LEGACY_READ).
+LEGACY_IDEM = settings.IDEM_LEGACY_READ and settings.BACKEND != "memory" and settings.REDIS_MODE == "single"
+
+async def legacy_idem_replay(user_id: str, resource: str, idempotency: str) -> Optional[Tuple[bool, float, float]]:
+    try:
+        value = await r.get(legacy_idem_key_for(user_id, resource, idempotency))
+    except (redis.RedisError, OSError):
+        return None  # best effort: the script call decides as if there were none
+    return parse_idem_record(value, settings.SCALE) if value is not None else None
+
+# The scripts keep a per-owner index of live buckets for /admin/user. When
+# sharded, it can only be kept if it lands on the same node/slot as the buckets.
+USER_INDEX = bool(settings.USER_INDEX_KEY_FMT) and settings.BACKEND != "memory" and (
+    not SHARDED
+    or ("{{{user}}}" in settings.BUCKET_KEY_FMT and "{{{user}}}" in settings.USER_INDEX_KEY_FMT)
+)
+
+def user_index_key(owner: str) -> str:
+    return settings.USER_INDEX_KEY_FMT.format(user=owner) if USER_INDEX else ""
+
+def bucket_node(key: str) -> redis.Redis:
+    return limiter.client_for(key) if isinstance(limiter, ShardedLuaLimiter) else r
+
+# Bucket reads: ring members have no replica URL, so they are read on the primaries
+RING = settings.REDIS_MODE == "ring" and isinstance(limiter, ShardedLuaLimiter)
+READ_NODES: List[redis.Redis] = BUCKET_NODES if RING else [rr]
+
+def read_node(key: str) -> redis.Redis:
+    return bucket_node(key) if RING else rr
+
+# Opt-in per resource: decisions served from tokens pre-claimed from Redis
+LEASE_RESOURCES = frozenset(settings.LEASE_RESOURCES)
+leases = LeaseManager(
+    limiter,
+    scale=settings.SCALE,
+    bucket_ttl_seconds=settings.TTL_SECONDS,
+    lease_ttl_ms=settings.LEASE_TTL_MS,
+    min_tokens=settings.LEASE_MIN_TOKENS,
+    max_tokens=settings.LEASE_MAX_TOKENS,
+)
+
+# Concurrent /allow calls on one bucket share a script call (app/coalesce.py)
+single_limiter = BucketCoalescer(
+    limiter,
+    window_ms=settings.COALESCE_WINDOW_MS,
+    max_batch=settings.COALESCE_MAX_BATCH,
+    on_batch=COALESCED_BATCH.observe,
+) if settings.COALESCE_ENABLED and settings.BACKEND != "memory" else limiter
+
+# Denies answered locally until Retry-After; None when disabled
+deny_cache: Optional[DenyCache] = DenyCache(
+    settings.DENY_CACHE_MAX_ENTRIES,
+    settings.DENY_CACHE_MARGIN_MS,
+    settings.DENY_CACHE_MAX_TTL_MS,
+) if settings.DENY_CACHE_ENABLED else None
+
 ALLOWED_TOTAL = 0
 DENIED_TOTAL = 0
 
-def resource_cfg(resource: str) -> Tuple[int, float]:
-    cap, rate = RESOURCE_CFG.get(resource, (settings.DEFAULT_CAPACITY, settings.DEFAULT_RATE_TOKENS_PER_SEC))
-    return int(cap), float(rate)
+def composite_items(pol, user_id: str, tenant: Optional[str], resource: str, cost: int) -> Tuple[List[str], list]:
+    """
+    (limit names, allow_many items) for a composite policy: one bucket per
+    limit, keyed by its scope. Tenant limits are skipped without a tenant.
+    """
+    names, items = [], []
+    for lim in pol.limits:
+        owner = composite_owner(lim.scope, user_id, tenant)
+        if owner is None:
+            continue
+        note_resource_cfg(f"{resource}:{lim.name}", lim.capacity, lim.rate_subtokens_per_sec)
+        key = settings.BUCKET_KEY_FMT.format(user=owner, resource=resource)
+        names.append(lim.name)
+        items.append((
+            f"{key}:{lim.name}", lim.capacity, lim.rate_subtokens_per_sec, cost, user_id, user_index_key(owner),
+        ))
+    return names, items
+
+async def scan_pages(match: bytes, count: int):
+    """Yield (node, keys) once per SCAN call on every bucket node (read side); pages may be empty."""
+    for node in READ_NODES:
+        if isinstance(node, redis.RedisCluster):
+            for primary in node.get_primaries():
+                cursor = None
+                while cursor != 0:
+                    cursors, keys = await node.scan(cursor=cursor or 0, match=match, count=count, target_nodes=primary)
+                    cursor = cursors[primary.name]
+                    yield node, keys
+        else:
+            cursor = None
+            while cursor != 0:
+                cursor, keys = await node.scan(cursor=cursor or 0, match=match, count=count)
+                yield node, keys
+
+async def scan_buckets(match: bytes, count: int):
+    """Yield (node, key) for bucket keys matching `match` on every bucket node (read side)."""
+    async for node, keys in scan_pages(match, count):
+        for key in keys:
+            yield node, key
 
-async def count_active_keys() -> int:
-    cnt = 0
-    cur = 0
-    pattern = settings.BUCKET_KEY_FMT.replace("{user}", "*").replace("{resource}", "*").encode("UTF-8")
+# Incremental SCAN state shared by sampler ticks; ACTIVE_KEYS_LAST is the
+# result of the last complete pass (None until the first pass finishes).
+ACTIVE_KEYS_SCAN_COUNT = 1000
+_active_scan = {"iter": None, "partial": 0}
+ACTIVE_KEYS_LAST: Optional[int] = None
+
+async def count_active_keys(budget: int) -> Optional[int]:
+    """
+    Advance the keyspace SCAN by about `budget` examined keys: budget //
+    ACTIVE_KEYS_SCAN_COUNT SCAN calls (at least one), however few of the keys
+    match. Returns the bucket count when a full pass completes, else None.
+    A failed SCAN drops the pass; the next call starts a new one.
+    """
+    global ACTIVE_KEYS_LAST
+    if _active_scan["iter"] is None:
+        pattern = settings.BUCKET_KEY_FMT.format(user="*", resource="*").encode("UTF-8")
+        _active_scan["iter"] = scan_pages(pattern, ACTIVE_KEYS_SCAN_COUNT)
+    it = _active_scan["iter"]
+    try:
+        for _ in range(max(1, budget // ACTIVE_KEYS_SCAN_COUNT)):
+            try:
+                _, keys = await it.__anext__()
+            except StopAsyncIteration:
+                ACTIVE_KEYS_LAST = _active_scan["partial"]
+                _active_scan["iter"], _active_scan["partial"] = None, 0
+                return ACTIVE_KEYS_LAST
+            _active_scan["partial"] += len(keys)
+    except Exception:
+        _active_scan["iter"], _active_scan["partial"] = None, 0
+        raise
+    return None
+
+async def active_keys_sampler() -> None:
+    global ACTIVE_KEYS_LAST
     while True:
-        cur, keys = await r.scan(cursor=cur, match=pattern, count=1000)
-        cnt + len(keys)
-        if cur == 0:
-            break
-    return cnt
-
-def floor_time(dt: datetime, bucket: str) -> datetime:
-    if bucket == "minute":   return dt.replace(second=0, microsecond=0, tzinfo=timezone.utc)
-    if bucket == "hour":     return dt.replace(minute=0, second=0, microsecond=0, tzinfo=timezone.utc)
-    if bucket == "day":      return dt.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone.utc)
-    return dt.replace(second=0, microsecond=0, tzinfo=timezone.utc)
-
-def bucket_key_for(dt: datetime, bucket: str) -> str:
-    dt = dt.astimezone(timezone.utc)
-    if bucket == "minute": tag = dt.strftime("%Y%m%d%H%M")
-    elif bucket == "hour": tag = dt.strftime("%Y%m%d%H")
-    elif bucket == "day":  tag = dt.strftime("%Y%m%d")
-    else:                  tag = dt.strftime("%Y%m%d%H%M")
-    return f"{settings.OFFENDERS_BUCKET_PREFIX}:{bucket}:{tag}"
-
-def bucket_ttl_seconds(bucket: str) -> int:
-    return {"minute": 60*90, "hour": 3600*48, "day": 86400*14}.get(bucket, 60*90)
+        if isinstance(limiter, AsyncMemoryLimiter):
+            # In-process buckets: no keyspace to scan
+            ACTIVE_KEYS_LAST = len(limiter)
+            ACTIVE_KEYS.set(ACTIVE_KEYS_LAST)
+            await asyncio.sleep(settings.ACTIVE_KEYS_SAMPLE_INTERVAL_SECONDS)
+            continue
+        try:
+            with BACKGROUND_LAT.labels(task="active_keys").time():
+                cnt = await count_active_keys(settings.ACTIVE_KEYS_SCAN_BUDGET)
+            if cnt is not None:
+                ACTIVE_KEYS.set(cnt)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+        await asyncio.sleep(settings.ACTIVE_KEYS_SAMPLE_INTERVAL_SECONDS)
 
-# ---------- FastAPI ----------
-app = FastAPI(title="Redis Lua Token Bucket (Async)")
+# Denies served by the deny cache, a token lease or the breaker's local buckets never
+# reach limiter.lua, so their offender counts are tallied here and flushed in one
+# pipeline per interval (kept for the next one while Redis is unreachable).
+_local_offenses: TallyCounter = TallyCounter()
+# BACKEND=memory has no offender ZSETs to flush to (AsyncMemoryLimiter ignores offender_keys)
+OFFENSES_TRACKED = settings.BACKEND != "memory"
+
+def note_offense(user_id: str) -> None:
+    if OFFENSES_TRACKED:
+        _local_offenses[user_id] += 1
+
+async def flush_local_offenses() -> None:
+    global _local_offenses
+    if not _local_offenses:
+        return
+    pending, _local_offenses = _local_offenses, TallyCounter()
+    pipe = r.pipeline(transaction=False)
+    for zkey, ttl in offender_keys():
+        for user_id, n in pending.items():
+            pipe.zincrby(zkey, n, user_id)
+        if ttl > 0:
+            pipe.expire(zkey, ttl)
+    try:
+        with BACKGROUND_LAT.labels(task="offender_flush").time():
+            await pipe.execute()
+    except Exception:
+        _local_offenses.update(pending)
+        raise
+
+# ---------- Offender rollups ----------
+# Denies are only counted into the current minute's ZSET (and the all-time
+# total); a background pass every OFFENDERS_ROLLUP_SECONDS folds closed
+# minutes into hours and closed hours into days (app/offender_rollup.py).
+offender_rollups = OffenderRollup(
+    r,
+    prefix=settings.OFFENDERS_BUCKET_PREFIX,
+    on_pass=BACKGROUND_LAT.labels(task="offender_rollup").observe,
+)
 
-class ObsMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        start = time.monotonic_ns()
-        rid = request.headers.get("X-Request-ID") or str(uuid.uuid4())
-        request.state.request_id = rid
+# ---------- Resource registry ----------
+# /admin/resources reads a registry the replicas maintain instead of scanning
+# buckets (app/resource_registry.py), flushed every RESOURCE_STATS_FLUSH_SECONDS.
+REGISTRY_ENABLED = settings.BACKEND != "memory"
+resource_registry = ResourceRegistry(
+    r,
+    rr,
+    key=settings.RESOURCES_KEY,
+    scale=settings.SCALE,
+    ttl_seconds=settings.TTL_SECONDS,
+    on_flush=BACKGROUND_LAT.labels(task="resource_registry_flush").observe,
+)
+
+def note_resource_cfg(resource: str, cap: int, rate_sub_per_sec: int) -> None:
+    if REGISTRY_ENABLED:
+        resource_registry.note_cfg(resource, cap, rate_sub_per_sec)
+
+def note_resource_decision(resource: str, user_id: str, allowed: bool) -> None:
+    if REGISTRY_ENABLED:
+        resource_registry.note_decision(resource, user_id, allowed)
+
+async def resource_registry_flusher() -> None:
+    while True:
+        await asyncio.sleep(settings.RESOURCE_STATS_FLUSH_SECONDS)
         try:
-            resp = await call_next(request)
-            return resp
-        finally:
-            took_ms = (time.monotonic_ns() - start) / 1_000_000.0
-            REQ_LAT.labels(endpoint=request.url.path).observe(took_ms/1000.0)
-            logger.info(json.dumps({
-                "ts": time.time(),
-                "request_id": rid,
-                "method": request.method,
-                "path": request.url.path,
-                "status": getattr(request.state, "status_code", None),
-                "latency_ms": round(took_ms, 3),
-            }))
-
-app.add_middleware(ObsMiddleware)
+            await resource_registry.flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
 
-@app.get("/metrics")
-async def metrics():
+# ---------- Top consumers ----------
+# Every replica keeps a Space-Saving sketch of tokens charged per
+# (user, resource) and flushes it every CONSUMERS_FLUSH_SECONDS
+# (app/consumers.py); /admin/top_consumers merges what all replicas flushed.
+CONSUMERS_ENABLED = settings.BACKEND != "memory" and settings.CONSUMERS_SKETCH_SIZE > 0
+consumers = TopConsumers(
+    r,
+    rr,
+    prefix=settings.CONSUMERS_KEY_PREFIX,
+    sketch_size=settings.CONSUMERS_SKETCH_SIZE,
+    replica_reads=REPLICA_READS,
+    on_flush=BACKGROUND_LAT.labels(task="consumers_flush").observe,
+)
+
+def note_consumption(user_id: str, resource: str, cost: int) -> None:
+    if CONSUMERS_ENABLED:
+        consumers.note(user_id, resource, cost)
+
+async def consumers_flusher() -> None:
+    while True:
+        await asyncio.sleep(settings.CONSUMERS_FLUSH_SECONDS)
+        try:
+            await consumers.flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+
+async def control_flusher() -> None:
+    while True:
+        await asyncio.sleep(settings.OFFENDERS_FLUSH_SECONDS)
+        try:
+            await flush_local_offenses()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+
+async def offender_rollup() -> None:
+    while True:
+        await asyncio.sleep(settings.OFFENDERS_ROLLUP_SECONDS)
+        try:
+            await offender_rollups.run()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+
+async def reload_policy() -> None:
+    """Activate a changed policy file at the instant all replicas agree on (see PolicyLoader.activate_when_due)."""
+    previous = policy.active.version
+    active = await policy.activate_when_due(
+        r if settings.BACKEND != "memory" else None,
+        delay=settings.POLICY_SWITCH_DELAY_SECONDS,
+        key_prefix=settings.POLICY_ACTIVATE_KEY_PREFIX,
+    )
+    if active is None:
+        return
+    logger.info(json.dumps({
+        "ts": time.time(),
+        "event": "policy_activated",
+        "version": active.version,
+        "previous_version": previous,
+        "resources": len(active),
+    }))
+
+async def policy_reloader() -> None:
+    while True:
+        await asyncio.sleep(settings.POLICY_RELOAD_SECONDS)
+        try:
+            await reload_policy()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # A bad file keeps the active policy; it is re-read once it changes again
+            logger.error(json.dumps({"ts": time.time(), "event": "policy_reload_failed", "error": str(e)}))
+
+async def lease_sweeper() -> None:
+    while True:
+        await asyncio.sleep(settings.LEASE_TTL_MS / 1000.0)
+        try:
+            await leases.release_expired()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+
+async def memory_sweeper() -> None:
+    while True:
+        await asyncio.sleep(1.0)
+        try:
+            limiter.evict_expired(settings.MEMORY_EVICT_BUDGET)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+
+# ---------- FastAPI ----------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
     try:
-        ACTIVE_KEYS.set(await count_active_keys())
+        await limiter.load()
     except Exception:
-        pass
+        pass  # EVALSHA falls back to EVAL on NOSCRIPT
+    tasks = [
+        asyncio.create_task(active_keys_sampler()),
+        asyncio.create_task(policy_reloader()),
+    ]
+    if settings.BACKEND != "memory":
+        tasks.append(asyncio.create_task(control_flusher()))
+        tasks.append(asyncio.create_task(resource_registry_flusher()))
+        tasks.append(asyncio.create_task(offender_rollup()))
+    if CONSUMERS_ENABLED:
+        tasks.append(asyncio.create_task(consumers_flusher()))
+    if LEASE_RESOURCES:
+        tasks.append(asyncio.create_task(lease_sweeper()))
+    if isinstance(limiter, AsyncMemoryLimiter):
+        tasks.append(asyncio.create_task(memory_sweeper()))
+    if settings.BINARY_UDS_PATH or settings.BINARY_TCP_PORT:
+        await binary_server.start(settings.BINARY_UDS_PATH, settings.BINARY_TCP_HOST, settings.BINARY_TCP_PORT)
+    try:
+        yield
+    finally:
+        await binary_server.close()
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            await leases.release_expired(release_all=True)
+            await flush_local_offenses()
+            await resource_registry.flush()
+            await consumers.flush()
+        except Exception:
+            pass
+
+app = FastAPI(title="Redis Lua Token Bucket (Async)", lifespan=lifespan)
+
+app.add_middleware(
+    ObsMiddleware,
+    latency=REQ_LAT,
+    logger=logger,
+    redis_calls=REQ_REDIS_CALLS,
+    redis_latency=REQ_REDIS_LAT,
+    server_timing=settings.SERVER_TIMING_ENABLED,
+)
+
+@app.get("/metrics")
+async def metrics():
+    if deny_cache is not None:
+        DENY_CACHE_SIZE.set(len(deny_cache))
+    for op, n in leases.stats.items():
+        LEASE_OPS.labels(op=op).set(n)
     data = generate_latest(registry)
     return PlainTextResponse(data.decode("UTF-8"), media_type=CONTENT_TYPE_LATEST)
 
-@app.post("/allow")
-async def allow(request: Request, 
-    user_id: str, 
-    resource: str = "default", 
-    cost: int = 1, 
-    idempotency: Optional[str] = None
-):
+async def decide(
+    user_id: str,
+    resource: str = "default",
+    cost: int = 1,
+    idempotency: Optional[str] = None,
+    tenant: Optional[str] = None,
+) -> Decision:
+    """
+    The /allow decision, shared by the HTTP endpoint and the binary listener.
+    Raises ValueError where /allow answers 400.
+    """
     global ALLOWED_TOTAL, DENIED_TOTAL
-    t0 = time.monotonic_ns()
-
-    cap, rate_tps = resource_cfg(resource)
-    rate_sub_per_sec = int(rate_tps * settings.SCALE)
+    pol = policy.active.lookup(resource)
+    cap, rate_sub_per_sec = pol.capacity, pol.rate_subtokens_per_sec
+    bucket_ttl = max(settings.TTL_SECONDS, pol.full_refill_seconds)
+    bound_by = None
 
     bucket_key = settings.BUCKET_KEY_FMT.format(user=user_id, resource=resource)
-    idem_key = f"idem:{user_id}:{resource}:{idempotency}" if idempotency else ""
-
-    allowed, retry_after, remaining_tokens, used_idem = await limiter.allow(
-        bucket_key=bucket_key,
-        capacity_tokens=cap,
-        rate_subtokens_per_sec=rate_sub_per_sec,
-        cost_tokens=cost,
-        scale=settings.SCALE,
-        ttl_seconds=settings.TTL_SECONDS,
-        idem_key=idem_key,
-        idempotency_ttl_seconds=settings.IDEM_TTL_SECONDS,
-    )
+    idem_key = idem_key_for(bucket_key, idempotency)
+    if pol.limits and idem_key:
+        raise ValueError("idempotency is not supported for composite resources")
 
+    # Idempotent calls always go to Redis so their result gets cached there. Composite
+    # denies aren't cached: the binding limit may be a tenant or global bucket, which
+    # (user, resource, cost) doesn't identify.
+    cached = deny_cache.get(bucket_key, cost) if deny_cache is not None and not idem_key and not pol.limits else None
+    legacy = await legacy_idem_replay(user_id, resource, idempotency) if LEGACY_IDEM and idem_key else None
+    if cached is not None:
+        DENY_CACHE_HITS.inc()
+        note_offense(user_id)
+        retry_after, remaining_tokens = cached
+        allowed, used_idem = False, False
+    elif legacy is not None:
+        allowed, retry_after, remaining_tokens = legacy
+        used_idem = True
+        if not allowed:
+            note_offense(user_id)
+    elif pol.limits:
+        # Every limit is checked and charged in one all-or-nothing script call
+        names, items = composite_items(pol, user_id, tenant, resource, cost)
+        decisions = await limiter.allow_many(
+            items,
+            scale=settings.SCALE,
+            ttl_seconds=bucket_ttl,
+            all_or_nothing=True,
+        )
+        allowed, retry_after, remaining_tokens, bound_by = fold_decisions(names, decisions)
+        used_idem = False
+        if not allowed:
+            note_offense(user_id)  # once per request, however many limits denied
+    elif resource in LEASE_RESOURCES and not idem_key and pol.algorithm != "sliding_window":
+        note_resource_cfg(resource, cap, rate_sub_per_sec)
+        allowed, retry_after, remaining_tokens, used_idem = await leases.allow(
+            bucket_key=bucket_key,
+            capacity_tokens=cap,
+            rate_subtokens_per_sec=rate_sub_per_sec,
+            cost_tokens=cost,
+            ttl_seconds=bucket_ttl,
+            index_key=user_index_key(user_id),
+        )
+        if not allowed:
+            note_offense(user_id)
+            if deny_cache is not None:
+                deny_cache.put(bucket_key, cost, retry_after, remaining_tokens)
+    else:
+        note_resource_cfg(resource, cap, rate_sub_per_sec)
+        allowed, retry_after, remaining_tokens, used_idem = await single_limiter.allow(
+            bucket_key=bucket_key,
+            capacity_tokens=cap,
+            rate_subtokens_per_sec=rate_sub_per_sec,
+            cost_tokens=cost,
+            scale=settings.SCALE,
+            ttl_seconds=bucket_ttl,
+            idem_key=idem_key,
+            idempotency_ttl_seconds=settings.IDEM_TTL_SECONDS,
+            offender_member=user_id,
+            offender_keys=() if SHARDED else offender_keys(),
+            config_argv=pol.config_argv,
+            algorithm=pol.algorithm,
+            window_ms=pol.window_ms,
+            index_key=user_index_key(user_id),
+        )
+        if not allowed and SHARDED:
+            note_offense(user_id)
+        if not allowed and not used_idem and deny_cache is not None:
+            deny_cache.put(bucket_key, cost, retry_after, remaining_tokens)
+
+    note_resource_decision(resource, user_id, allowed)
+    if allowed and not used_idem:
+        note_consumption(user_id, resource, cost)
     if allowed:
         ALLOWED_TOTAL += 1
         REQ_TOTAL.labels(result="allow").inc()
     else:
         DENIED_TOTAL += 1
         REQ_TOTAL.labels(result="deny").inc()
-        # offenders: global + time bucket
-        try:
-            await r.zincrby(settings.OFFENDERS_ZSET, 1.0, user_id)
-            now = datetime.now(timezone.utc)
-            for bucket in ("minute", "hour", "day"):
-                zkey = bucket_key_for(floor_time(now, bucket), bucket)
-                await r.zincrby(zkey, 1.0, user_id)
-                await r.expire(zkey, bucket_ttl_seconds(bucket))
-        except Exception:
-            pass
+    return Decision(
+        allowed,
+        retry_after,
+        remaining_tokens,
+        bound_by,
+        composite=bool(pol.limits),
+        idempotent_replay=bool(used_idem),
+        deny_cache=cached is not None,
+    )
 
+@app.post("/allow")
+async def allow(request: Request, 
+    user_id: str, 
+    resource: str = "default", 
+    cost: int = 1, 
+    idempotency: Optional[str] = None,
+    tenant: Optional[str] = None,
+):
+    t0 = time.monotonic_ns()
     try:
-        ACTIVE_KEYS.set(await count_active_keys())
-    except Exception:
-        pass
+        d = await decide(user_id, resource, cost, idempotency, tenant)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
 
-    rid = getattr(request.state, "request_id", str(uuid.uuid4()))
+    rid = getattr(request.state, "request_id", None) or new_request_id()
     took_ms = (time.monotonic_ns() - t0) / 1_000_000.0
-    request.state.status_code = 200 if allowed else 429
+    timings = current_timings()
     logger.info(json.dumps({
         "ts": time.time(),
         "request_id": rid,
         "user_id": user_id,
         "resource": resource,
-        "decision": "allow" if allowed else "deny",
-        "tokens_left": round(remaining_tokens, 6),
+        "decision": "allow" if d.allowed else "deny",
+        "tokens_left": round(d.tokens_left, 6),
         "latency_ms": round(took_ms, 3),
-        "idempotent_cache": bool(used_idem),
+        "idempotent_cache": d.idempotent_replay,
+        "deny_cache": d.deny_cache,
+        "limit": d.limit,
+        **(timings.log_fields() if timings is not None else {}),
     }))
 
-    if allowed:
-        return {"allowed": True, "retry_after": 0.0, "tokens_left": remaining_tokens}
-
+    if d.allowed:
+        return d.as_dict()
     return JSONResponse(
         status_code=429,
-        content={"allowed": False, "retry_after": retry_after, "tokens_left": remaining_tokens},
-        headers={"Retry-After": f"{max(0.0, round(retry_after, 3))}", "X-Request-ID": rid},
+        content=d.as_dict(),  # limit is None when answered from the deny cache
+        headers={"Retry-After": f"{max(0.0, round(d.retry_after, 3))}", "X-Request-ID": rid},
     )
 
+# Optional sidecar listener: /allow over a Unix socket and/or TCP, framed binary (app/binary_server.py)
+BINARY_LAT = REQ_LAT.labels(endpoint="binary")
+
+async def binary_decide(
+    user_id: str, resource: str, cost: int, idempotency: Optional[str], tenant: Optional[str],
+) -> Decision:
+    t0 = time.perf_counter()
+    try:
+        return await decide(user_id, resource, cost, idempotency, tenant)
+    finally:
+        BINARY_LAT.observe(time.perf_counter() - t0)
+
+binary_server = BinaryAllowServer(binary_decide, max_inflight=settings.BINARY_MAX_INFLIGHT)
+
+class BatchItem(BaseModel):
+    user_id: str
+    resource: str = "default"
+    cost: int = Field(default=1, ge=0)
+    tenant: Optional[str] = None
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem]
+    all_or_nothing: bool = False
+
+@app.post("/allow/batch")
+async def allow_batch(request: Request, body: BatchRequest):
+    """
+    Decide many (user_id, resource, cost) tuples in one Redis round trip.
+    With all_or_nothing=true either every item is charged or none is, and a
+    rejected batch answers 429 with the longest Retry-After of its items.
+    """
+    global ALLOWED_TOTAL, DENIED_TOTAL
+    t0 = time.monotonic_ns()
+
+    if not body.items or len(body.items) > settings.BATCH_MAX_ITEMS:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"items must contain 1..{settings.BATCH_MAX_ITEMS} entries"},
+        )
+
+    # One (limit names, allow_many items) part per request item; names is None for plain resources
+    parts: List[Tuple[Optional[List[str]], list]] = []
+    ttl = settings.TTL_SECONDS
+    for it in body.items:
+        pol = policy.active.lookup(it.resource)
+        if pol.algorithm != "token_bucket":
+            # limiter_batch.lua is token-bucket only and would rewrite GCRA/window state under its own rules
+            return JSONResponse(
+                status_code=400,
+                content={"error": f"resource {it.resource!r} uses {pol.algorithm}, which /allow/batch does not support"},
+            )
+        ttl = max(ttl, pol.full_refill_seconds)
+        if pol.limits:
+            parts.append(composite_items(pol, it.user_id, it.tenant, it.resource, it.cost))
+            continue
+        note_resource_cfg(it.resource, pol.capacity, pol.rate_subtokens_per_sec)
+        bucket_key = settings.BUCKET_KEY_FMT.format(user=it.user_id, resource=it.resource)
+        parts.append((None, [(
+            bucket_key, pol.capacity, pol.rate_subtokens_per_sec, it.cost, it.user_id, user_index_key(it.user_id),
+        )]))
+
+    # Composite denies count once per request item, so they are tallied here
+    composite = any(names is not None for names, _ in parts)
+    count_locally = SHARDED or composite
+    off_keys = () if count_locally else offender_keys()
+
+    per_part: list = [None] * len(parts)
+    if body.all_or_nothing or not composite:
+        flat = [item for _, its in parts for item in its]
+        flat_decisions = await limiter.allow_many(
+            flat,
+            scale=settings.SCALE,
+            ttl_seconds=ttl,
+            all_or_nothing=body.all_or_nothing,
+            offender_keys=off_keys,
+        )
+        pos = 0
+        for i, (_, its) in enumerate(parts):
+            per_part[i] = flat_decisions[pos:pos + len(its)]
+            pos += len(its)
+    else:
+        # Each composite item is atomic on its own; plain items share one call
+        plain = [i for i, (names, _) in enumerate(parts) if names is None]
+        comp = [i for i, (names, _) in enumerate(parts) if names is not None]
+        calls = []
+        if plain:
+            calls.append(limiter.allow_many(
+                [parts[i][1][0] for i in plain],
+                scale=settings.SCALE,
+                ttl_seconds=ttl,
+                offender_keys=off_keys,
+            ))
+        calls += [
+            limiter.allow_many(parts[i][1], scale=settings.SCALE, ttl_seconds=ttl, all_or_nothing=True)
+            for i in comp
+        ]
+        outcomes = await asyncio.gather(*calls)
+        if plain:
+            for i, d in zip(plain, outcomes[0]):
+                per_part[i] = [d]
+            outcomes = outcomes[1:]
+        for i, ds in zip(comp, outcomes):
+            per_part[i] = ds
+
+    decisions = []
+    results = []
+    for it, (names, _), ds in zip(body.items, parts, per_part):
+        if names is None:
+            allowed, retry_after, remaining_tokens, _ = ds[0]
+            bound_by = None
+        else:
+            allowed, retry_after, remaining_tokens, bound_by = fold_decisions(names, ds)
+        decisions.append((allowed, retry_after))
+        note_resource_decision(it.resource, it.user_id, allowed)
+        if allowed:
+            note_consumption(it.user_id, it.resource, it.cost)
+            ALLOWED_TOTAL += 1
+            REQ_TOTAL.labels(result="allow").inc()
+        else:
+            DENIED_TOTAL += 1
+            REQ_TOTAL.labels(result="deny").inc()
+            # rolled-back items that would have passed report retry_after=0
+            if count_locally and retry_after > 0:
+                note_offense(it.user_id)
+        result = {
+            "user_id": it.user_id,
+            "resource": it.resource,
+            "allowed": allowed,
+            "retry_after": retry_after,
+            "tokens_left": remaining_tokens,
+        }
+        if names is not None:
+            result["limit"] = bound_by
+        results.append(result)
+
+    all_allowed = all(d[0] for d in decisions)
+    max_retry = max(d[1] for d in decisions)
+
+    rid = getattr(request.state, "request_id", None) or new_request_id()
+    took_ms = (time.monotonic_ns() - t0) / 1_000_000.0
+    denied_batch = body.all_or_nothing and not all_allowed
+    logger.info(json.dumps({
+        "ts": time.time(),
+        "request_id": rid,
+        "batch_size": len(parts),
+        "all_or_nothing": body.all_or_nothing,
+        "decision": "allow" if all_allowed else ("deny" if denied_batch else "partial"),
+        "latency_ms": round(took_ms, 3),
+    }))
+
+    content = {"allowed": all_allowed, "retry_after": max_retry, "results": results}
+    if denied_batch:
+        return JSONResponse(
+            status_code=429,
+            content=content,
+            headers={"Retry-After": f"{max(0.0, round(max_retry, 3))}", "X-Request-ID": rid},
+        )
+    return content
+
 @app.get("/admin/stats")
 async def admin_stats(top_n: int = 10):
     try:
-        raw = await r.zrevrange(settings.OFFENDERS_ZSET, 0, top_n-1, withscores=True)
+        raw = await rr.zrevrange(settings.OFFENDERS_ZSET, 0, top_n-1, withscores=True)
         offenders = [{"user_id": (uid.decode() if isinstance(uid, bytes) else uid), "denies": int(score)} for uid, score in raw]
     except Exception:
         offenders = []
-    try:
-        active = await count_active_keys()
-    except Exception:
-        active = None
     return {
         "allowed_total": ALLOWED_TOTAL,
         "denied_total": DENIED_TOTAL,
-        "active_keys": active,
+        "active_keys": ACTIVE_KEYS_LAST,
+        "policy_version": policy.active.version,
         "top_offenders": offenders,
     }
 
+@app.get("/admin/resources")
+async def admin_resources():
+    """
+    Every resource seen by any replica, from the registry (O(resources), no
+    bucket SCAN): config, last decision, approximate live buckets and
+    allow/deny rates over the last complete minute.
+    """
+    def default_cfg(resource: str) -> Tuple[int, int]:
+        pol = policy.active.lookup(resource)
+        return pol.capacity, pol.rate_subtokens_per_sec
+    return {"resources": await resource_registry.resources(default_cfg)}
+
+# (window, bucket, top_n) -> (expires at, result): dashboards poll the same few queries
+_top_offenders_cache: Dict[Tuple[str, str, int], Tuple[float, List[dict]]] = {}
+
 @app.get("/admin/top_offenders")
 async def top_offenders(window: str = "1h", bucket: str = "minute", top_n: int = 10):
     """
     window: e.g., 15m, 1h, 6h, 24h
-    bucket: minute|hour|day
-    Aggregates ZSETs within the window via ZUNIONSTORE into a temp key.
+    bucket: minute|hour|day, the granularity the window's start is rounded down to
+    Unions the day/hour rollups covering the window plus the minutes at its
+    edges; results are cached for TOP_OFFENDERS_CACHE_SECONDS.
     """
     units = {"m": "minutes", "h": "hours", "d": "days"}
     try:
@@ -225,81 +944,186 @@ async def top_offenders(window: str = "1h", bucket: str = "minute", top_n: int =
     except Exception:
         return JSONResponse(status_code=400, content={"error": "invalid window; use 15m|1h|24h"})
 
+    cache_key = (window, bucket, top_n)
+    cached = _top_offenders_cache.get(cache_key)
+    if cached is not None and cached[0] > time.monotonic():
+        return {"window": window, "bucket": bucket, "top_offenders": cached[1]}
+
     now = datetime.now(timezone.utc)
-    start = now - timedelta(**kwargs)
-
-    # build list of ZSET keys for the window
-    keys: List[str] = []
-    cursor = floor_time(now, bucket)
-    step = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1), "day": timedelta(days=1)}.get(bucket, timedelta(minutes=1))
-    while cursor >= floor_time(start, bucket):
-        keys.append(bucket_key_for(cursor, bucket))
-        cursor -= step
-    if not keys:
-        return {"window": window, "bucket": bucket, "top_offenders": []}
+    start = int(floor_time(now - timedelta(**kwargs), bucket).timestamp() // 60)
+    end = int(now.timestamp() // 60) + 1
+    # Finer ZSETs past their retention are gone: round the start out to the next coarser one
+    if end - start > bucket_ttl_seconds("minute") // 60:
+        start -= start % 60
+    if end - start > bucket_ttl_seconds("hour") // 60:
+        start -= start % 1440
+    folded_min, folded_hour = await offender_rollups.watermarks(rr)
+    # Before the first rollup pass nothing is folded yet
+    keys = offender_cover(start, end, folded_min or start, folded_hour or start)
 
-    # union into a temp key
-    temp_key = f"{settings.OFFENDERS_BUCKET_PREFIX}:tmp:{uuid.uuid4()}"
-    try:
-        await r.zunionstore(temp_key, keys=keys)  # sum by default
-        await r.expire(temp_key, 30)  # short TTL
-        raw = await r.zrevrange(temp_key, 0, top_n-1, withscores=True)
-        out = [{"user_id": (u.decode() if isinstance(u, bytes) else u), "denies": int(s)} for u, s in raw]
-    finally:
-        # let ttl clean it; no hard DEL needed
-        pass
+    if len(keys) == 1:
+        raw = await rr.zrevrange(keys[0], 0, top_n-1, withscores=True)
+    elif REPLICA_READS:
+        # A replica can't store the union: compute it and take the top N here
+        raw = heapq.nlargest(top_n, await rr.zunion(keys, withscores=True), key=lambda ms: ms[1])
+    else:
+        # Same-window queries share one short-lived result key
+        temp_key = f"{settings.OFFENDERS_BUCKET_PREFIX}:tmp:{window}:{bucket}"
+        pipe = r.pipeline(transaction=True)
+        pipe.zunionstore(temp_key, keys=keys)  # sum by default
+        pipe.expire(temp_key, 30)
+        pipe.zrevrange(temp_key, 0, top_n-1, withscores=True)
+        raw = (await pipe.execute())[-1]
+    out = [{"user_id": (u.decode() if isinstance(u, bytes) else u), "denies": int(s)} for u, s in raw]
 
+    if len(_top_offenders_cache) >= 1_000:
+        _top_offenders_cache.clear()  # query params come from clients; stay bounded
+    _top_offenders_cache[cache_key] = (time.monotonic() + settings.TOP_OFFENDERS_CACHE_SECONDS, out)
     return {"window": window, "bucket": bucket, "top_offenders": out}
 
-@app.get("/admin/user/{user_id}")
-async def admin_user(user_id: str):
+@app.get("/admin/top_consumers")
+async def top_consumers(window: str = "1h", top_n: int = 10):
+    """
+    Heaviest (user, resource) pairs by tokens charged, merged from every
+    replica's sketch. window: up to 60m at minute resolution, up to 48h in
+    whole hours. A pair's true total lies in
+    [tokens - error, tokens + max_untracked].
+    """
+    units = {"m": 60, "h": 3600, "d": 86400}
+    try:
+        seconds = int(window[:-1]) * units[window[-1]]
+    except Exception:
+        return JSONResponse(status_code=400, content={"error": "invalid window; use 15m|1h|24h"})
+    if not 0 < seconds <= bucket_ttl_seconds("hour"):
+        return JSONResponse(status_code=400, content={"error": "window must be between 1m and 48h"})
+
+    out, max_untracked = await consumers.top(window, seconds, top_n)
+    return {
+        "window": window,
+        "top_consumers": out,
+        "max_untracked": max_untracked,
+    }
+
+async def indexed_buckets(user_id: str) -> List[Tuple[bytes, Optional[dict], dict]]:
+    """
+    (key, state, legacy_config) for the user's live buckets, from the index
+    the scripts keep: one ZRANGEBYSCORE, then every state in one pipeline.
+    Legacy hash buckets only join the index once they are rewritten.
+    """
+    index_key = user_index_key(user_id)
+    node = read_node(index_key)
+    keys = await node.zrangebyscore(index_key, f"({int(time.time() * 1000)}", "+inf")
+    if not keys:
+        return []
+    pipe = node.pipeline(transaction=False)
+    for k in keys:
+        pipe.get(k)
+    raws = await pipe.execute(raise_on_error=False)
+    out = []
+    for k, raw in zip(keys, raws):
+        if isinstance(raw, redis.ResponseError):  # WRONGTYPE: legacy hash
+            out.append((k, *await read_bucket(node, k)))
+        else:
+            out.append((k, parse_bucket(raw), {}))
+    return out
+
+async def scanned_buckets(user_id: str) -> List[Tuple[bytes, Optional[dict], dict]]:
+    """indexed_buckets() by SCANning every bucket node, for when there is no index."""
     pattern = settings.BUCKET_KEY_FMT.format(user=user_id, resource="*").encode("utf-8")
-    cur = 0
+    return [(k, *await read_bucket(node, k)) async for node, k in scan_buckets(pattern, 500)]
+
+@app.get("/admin/user/{user_id}")
+async def admin_user(user_id: str, scan: bool = False):
+    """
+    The user's buckets with refill applied. Read from the per-user index
+    (USER_INDEX_KEY_FMT); scan=true walks the keyspace instead, which also
+    finds buckets written before the index existed.
+    """
+    try:
+        published = await rr.hgetall(settings.RESOURCES_KEY)
+    except Exception:
+        published = {}
+    found = await (indexed_buckets(user_id) if USER_INDEX and not scan else scanned_buckets(user_id))
+    now_ms = time.time() * 1000.0
     resources: List[dict] = []
-    while True:
-        cur, keys = await r.scan(cursor=cur, match=pattern, count=500)
-        for k in keys:
-            key_str = k.decode()
-            try:
-                resource = key_str.split(":", 2)[2]
-            except Exception:
-                resource = "unknown"
-
-            # Read persisted config + tokens (written by Lua)
-            vals = await r.hmget(k, b"tokens", b"capacity_tokens", b"rate_subtokens_per_sec", b"scale")
-            tokens_sub = float(vals[0].decode()) if vals[0] else 0.0
-            cap_tokens = int(vals[1].decode()) if vals[1] else settings.DEFAULT_CAPACITY
-            rate_sub = int(vals[2].decode()) if vals[2] else int(settings.DEFAULT_RATE_TOKENS_PER_SEC * settings.SCALE)
-            sc = int(vals[3].decode()) if vals[3] else settings.SCALE
-
-            tokens = tokens_sub / sc
-            rate_tps = rate_sub / sc
-
-            next_token = 0.0 if tokens >= 1.0 else (1.0 - tokens) / max(rate_tps, 1e-12)
-            full_refill = 0.0 if tokens >= cap_tokens else (cap_tokens - tokens) / max(rate_tps, 1e-12)
-
-            resources.append({
-                "resource": resource,
-                "capacity": cap_tokens,
-                "refill_rate_per_sec": round(rate_tps, 6),
-                "tokens": round(tokens, 6),
-                "next_token_seconds": max(0.0, round(next_token, 6)),
-                "full_refill_seconds": max(0.0, round(full_refill, 6)),
-            })
-        if cur == 0:
-            break
+    for k, state, cfg in found:
+        key_str = k.decode()
+        try:
+            resource = key_str.split(":", 2)[2]
+        except Exception:
+            resource = "unknown"
+
+        if state is None:
+            continue  # expired between listing and read
+        if not cfg and resource.encode() in published:
+            cfg = json.loads(published[resource.encode()])
+        if not cfg:
+            pol = policy.active.lookup(resource)
+            cfg = {"capacity": pol.capacity, "rate_subtokens_per_sec": pol.rate_subtokens_per_sec, "scale": settings.SCALE}
+        cap_tokens, rate_sub, sc = cfg["capacity"], cfg["rate_subtokens_per_sec"], cfg["scale"]
+
+        window_ms = policy.active.lookup(resource).window_ms or 1000
+        tokens = current_subtokens(state, cap_tokens, rate_sub, sc, window_ms, now_ms) / sc
+        rate_tps = rate_sub / sc
+
+        next_token = 0.0 if tokens >= 1.0 else (1.0 - tokens) / max(rate_tps, 1e-12)
+        full_refill = 0.0 if tokens >= cap_tokens else (cap_tokens - tokens) / max(rate_tps, 1e-12)
+
+        resources.append({
+            "resource": resource,
+            "capacity": cap_tokens,
+            "refill_rate_per_sec": round(rate_tps, 6),
+            "tokens": round(tokens, 6),
+            "next_token_seconds": max(0.0, round(next_token, 6)),
+            "full_refill_seconds": max(0.0, round(full_refill, 6)),
+        })
     return {"user_id": user_id, "resources": resources}
 
+# /peek reads bucket state on the read side and replays the scripts' math (app/peek.py)
+peeker = BucketPeeker(read_node, scale=settings.SCALE)
+
+@app.get("/peek")
+async def peek(user_id: str, resource: str = "default", cost: int = 1, tenant: Optional[str] = None):
+    """
+    What POST /allow would answer right now, without charging: tokens left
+    and retry_after (the ETA for `cost` tokens), computed from the bucket
+    state on the read side (REDIS_REPLICA_URL when set), which trails the
+    primary by the replication lag. Tokens leased to replicas and their deny
+    caches are not visible from Redis.
+    """
+    if isinstance(limiter, AsyncMemoryLimiter):
+        return JSONResponse(status_code=501, content={"error": "peek reads bucket state from Redis"})
+    pol = policy.active.lookup(resource)
+    if pol.limits:
+        names, targets = [], []
+        for lim in pol.limits:
+            owner = composite_owner(lim.scope, user_id, tenant)
+            if owner is None:
+                continue
+            names.append(lim.name)
+            targets.append((f"{settings.BUCKET_KEY_FMT.format(user=owner, resource=resource)}:{lim.name}", lim))
+    else:
+        targets = [(settings.BUCKET_KEY_FMT.format(user=user_id, resource=resource), pol)]
+    decisions = await peeker.decisions(targets, cost)
+    if pol.limits:
+        allowed, retry_after, tokens, bound_by = fold_decisions(names, decisions)
+        return Decision(allowed, retry_after, tokens, bound_by, composite=True).as_dict()
+    return Decision(*decisions[0][:3]).as_dict()
+
 @app.get("/readyz")
 async def readyz():
     """
     Readiness = Redis reachable and Lua script loadable.
     """
+    if isinstance(limiter, AsyncMemoryLimiter):
+        return {"ready": True}
     try:
         pong = await r.ping()
         # Quick sanity: eval a no-op (EVAL will load if SHA missing)
         _ = await r.eval("return 1", 0)
         ok = bool(pong)
+        for node in BUCKET_NODES:
+            ok = ok and bool(await node.ping())
     except Exception as e:
         return JSONResponse(status_code=503, content={"ready": False, "error": str(e)})
     return {"ready": ok}
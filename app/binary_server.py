@@ -0,0 +1,218 @@
+"""
+Binary /allow listener for sidecars: the same decision as POST /allow
+without HTTP parsing, query validation or JSON, over a Unix domain socket
+(and/or TCP).
+
+Every message is a frame: a big-endian u32 byte count, then the payload.
+Strings are a u16 byte count + UTF-8; an empty string means "not given".
+
+    request:   u32 cost | str user_id | str resource | str idempotency | str tenant
+    response:  u8 status | f64 retry_after | f64 tokens_left | str text
+
+status is 0 allowed, 1 denied, 2 rejected (where /allow answers 400) or
+3 failed (500). text is the binding limit of a composite resource, or the
+error.
+
+A connection may pipeline any number of requests without waiting for
+replies: up to `max_inflight` per connection are decided concurrently and
+replies come back in request order.
+"""
+from __future__ import annotations
+import asyncio
+import contextlib
+import os
+import struct
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from app.client import Decision
+
+ALLOWED, DENIED, REJECTED, FAILED = 0, 1, 2, 3
+MAX_FRAME = 64 * 1024
+
+_LEN = struct.Struct(">I")
+_STR = struct.Struct(">H")
+_COST = struct.Struct(">I")
+_RESULT = struct.Struct(">Bdd")
+
+# decide(user_id, resource, cost, idempotency, tenant)
+Decide = Callable[[str, str, int, Optional[str], Optional[str]], Awaitable[Decision]]
+
+def _pack_str(s: Optional[str]) -> bytes:
+    b = (s or "").encode("utf-8")
+    return _STR.pack(len(b)) + b
+
+def _unpack_strs(payload: bytes, offset: int, n: int) -> List[str]:
+    out = []
+    for _ in range(n):
+        (size,) = _STR.unpack_from(payload, offset)
+        offset += _STR.size
+        if offset + size > len(payload):
+            raise ValueError("truncated string")
+        out.append(payload[offset:offset + size].decode("utf-8"))
+        offset += size
+    return out
+
+def encode_request(
+    user_id: str,
+    resource: str = "default",
+    cost: int = 1,
+    idempotency: Optional[str] = None,
+    tenant: Optional[str] = None,
+) -> bytes:
+    payload = _COST.pack(cost) + _pack_str(user_id) + _pack_str(resource) + _pack_str(idempotency) + _pack_str(tenant)
+    return _LEN.pack(len(payload)) + payload
+
+def decode_request(payload: bytes) -> Tuple[str, str, int, Optional[str], Optional[str]]:
+    (cost,) = _COST.unpack_from(payload, 0)
+    user_id, resource, idempotency, tenant = _unpack_strs(payload, _COST.size, 4)
+    if not user_id:
+        raise ValueError("user_id is required")
+    return user_id, resource or "default", cost, idempotency or None, tenant or None
+
+def encode_response(status: int, retry_after: float, tokens_left: float, text: str = "") -> bytes:
+    payload = _RESULT.pack(status, retry_after, tokens_left) + _pack_str(text)
+    return _LEN.pack(len(payload)) + payload
+
+def decode_response(payload: bytes) -> Tuple[int, float, float, str]:
+    status, retry_after, tokens_left = _RESULT.unpack_from(payload, 0)
+    (text,) = _unpack_strs(payload, _RESULT.size, 1)
+    return status, retry_after, tokens_left, text
+
+async def read_frame(reader: asyncio.StreamReader, max_frame: int = MAX_FRAME) -> Optional[bytes]:
+    """The next payload, or None at a clean end of stream."""
+    try:
+        head = await reader.readexactly(_LEN.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise
+        return None
+    (size,) = _LEN.unpack(head)
+    if size > max_frame:
+        raise ValueError(f"frame of {size} bytes exceeds {max_frame}")
+    return await reader.readexactly(size)
+
+
+class BinaryAllowServer:
+    """Serves `decide` over the framing above; start() on a UDS path and/or a TCP port."""
+
+    def __init__(self, decide: Decide, *, max_inflight: int = 128, max_frame: int = MAX_FRAME):
+        self._decide = decide
+        self._max_inflight = max_inflight
+        self._max_frame = max_frame
+        self._servers: List[asyncio.AbstractServer] = []
+        self._uds_path: Optional[str] = None
+
+    async def start(self, uds_path: str = "", host: str = "", port: int = 0) -> None:
+        if uds_path:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(uds_path)  # stale socket from a previous run
+            self._servers.append(await asyncio.start_unix_server(self._serve, path=uds_path))
+            self._uds_path = uds_path
+        if port:
+            self._servers.append(await asyncio.start_server(self._serve, host or "127.0.0.1", port))
+
+    @property
+    def sockets(self) -> list:
+        return [sock for srv in self._servers for sock in srv.sockets]
+
+    async def close(self) -> None:
+        for srv in self._servers:
+            srv.close()
+            await srv.wait_closed()
+        self._servers.clear()
+        if self._uds_path:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self._uds_path)
+
+    async def _answer(self, payload: bytes) -> bytes:
+        try:
+            d = await self._decide(*decode_request(payload))
+        except (ValueError, struct.error, UnicodeDecodeError) as e:
+            return encode_response(REJECTED, 0.0, 0.0, str(e))
+        except Exception as e:
+            return encode_response(FAILED, 0.0, 0.0, type(e).__name__)
+        return encode_response(ALLOWED if d.allowed else DENIED, d.retry_after, d.tokens_left, d.limit or "")
+
+    async def _reply(self, payload: bytes, previous: Optional[asyncio.Task], writer: asyncio.StreamWriter) -> None:
+        out = await self._answer(payload)
+        if previous is not None:
+            await previous  # replies leave in request order
+        writer.write(out)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        inflight = asyncio.Semaphore(self._max_inflight)
+        last: Optional[asyncio.Task] = None
+        try:
+            while True:
+                payload = await read_frame(reader, self._max_frame)
+                if payload is None:
+                    break
+                await inflight.acquire()
+                last = asyncio.create_task(self._reply(payload, last, writer))
+                last.add_done_callback(lambda _: inflight.release())
+                if writer.transport.get_write_buffer_size() > self._max_frame:
+                    await writer.drain()  # the peer is not reading its replies
+            if last is not None:
+                await last
+            await writer.drain()
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass  # oversized frame or dropped peer: close the connection
+        finally:
+            writer.close()
+            with contextlib.suppress(Exception):
+                await writer.wait_closed()
+
+
+class BinaryAllowClient:
+    """Pipelining client for BinaryAllowServer (tests, benchmarks, Python sidecar callers)."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._waiters: "asyncio.Queue[asyncio.Future]" = asyncio.Queue()
+        self._reader_task = asyncio.create_task(self._read_replies())
+
+    @classmethod
+    async def connect(cls, uds_path: str = "", host: str = "127.0.0.1", port: int = 0) -> "BinaryAllowClient":
+        if uds_path:
+            reader, writer = await asyncio.open_unix_connection(uds_path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def _read_replies(self) -> None:
+        try:
+            while True:
+                payload = await read_frame(self._reader)
+                if payload is None:
+                    raise ConnectionError("server closed the connection")
+                self._waiters.get_nowait().set_result(decode_response(payload))
+        except Exception as e:
+            while not self._waiters.empty():
+                fut = self._waiters.get_nowait()
+                if not fut.done():
+                    fut.set_exception(e)
+
+    async def allow(
+        self,
+        user_id: str,
+        resource: str = "default",
+        cost: int = 1,
+        idempotency: Optional[str] = None,
+        tenant: Optional[str] = None,
+    ) -> Tuple[int, float, float, str]:
+        """(status, retry_after, tokens_left, text); concurrent calls share the connection."""
+        if self._reader_task.done():
+            raise ConnectionError("connection is closed")
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.put_nowait(fut)
+        self._writer.write(encode_request(user_id, resource, cost, idempotency, tenant))
+        return await fut
+
+    async def close(self) -> None:
+        self._writer.close()
+        with contextlib.suppress(Exception):
+            await self._writer.wait_closed()
+        self._reader_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._reader_task
@@ -0,0 +1,294 @@
+from __future__ import annotations
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import redis.exceptions
+
+from app.lua_limiter_async import AsyncLuaLimiter, BatchItem, OffenderKey
+from app.memory_limiter import AsyncMemoryLimiter
+
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+# What counts as Redis being unavailable; script errors and bad arguments don't
+_OUTAGE = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError, OSError)
+
+Decision = Tuple[bool, float, float, bool]
+
+
+class CircuitBreaker:
+    """
+    Closed until `failure_threshold` consecutive failures, then open for
+    `reset_seconds`. After that one caller at a time is let through as a
+    probe (half-open): its success closes the breaker, its failure reopens it.
+    A probe that never reports back is replaced after another reset_seconds.
+    """
+
+    __slots__ = ("failure_threshold", "reset_seconds", "state", "_failures", "_until", "_now", "_on_state")
+
+    def __init__(
+        self,
+        *,
+        failure_threshold: int = 5,
+        reset_seconds: float = 2.0,
+        now: Callable[[], float] = time.monotonic,
+        on_state: Optional[Callable[[int], None]] = None,
+    ):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self._failures = 0
+        self._until = 0.0  # OPEN: when probing may start; HALF_OPEN: when the probe is given up on
+        self._now = now
+        self._on_state = on_state
+
+    def _set(self, state: int) -> None:
+        self.state = state
+        if self._on_state is not None:
+            self._on_state(state)
+
+    def admit(self) -> bool:
+        """Whether this call may go to Redis."""
+        if self.state == CLOSED:
+            return True
+        now = self._now()
+        if now < self._until:
+            return False
+        self._until = now + self.reset_seconds
+        if self.state == OPEN:
+            self._set(HALF_OPEN)
+        return True
+
+    def success(self) -> bool:
+        """Record a call that reached Redis; True if that closed the breaker."""
+        self._failures = 0
+        if self.state == CLOSED:
+            return False
+        self._set(CLOSED)
+        return True
+
+    def failure(self) -> None:
+        self._failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+            self._until = self._now() + self.reset_seconds
+            self._set(OPEN)
+
+
+class _Debt:
+    __slots__ = ("tokens", "capacity", "rate", "scale", "ttl", "index_key")
+
+    def __init__(self, capacity: int, rate: int, scale: int, ttl: int, index_key: str):
+        self.tokens = 0
+        self.capacity = capacity
+        self.rate = rate
+        self.scale = scale
+        self.ttl = ttl
+        self.index_key = index_key
+
+
+class BreakerLimiter:
+    """
+    AsyncLuaLimiter guarded by a latency budget and a CircuitBreaker.
+
+    A call that does not complete within `budget_ms`, or fails with a
+    connection error, counts as a failure and is decided locally instead of
+    raising; once the breaker opens, calls skip Redis altogether until a probe
+    gets through. Local decisions come from an AsyncMemoryLimiter whose buckets
+    get `local_share` of each policy's capacity and refill rate. Replicas
+    decide independently, so the default of 1.0 is only right for a single
+    replica; 1 / replica count keeps the fleet near the global limit while
+    every replica is cut off.
+
+    Tokens charged locally are remembered per bucket and withdrawn from Redis
+    through lease.lua when the breaker closes (clamped at an empty bucket), so
+    an outage doesn't hand out a second full allowance afterwards. At most
+    `max_debts` buckets are remembered; spend on further buckets is not
+    reconciled (reported through on_debt_dropped). Sliding window counters are
+    not reconciled either. A call cut off by the budget may still have been
+    charged in Redis as well; the error is on the side of denying.
+    """
+
+    def __init__(
+        self,
+        inner: AsyncLuaLimiter,
+        *,
+        budget_ms: float = 50.0,
+        failure_threshold: int = 5,
+        reset_seconds: float = 2.0,
+        local_share: float = 1.0,
+        max_debts: int = 100_000,
+        on_state: Optional[Callable[[int], None]] = None,
+        on_fallback: Optional[Callable[[], None]] = None,
+        on_overrun: Optional[Callable[[], None]] = None,
+        on_debt_dropped: Optional[Callable[[], None]] = None,
+        on_local_deny: Optional[Callable[[str], None]] = None,
+        now: Callable[[], float] = time.monotonic,
+    ):
+        if not 0 < local_share <= 1:
+            raise ValueError("local_share must be in (0, 1]")
+        self._inner = inner
+        self._budget = budget_ms / 1000.0 if budget_ms > 0 else None
+        self._share = local_share
+        self._on_fallback = on_fallback
+        self._on_overrun = on_overrun
+        self._on_debt_dropped = on_debt_dropped
+        # Denies the script would have counted against offender ZSETs
+        self._on_local_deny = on_local_deny
+        self.breaker = CircuitBreaker(
+            failure_threshold=failure_threshold, reset_seconds=reset_seconds, now=now, on_state=on_state,
+        )
+        self._local = AsyncMemoryLimiter()
+        self._debts: Dict[str, _Debt] = {}
+        self._max_debts = max_debts
+        self._tasks: Set[asyncio.Task] = set()  # the loop only keeps weak references
+
+    @property
+    def r(self):
+        return self._inner.r
+
+    async def load(self) -> None:
+        await self._inner.load()
+
+    def _shared(self, capacity_tokens: int, rate_subtokens_per_sec: int) -> Tuple[int, int]:
+        return max(1, int(capacity_tokens * self._share)), max(1, int(rate_subtokens_per_sec * self._share))
+
+    def _owe(self, bucket_key: str, tokens: int, capacity: int, rate: int, scale: int, ttl: int, index_key: str) -> None:
+        d = self._debts.get(bucket_key)
+        if d is None:
+            if len(self._debts) >= self._max_debts:
+                if self._on_debt_dropped is not None:
+                    self._on_debt_dropped()
+                return
+            d = self._debts[bucket_key] = _Debt(capacity, rate, scale, ttl, index_key)
+        d.tokens += tokens
+
+    async def _guarded(self, call: Callable[[], Awaitable]):
+        """(True, result) if Redis answered in time, (False, None) to decide locally."""
+        if not self.breaker.admit():
+            return False, None
+        try:
+            async with asyncio.timeout(self._budget):
+                res = await call()
+        except TimeoutError:
+            if self._on_overrun is not None:
+                self._on_overrun()
+            self.breaker.failure()
+            return False, None
+        except _OUTAGE:
+            self.breaker.failure()
+            return False, None
+        except Exception:
+            self._succeeded()  # Redis answered, with an error of the caller's making
+            raise
+        self._succeeded()
+        return True, res
+
+    def _succeeded(self) -> None:
+        if self.breaker.success() and self._debts:
+            task = asyncio.get_running_loop().create_task(self.reconcile())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _fell_back(self) -> None:
+        if self._on_fallback is not None:
+            self._on_fallback()
+        self._local.evict_expired(64)
+
+    async def allow(self, **kwargs) -> Decision:
+        ok, res = await self._guarded(lambda: self._inner.allow(**kwargs))
+        if ok:
+            return res
+        self._fell_back()
+        local = dict(kwargs, config_argv=())
+        local["capacity_tokens"], local["rate_subtokens_per_sec"] = self._shared(
+            kwargs["capacity_tokens"], kwargs["rate_subtokens_per_sec"],
+        )
+        res = await self._local.allow(**local)
+        allowed, _, _, used_idem = res
+        if allowed and not used_idem and kwargs.get("algorithm", "token_bucket") != "sliding_window":
+            self._owe(
+                kwargs["bucket_key"], kwargs["cost_tokens"], kwargs["capacity_tokens"],
+                kwargs["rate_subtokens_per_sec"], kwargs["scale"], kwargs["ttl_seconds"], kwargs.get("index_key", ""),
+            )
+        elif not allowed and kwargs.get("offender_keys") and self._on_local_deny is not None:
+            self._on_local_deny(kwargs.get("offender_member", ""))
+        return res
+
+    async def allow_many(
+        self,
+        items: Sequence[BatchItem],
+        *,
+        scale: int,
+        ttl_seconds: int,
+        all_or_nothing: bool = False,
+        offender_keys: Sequence[OffenderKey] = (),
+    ) -> List[Decision]:
+        ok, res = await self._guarded(lambda: self._inner.allow_many(
+            items, scale=scale, ttl_seconds=ttl_seconds, all_or_nothing=all_or_nothing, offender_keys=offender_keys,
+        ))
+        if ok:
+            return res
+        self._fell_back()
+        res = await self._local.allow_many(
+            [(item[0], *self._shared(item[1], item[2]), *item[3:]) for item in items],
+            scale=scale,
+            ttl_seconds=ttl_seconds,
+            all_or_nothing=all_or_nothing,
+        )
+        for item, (allowed, *_) in zip(items, res):
+            if allowed:
+                self._owe(item[0], item[3], item[1], item[2], scale, ttl_seconds, item[5] if len(item) > 5 else "")
+            elif offender_keys and self._on_local_deny is not None:
+                self._on_local_deny(item[4])
+        return res
+
+    async def lease(self, **kwargs) -> Tuple[int, float, float]:
+        ok, res = await self._guarded(lambda: self._inner.lease(**kwargs))
+        if ok:
+            return res
+        self._fell_back()
+        local = dict(kwargs)
+        local["capacity_tokens"], local["rate_subtokens_per_sec"] = self._shared(
+            kwargs["capacity_tokens"], kwargs["rate_subtokens_per_sec"],
+        )
+        res = await self._local.lease(**local)
+        owed = res[0] - kwargs.get("return_tokens", 0)
+        if owed:
+            self._owe(
+                kwargs["bucket_key"], owed, kwargs["capacity_tokens"], kwargs["rate_subtokens_per_sec"],
+                kwargs["scale"], kwargs["ttl_seconds"], kwargs.get("index_key", ""),
+            )
+        return res
+
+    async def reconcile(self, chunk: int = 256) -> int:
+        """
+        Withdraw the tokens charged locally from their Redis buckets and start
+        the next outage from fresh local buckets. Returns the buckets settled;
+        whatever could not be sent stays owed until the next recovery.
+        """
+        debts, self._debts = self._debts, {}
+        self._local = AsyncMemoryLimiter()
+        pending = [(key, d) for key, d in debts.items() if d.tokens > 0]
+        settled = 0
+        for start in range(0, len(pending), chunk):
+            part = pending[start:start + chunk]
+            results = await asyncio.gather(*(
+                self._inner.lease(
+                    bucket_key=key,
+                    capacity_tokens=d.capacity,
+                    rate_subtokens_per_sec=d.rate,
+                    scale=d.scale,
+                    ttl_seconds=d.ttl,
+                    want_tokens=d.tokens,
+                    min_tokens=1,
+                    index_key=d.index_key,
+                )
+                for key, d in part
+            ), return_exceptions=True)
+            failed = [(key, d) for (key, d), res in zip(part, results) if isinstance(res, BaseException)]
+            settled += len(part) - len(failed)
+            if failed:
+                for key, d in failed + pending[start + chunk:]:
+                    self._owe(key, d.tokens, d.capacity, d.rate, d.scale, d.ttl, d.index_key)
+                break
+        return settled
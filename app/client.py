@@ -0,0 +1,272 @@
+"""
+Embedded client: the /allow decision in-process, for Python services that
+would otherwise call the HTTP service on every request.
+
+It reads the same settings (env vars) and policy file as the service, builds
+the same bucket/idempotency/index keys, runs the same preloaded scripts over
+one connection pool and counts denies in the same offender ZSETs, so its
+decisions match the service's /allow and both can share a Redis:
+
+    limiter = RateLimitClient()          # REDIS_URL, REDIS_MODE, POLICY_PATH, ...
+    await limiter.load()
+    d = await limiter.allow("alice", "search")
+    if not d.allowed:
+        raise TooManyRequests(retry_after=d.retry_after)
+
+SyncRateLimitClient is the blocking variant. Service-side extras are not
+reproduced: token leases, the deny cache, and the /admin/resources and
+/admin/top_consumers statistics only reflect HTTP traffic.
+"""
+from __future__ import annotations
+import asyncio
+import json
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import redis.asyncio as redis
+
+from app.keys import composite_owner, idem_key_for, legacy_idem_key_for, offender_keys, parse_idem_record
+from app.lua_limiter_async import bundled_limiter
+from app.policy import PolicyLoader, ResourcePolicy, fold_decisions
+from app.settings import settings
+from app.sharding import cluster_limiter, ring_limiter
+
+class Decision:
+    """One /allow outcome; as_dict() is the service's JSON response body."""
+
+    __slots__ = ("allowed", "retry_after", "tokens_left", "limit", "composite", "idempotent_replay", "deny_cache")
+
+    def __init__(
+        self,
+        allowed: bool,
+        retry_after: float,
+        tokens_left: float,
+        limit: Optional[str] = None,
+        composite: bool = False,
+        idempotent_replay: bool = False,
+        deny_cache: bool = False,
+    ):
+        self.allowed = allowed
+        self.retry_after = 0.0 if allowed else retry_after
+        self.tokens_left = tokens_left
+        self.limit = limit
+        self.composite = composite
+        self.idempotent_replay = idempotent_replay
+        self.deny_cache = deny_cache  # answered by the service's local deny cache
+
+    def as_dict(self) -> dict:
+        body = {"allowed": self.allowed, "retry_after": self.retry_after, "tokens_left": self.tokens_left}
+        if self.composite:
+            body["limit"] = self.limit
+        return body
+
+    def __repr__(self) -> str:
+        return f"Decision({self.as_dict()!r})"
+
+
+class RateLimitClient:
+    """
+    Decides against Redis directly. One instance per process: it owns the
+    connection pool (and the ring's pools in REDIS_MODE=ring), and re-reads
+    the policy file every POLICY_RELOAD_SECONDS, switching versions at the
+    same instant as the service replicas.
+    """
+
+    def __init__(
+        self,
+        redis_url: Optional[str] = None,
+        *,
+        policy_path: Optional[str] = None,
+        max_connections: Optional[int] = None,
+    ):
+        url = redis_url or settings.REDIS_URL
+        self._nodes: List[redis.Redis] = []
+        if settings.REDIS_MODE == "cluster":
+            self.r = redis.RedisCluster.from_url(url, decode_responses=False)
+            self.limiter = cluster_limiter(self.r, bundled_limiter)
+        else:
+            self.r = redis.from_url(url, decode_responses=False, max_connections=max_connections)
+            if settings.REDIS_MODE == "ring":
+                self.limiter, self._nodes = ring_limiter(settings.REDIS_URLS, bundled_limiter)
+            else:
+                self.limiter = bundled_limiter(self.r)
+        self.sharded = settings.REDIS_MODE != "single"
+        self.policy = PolicyLoader(
+            policy_path or settings.POLICY_PATH,
+            scale=settings.SCALE,
+            default_capacity=settings.DEFAULT_CAPACITY,
+            default_rate=settings.DEFAULT_RATE_TOKENS_PER_SEC,
+        )
+        # Same rule as the service: the index must share the buckets' node/slot
+        self._index = bool(settings.USER_INDEX_KEY_FMT) and (
+            not self.sharded
+            or ("{{{user}}}" in settings.BUCKET_KEY_FMT and "{{{user}}}" in settings.USER_INDEX_KEY_FMT)
+        )
+        self._published: Dict[str, Tuple[int, int]] = {}
+        self._next_poll = time.monotonic() + settings.POLICY_RELOAD_SECONDS
+
+    async def load(self) -> None:
+        """Preload the scripts so the first decisions hit EVALSHA."""
+        await self.limiter.load()
+
+    async def close(self) -> None:
+        for node in self._nodes:
+            await node.aclose()
+        await self.r.aclose()
+
+    async def __aenter__(self) -> "RateLimitClient":
+        await self.load()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    def _index_key(self, owner: str) -> str:
+        return settings.USER_INDEX_KEY_FMT.format(user=owner) if self._index else ""
+
+    async def _reload_policy(self) -> None:
+        now = time.monotonic()
+        if now < self._next_poll:
+            return
+        self._next_poll = now + settings.POLICY_RELOAD_SECONDS
+        try:
+            await self.policy.activate_when_due(
+                self.r,
+                delay=settings.POLICY_SWITCH_DELAY_SECONDS,
+                key_prefix=settings.POLICY_ACTIVATE_KEY_PREFIX,
+            )
+        except Exception:
+            pass  # a bad file keeps the active policy, as in the service
+
+    async def _publish(self, resource: str, pol: ResourcePolicy) -> None:
+        # /admin/user reads capacity/rate from RESOURCES_KEY; written once per change
+        cfg = (pol.capacity, pol.rate_subtokens_per_sec)
+        if self._published.get(resource) == cfg:
+            return
+        await self.r.hset(settings.RESOURCES_KEY, resource, json.dumps(
+            {"capacity": cfg[0], "rate_subtokens_per_sec": cfg[1], "scale": settings.SCALE}
+        ))
+        self._published[resource] = cfg
+
+    async def _count_offense(self, user_id: str) -> None:
+        pipe = self.r.pipeline(transaction=False)
+        for zkey, ttl in offender_keys():
+            pipe.zincrby(zkey, 1, user_id)
+            if ttl > 0:
+                pipe.expire(zkey, ttl)
+        await pipe.execute()
+
+    async def allow(
+        self,
+        user_id: str,
+        resource: str = "default",
+        cost: int = 1,
+        idempotency: Optional[str] = None,
+        tenant: Optional[str] = None,
+    ) -> Decision:
+        """
+        Spend `cost` tokens; same arguments and outcome as POST /allow.
+        Raises ValueError where the service answers 400.
+        """
+        await self._reload_policy()
+        pol = self.policy.active.lookup(resource)
+        bucket_ttl = max(settings.TTL_SECONDS, pol.full_refill_seconds)
+        bucket_key = settings.BUCKET_KEY_FMT.format(user=user_id, resource=resource)
+        idem_key = idem_key_for(bucket_key, idempotency)
+
+        if pol.limits:
+            if idem_key:
+                raise ValueError("idempotency is not supported for composite resources")
+            names, items = [], []
+            for lim in pol.limits:
+                owner = composite_owner(lim.scope, user_id, tenant)
+                if owner is None:
+                    continue
+                await self._publish(f"{resource}:{lim.name}", lim)
+                key = settings.BUCKET_KEY_FMT.format(user=owner, resource=resource)
+                names.append(lim.name)
+                items.append((
+                    f"{key}:{lim.name}", lim.capacity, lim.rate_subtokens_per_sec, cost, user_id, self._index_key(owner),
+                ))
+            decisions = await self.limiter.allow_many(
+                items, scale=settings.SCALE, ttl_seconds=bucket_ttl, all_or_nothing=True,
+            )
+            allowed, retry_after, remaining, bound_by = fold_decisions(names, decisions)
+            if not allowed:
+                await self._count_offense(user_id)  # once per request, however many limits denied
+            return Decision(allowed, retry_after, remaining, bound_by, composite=True)
+
+        await self._publish(resource, pol)
+        if idem_key and settings.IDEM_LEGACY_READ and not self.sharded:
+            value = await self.r.get(legacy_idem_key_for(user_id, resource, idempotency))
+            if value is not None:
+                allowed, retry_after, remaining = parse_idem_record(value, settings.SCALE)
+                if not allowed:
+                    await self._count_offense(user_id)
+                return Decision(allowed, retry_after, remaining, idempotent_replay=True)
+        allowed, retry_after, remaining, used_idem = await self.limiter.allow(
+            bucket_key=bucket_key,
+            capacity_tokens=pol.capacity,
+            rate_subtokens_per_sec=pol.rate_subtokens_per_sec,
+            cost_tokens=cost,
+            scale=settings.SCALE,
+            ttl_seconds=bucket_ttl,
+            idem_key=idem_key,
+            idempotency_ttl_seconds=settings.IDEM_TTL_SECONDS,
+            offender_member=user_id,
+            offender_keys=() if self.sharded else offender_keys(),
+            config_argv=pol.config_argv,
+            algorithm=pol.algorithm,
+            window_ms=pol.window_ms,
+            index_key=self._index_key(user_id),
+        )
+        if not allowed and self.sharded:
+            await self._count_offense(user_id)
+        return Decision(allowed, retry_after, remaining, idempotent_replay=used_idem)
+
+
+class SyncRateLimitClient:
+    """
+    Blocking RateLimitClient for threaded/sync services. A private event loop
+    on a daemon thread owns the client and its pool; allow() may be called
+    from any thread.
+    """
+
+    def __init__(self, *args, timeout: Optional[float] = 5.0, **kwargs):
+        self._timeout = timeout
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="ratelimit-client", daemon=True)
+        self._thread.start()
+        self._client = RateLimitClient(*args, **kwargs)
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(self._timeout)
+
+    def load(self) -> None:
+        self._call(self._client.load())
+
+    def allow(
+        self,
+        user_id: str,
+        resource: str = "default",
+        cost: int = 1,
+        idempotency: Optional[str] = None,
+        tenant: Optional[str] = None,
+    ) -> Decision:
+        return self._call(self._client.allow(user_id, resource, cost, idempotency, tenant))
+
+    def close(self) -> None:
+        try:
+            self._call(self._client.close())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+
+    def __enter__(self) -> "SyncRateLimitClient":
+        self.load()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,132 @@
+from __future__ import annotations
+import asyncio
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from app.obs_middleware import note_shared_calls, track_timings
+
+Decision = Tuple[bool, float, float, bool]
+
+class _Pending:
+    __slots__ = ("calls", "futures", "inflight", "scheduled")
+
+    def __init__(self):
+        self.calls: List[dict] = []
+        self.futures: List[asyncio.Future] = []
+        self.inflight = False
+        self.scheduled = False
+
+
+class BucketCoalescer:
+    """
+    Single-flight micro-batching of allow() per bucket key.
+
+    A hot bucket hit by many concurrent requests would otherwise cost one
+    script call each, all serialized on the same Redis key. Here at most one
+    call per bucket is in flight: requests arriving in the same event-loop
+    tick (or within `window_ms`), or while the previous call is outstanding,
+    are sent together as one allow_many() (limiter_batch.lua). That script
+    charges repeated keys in arrival order, each against the balance the
+    earlier ones left, and counts every denied item as an offense, so each
+    request gets the decision it would have got alone, in the same order.
+    A lone request still goes through allow() unchanged.
+
+    Only plain token-bucket calls are merged; idempotent calls and the GCRA
+    and sliding-window engines pass straight through.
+
+    The batch runs in its own task with its own RequestTimings, and every
+    request it served is charged the whole shared call (redis_calls,
+    Server-Timing, the access log's redis_ms) rather than just the request
+    that happened to start it.
+    """
+
+    def __init__(
+        self,
+        limiter,
+        *,
+        window_ms: float = 0.0,
+        max_batch: int = 64,
+        on_batch: Optional[Callable[[int], None]] = None,
+    ):
+        self._limiter = limiter
+        self._window = window_ms / 1000.0
+        self._max_batch = max_batch
+        self._on_batch = on_batch
+        self._pending: Dict[str, _Pending] = {}
+        self._tasks: Set[asyncio.Task] = set()  # the loop only keeps weak references
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def allow(self, **kwargs) -> Decision:
+        if kwargs.get("idem_key") or kwargs.get("algorithm", "token_bucket") != "token_bucket":
+            return await self._limiter.allow(**kwargs)
+        key = kwargs["bucket_key"]
+        p = self._pending.get(key)
+        if p is None:
+            p = self._pending[key] = _Pending()
+        fut = asyncio.get_running_loop().create_future()
+        p.calls.append(kwargs)
+        p.futures.append(fut)
+        if not p.inflight:
+            if len(p.calls) >= self._max_batch:
+                self._start(key)
+            elif not p.scheduled:
+                p.scheduled = True
+                loop = asyncio.get_running_loop()
+                if self._window > 0:
+                    loop.call_later(self._window, self._start, key)
+                else:
+                    loop.call_soon(self._start, key)
+        timings, res = await fut
+        note_shared_calls(timings)
+        if isinstance(res, BaseException):
+            raise res
+        return res
+
+    def _start(self, key: str) -> None:
+        p = self._pending.get(key)
+        if p is None or p.inflight:
+            return
+        p.scheduled = False
+        if not p.calls:
+            del self._pending[key]
+            return
+        calls, futures = p.calls[:self._max_batch], p.futures[:self._max_batch]
+        del p.calls[:self._max_batch], p.futures[:self._max_batch]
+        p.inflight = True
+        task = asyncio.get_running_loop().create_task(self._run(key, p, calls, futures))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key: str, p: _Pending, calls: List[dict], futures: List[asyncio.Future]) -> None:
+        timings = track_timings()  # the task's copy of the context, not the starting request's
+        try:
+            if self._on_batch is not None:
+                self._on_batch(len(calls))
+            if len(calls) == 1:
+                results = [await self._limiter.allow(**calls[0])]
+            else:
+                first = calls[0]
+                results = await self._limiter.allow_many(
+                    [
+                        (key, c["capacity_tokens"], c["rate_subtokens_per_sec"], c["cost_tokens"],
+                         c.get("offender_member", ""), c.get("index_key", ""))
+                        for c in calls
+                    ],
+                    scale=first["scale"],
+                    ttl_seconds=max(c["ttl_seconds"] for c in calls),
+                    offender_keys=first.get("offender_keys", ()),
+                )
+            for fut, res in zip(futures, results):
+                if not fut.done():
+                    fut.set_result((timings, res))
+        except BaseException as e:
+            for fut in futures:
+                if not fut.done():
+                    fut.set_result((timings, e))
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            p.inflight = False
+            # Whatever queued up meanwhile goes out as the next batch
+            self._start(key)
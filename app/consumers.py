@@ -0,0 +1,133 @@
+from __future__ import annotations
+import heapq
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, List, Optional, Tuple
+
+import redis.asyncio as redis
+
+from app.heavy_hitters import SpaceSaving
+from app.keys import bucket_ttl_seconds, floor_time
+
+
+class TopConsumers:
+    """
+    Tokens charged per (user, resource), kept in a Space-Saving sketch
+    instead of a Redis write per allow. Each flush hands the sketch's counts
+    to Redis with one pipeline and starts a fresh one:
+
+      <prefix>:tokens:{minute|hour}:<tag>  ZSET member -> tokens (over-estimates)
+      <prefix>:err:{minute|hour}:<tag>     ZSET member -> max over-estimate
+      <prefix>:floor:{minute|hour}:<tag>   sum of every flush's min_count, the most
+                                           a member can be missing from its ZSET
+
+    Members are JSON [user_id, resource]. With `replica_reads` queries run on
+    `reader` and the unions are computed here, since a replica can't store them.
+    """
+
+    def __init__(
+        self,
+        writer: redis.Redis,
+        reader: redis.Redis,
+        *,
+        prefix: str,
+        sketch_size: int,
+        replica_reads: bool = False,
+        on_flush: Optional[Callable[[float], None]] = None,
+        now: Callable[[], datetime] = lambda: datetime.now(timezone.utc),
+    ):
+        self._r = writer
+        self._rr = reader
+        self.prefix = prefix
+        self._size = max(1, sketch_size)
+        self._replica_reads = replica_reads
+        self._on_flush = on_flush  # seconds spent in the flush pipeline
+        self._now = now
+        self._sketch = SpaceSaving(self._size)
+
+    def __len__(self) -> int:
+        return len(self._sketch)
+
+    def note(self, user_id: str, resource: str, cost: int) -> None:
+        if cost > 0:
+            self._sketch.add((user_id, resource), cost)
+
+    def key(self, kind: str, dt: datetime, bucket: str) -> str:
+        tag = dt.strftime("%Y%m%d%H%M" if bucket == "minute" else "%Y%m%d%H")
+        return f"{self.prefix}:{kind}:{bucket}:{tag}"
+
+    async def flush(self) -> None:
+        if not len(self._sketch):
+            return
+        sketch, self._sketch = self._sketch, SpaceSaving(self._size)
+        members = [(json.dumps(key), count, error) for key, count, error in sketch.items()]
+        floor = sketch.min_count()
+        now = self._now()
+        pipe = self._r.pipeline(transaction=False)
+        for bucket in ("minute", "hour"):
+            ttl = bucket_ttl_seconds(bucket)
+            counts_key = self.key("tokens", now, bucket)
+            err_key = self.key("err", now, bucket)
+            for member, count, error in members:
+                pipe.zincrby(counts_key, count, member)
+                if error:
+                    pipe.zincrby(err_key, error, member)
+            pipe.expire(counts_key, ttl)
+            pipe.expire(err_key, ttl)
+            if floor:
+                floor_key = self.key("floor", now, bucket)
+                pipe.incrby(floor_key, floor)
+                pipe.expire(floor_key, ttl)
+        t0 = time.perf_counter()
+        await pipe.execute()
+        if self._on_flush is not None:
+            self._on_flush(time.perf_counter() - t0)
+
+    async def top(self, window: str, seconds: int, top_n: int) -> Tuple[List[dict], int]:
+        """
+        (heaviest pairs over the last `seconds`, max_untracked): minute
+        resolution up to an hour, whole hours beyond. `window` names the
+        temporary union keys.
+        """
+        bucket = "minute" if seconds <= 3600 else "hour"
+        step = timedelta(minutes=1) if bucket == "minute" else timedelta(hours=1)
+        now = self._now()
+        start = floor_time(now - timedelta(seconds=seconds), bucket)
+        slices = []
+        cursor = floor_time(now, bucket)
+        while cursor >= start:
+            slices.append(cursor)
+            cursor -= step
+
+        token_keys = [self.key("tokens", dt, bucket) for dt in slices]
+        err_keys = [self.key("err", dt, bucket) for dt in slices]
+        if self._replica_reads:
+            pipe = self._rr.pipeline(transaction=False)
+            pipe.zunion(token_keys, withscores=True)
+            pipe.zunion(err_keys, withscores=True)
+            for dt in slices:
+                pipe.get(self.key("floor", dt, bucket))
+            tokens_all, errors_all, *floors = await pipe.execute()
+            top = heapq.nlargest(top_n, tokens_all, key=lambda ms: ms[1])
+            error_of = {m: e for m, e in errors_all}
+            errors = [error_of.get(m) for m, _ in top]
+        else:
+            temp_key = f"{self.prefix}:tmp:{window}"
+            pipe = self._r.pipeline(transaction=True)
+            pipe.zunionstore(temp_key, keys=token_keys)
+            pipe.zunionstore(f"{temp_key}:err", keys=err_keys)
+            pipe.expire(temp_key, 30)
+            pipe.expire(f"{temp_key}:err", 30)
+            pipe.zrevrange(temp_key, 0, top_n-1, withscores=True)
+            for dt in slices:
+                pipe.get(self.key("floor", dt, bucket))
+            res = await pipe.execute()
+            top, floors = res[4], res[5:]
+            errors = await self._r.zmscore(f"{temp_key}:err", [m for m, _ in top]) if top else []
+
+        out = []
+        for (member, tokens), error in zip(top, errors):
+            user_id, resource = json.loads(member)
+            out.append({"user_id": user_id, "resource": resource, "tokens": int(tokens), "error": int(error or 0)})
+        return out, sum(int(f) for f in floors if f)
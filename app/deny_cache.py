@@ -0,0 +1,60 @@
+from __future__ import annotations
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+class DenyCache:
+    """
+    Bounded, TTL-evicting cache of recent denies keyed by (bucket_key, cost).
+
+    A token bucket only gains tokens by refilling over time, so a deny with
+    retry_after=T stays a deny for the same cost until T has elapsed. Entries
+    expire `margin_ms` before that instant (and never live longer than
+    `max_ttl_ms`), after which the next request goes back to Redis.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        margin_ms: int,
+        max_ttl_ms: int,
+        *,
+        now: Callable[[], float] = time.monotonic,
+    ):
+        if max_entries <= 0:
+            raise ValueError("max_entries must be > 0")
+        self._max_entries = max_entries
+        self._margin = margin_ms / 1000.0
+        self._max_ttl = max_ttl_ms / 1000.0
+        self._now = now
+        # key -> (expires_at, retry_deadline, remaining_tokens); insertion order = eviction order
+        self._entries: OrderedDict[Tuple[str, int], Tuple[float, float, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, bucket_key: str, cost: int) -> Optional[Tuple[float, float]]:
+        """Returns (retry_after_seconds, remaining_tokens) for a live deny, else None."""
+        key = (bucket_key, cost)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        now = self._now()
+        if now >= entry[0]:
+            del self._entries[key]
+            return None
+        return max(0.0, entry[1] - now), entry[2]
+
+    def put(self, bucket_key: str, cost: int, retry_after: float, remaining: float) -> None:
+        ttl = min(retry_after, self._max_ttl) - self._margin
+        if ttl <= 0:
+            return
+        now = self._now()
+        key = (bucket_key, cost)
+        self._entries.pop(key, None)
+        self._entries[key] = (now + ttl, now + retry_after, remaining)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
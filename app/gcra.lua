@@ -0,0 +1,138 @@
+-- GCRA (generic cell rate algorithm): the same burst/rate limit as limiter.lua,
+-- but a bucket is a single integer, its theoretical arrival time (TAT) in
+-- microseconds. Each admitted subtoken pushes TAT forward by 1/rate; a request
+-- fits while TAT stays within one full bucket (capacity/rate) of now. The key
+-- expires exactly when TAT is reached, i.e. when the bucket would be full.
+--
+-- KEYS, ARGV and the return value are identical to limiter.lua, so both are
+-- driven by AsyncLuaLimiter.allow(); ARGV[5] ttl_seconds is not needed.
+-- rate_subtokens_per_sec must be > 0 (policy.py rejects gcra with rate 0).
+--
+-- State written by limiter.lua ("tokens:last_refill_ms" or the legacy hash)
+-- is converted on read, so a resource can switch algorithms without reset.
+
+local bucket_key = KEYS[1]
+local idem_key   = KEYS[2] ~= bucket_key and KEYS[2] or nil
+
+local capacity_tokens        = tonumber(ARGV[1])
+local rate_subtokens_per_sec = tonumber(ARGV[2])
+local cost_tokens            = tonumber(ARGV[3])
+local SCALE                  = tonumber(ARGV[4])
+local idem_ttl_seconds       = tonumber(ARGV[6])
+local offender_member        = ARGV[7]
+
+-- Count a deny against every offender ZSET in the same execution
+local function record_offense()
+    for i = 4, #KEYS do
+        redis.call('ZINCRBY', KEYS[i], 1, offender_member)
+        local ttl = tonumber(ARGV[i + 4])
+        if ttl and ttl > 0 then
+            redis.call('EXPIRE', KEYS[i], ttl)
+        end
+    end
+end
+
+-- If idempotency key exists, return cached result immediately
+if idem_key then
+    local cached = redis.call('GET', idem_key)
+    if cached then
+        -- cached is "allowed,retry_after_ms,remaining_subtokens"
+        local parts = {}
+        for s in string.gmatch(cached, '([^,]+)') do table.insert(parts, s) end
+        local allowed = tonumber(parts[1])
+        if allowed == 0 then
+            record_offense()
+        end
+        return { allowed, tostring(tonumber(parts[2]) / 1000.0), tostring(tonumber(parts[3]) / SCALE), 1 }
+    end
+end
+
+if rate_subtokens_per_sec <= 0 then
+    return redis.error_reply('gcra needs rate_subtokens_per_sec > 0')
+end
+
+local now_time = redis.call('TIME')
+local now_us = tonumber(now_time[1]) * 1000000 + tonumber(now_time[2])
+local now_ms = math.floor(now_us / 1000)
+
+-- Keep the bucket in its owner's index ZSET (KEYS[3]), as limiter.lua does
+local function index_bucket(expires_ms)
+    local index_key = KEYS[3]
+    if not index_key or index_key == bucket_key then
+        return
+    end
+    if redis.call('ZADD', index_key, expires_ms, bucket_key) == 1 then
+        redis.call('ZREMRANGEBYSCORE', index_key, '-inf', now_ms)
+    end
+    if redis.call('PTTL', index_key) < expires_ms - now_ms then
+        redis.call('PEXPIREAT', index_key, expires_ms)
+    end
+end
+
+local capacity_subtokens = capacity_tokens * SCALE
+local need_subtokens = cost_tokens * SCALE
+local us_per_subtoken = 1000000 / rate_subtokens_per_sec
+local tolerance_us = capacity_subtokens * us_per_subtoken -- one full bucket
+
+-- Load TAT, converting token-bucket state: a bucket short of N subtokens
+-- is full again N/rate from now
+local tat = nil
+local tokens, last_ms
+local raw = redis.pcall('GET', bucket_key)
+if type(raw) == 'table' and raw.err then
+    local hvals = redis.call('HMGET', bucket_key, 'tokens', 'last_refill_ms')
+    tokens, last_ms = tonumber(hvals[1]), tonumber(hvals[2])
+elseif raw then
+    local sep = string.find(raw, ':', 1, true)
+    if sep then
+        tokens = tonumber(string.sub(raw, 1, sep - 1))
+        last_ms = tonumber(string.sub(raw, sep + 1))
+    else
+        tat = tonumber(raw)
+    end
+end
+if tat == nil and tokens ~= nil and last_ms ~= nil then
+    if now_ms > last_ms then
+        tokens = tokens + math.floor((rate_subtokens_per_sec * (now_ms - last_ms)) / 1000)
+    end
+    if tokens > capacity_subtokens then
+        tokens = capacity_subtokens
+    end
+    tat = now_us + (capacity_subtokens - tokens) * us_per_subtoken
+end
+if tat == nil or tat < now_us then
+    tat = now_us
+end
+
+local allowed = 0
+local retry_after_ms = 0
+local remaining_subtokens
+
+local new_tat = tat + need_subtokens * us_per_subtoken
+local allow_at_us = new_tat - tolerance_us
+if now_us >= allow_at_us then
+    allowed = 1
+    remaining_subtokens = math.floor((tolerance_us - (new_tat - now_us)) / us_per_subtoken)
+    -- Free calls and denies leave TAT as it was: nothing to write
+    if need_subtokens > 0 then
+        new_tat = math.ceil(new_tat)
+        local px = math.ceil((new_tat - now_us) / 1000)
+        redis.call('SET', bucket_key, string.format('%d', new_tat), 'PX', px)
+        index_bucket(now_ms + px)
+    end
+else
+    retry_after_ms = math.ceil((allow_at_us - now_us) / 1000)
+    remaining_subtokens = math.floor((tolerance_us - (tat - now_us)) / us_per_subtoken)
+    record_offense()
+end
+if remaining_subtokens < 0 then
+    remaining_subtokens = 0
+end
+
+-- Cache idempotent result if requested
+if idem_key then
+    local value = tostring(allowed) .. ',' .. tostring(retry_after_ms) .. ',' .. tostring(remaining_subtokens)
+    redis.call('SET', idem_key, value, 'EX', idem_ttl_seconds)
+end
+
+return { allowed, tostring(retry_after_ms / 1000.0), tostring(remaining_subtokens / SCALE), 0 }
@@ -0,0 +1,67 @@
+from __future__ import annotations
+import heapq
+from typing import Dict, Hashable, List, Tuple
+
+class SpaceSaving:
+    """
+    Space-Saving summary (Metwally et al.) of a weighted stream: tracks at
+    most `capacity` keys, and any key whose true total exceeds
+    total_weight / capacity is guaranteed to be among them.
+
+    A key not yet tracked replaces the one with the smallest count and
+    inherits that count as its error, so for every tracked key
+    count - error <= true total <= count. An untracked key's total is at
+    most min_count(). Memory is O(capacity) whatever the key cardinality.
+    """
+
+    __slots__ = ("capacity", "_counts", "_errors", "_heap")
+
+    def __init__(self, capacity: int):
+        if capacity <= 0:
+            raise ValueError("capacity must be > 0")
+        self.capacity = capacity
+        self._counts: Dict[Hashable, int] = {}
+        self._errors: Dict[Hashable, int] = {}
+        # One (count, key) entry per tracked key; the count may lag behind
+        # _counts (increments don't touch the heap) and is refreshed lazily
+        self._heap: List[Tuple[int, Hashable]] = []
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def _min_entry(self) -> Tuple[int, Hashable]:
+        while True:
+            stale, key = self._heap[0]
+            count = self._counts[key]
+            if count == stale:
+                return count, key
+            heapq.heapreplace(self._heap, (count, key))
+
+    def add(self, key: Hashable, weight: int = 1) -> None:
+        count = self._counts.get(key)
+        if count is not None:
+            self._counts[key] = count + weight
+            return
+        if len(self._counts) < self.capacity:
+            self._counts[key] = weight
+            heapq.heappush(self._heap, (weight, key))
+            return
+        floor, victim = self._min_entry()
+        del self._counts[victim]
+        self._errors.pop(victim, None)
+        self._counts[key] = floor + weight
+        self._errors[key] = floor
+        heapq.heapreplace(self._heap, (floor + weight, key))
+
+    def min_count(self) -> int:
+        """Upper bound on the total of any key not tracked (0 while not full)."""
+        if len(self._counts) < self.capacity:
+            return 0
+        return self._min_entry()[0]
+
+    def items(self) -> List[Tuple[Hashable, int, int]]:
+        """(key, count, error) for every tracked key, heaviest first."""
+        return sorted(
+            ((k, c, self._errors.get(k, 0)) for k, c in self._counts.items()),
+            key=lambda kce: -kce[1],
+        )
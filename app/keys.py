@@ -0,0 +1,64 @@
+from __future__ import annotations
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+from app.settings import settings
+
+# Redis key layout shared by the HTTP service and the embedded client (app/client.py),
+# so both charge the same buckets and count denies in the same offender ZSETs.
+
+def idem_key_for(bucket_key: str, idempotency: Optional[str]) -> str:
+    # Derived from the bucket key so it inherits the bucket's hash tag (same slot/shard)
+    return f"idem:{bucket_key}:{idempotency}" if idempotency else ""
+
+def legacy_idem_key_for(user_id: str, resource: str, idempotency: Optional[str]) -> str:
+    # Layout before idempotency keys followed the bucket key; only read while
+    # records written by older replicas may still be live (IDEM_LEGACY_READ)
+    return f"idem:{user_id}:{resource}:{idempotency}" if idempotency else ""
+
+def parse_idem_record(value, scale: int) -> Tuple[bool, float, float]:
+    """(allowed, retry_after, remaining_tokens) from a cached "allowed,retry_after_ms,remaining_subtokens"."""
+    if isinstance(value, bytes):
+        value = value.decode("UTF-8")
+    allowed, retry_after_ms, remaining = value.split(",")[:3]
+    return int(allowed) == 1, float(retry_after_ms) / 1000.0, float(remaining) / scale
+
+def composite_owner(scope: str, user_id: str, tenant: Optional[str]) -> Optional[str]:
+    """Whose bucket a composite limit charges; None for a tenant limit without a tenant."""
+    if scope == "user":
+        return user_id
+    if scope == "tenant":
+        return f"@tenant:{tenant}" if tenant else None
+    return "@global"
+
+def floor_time(dt: datetime, bucket: str) -> datetime:
+    if bucket == "minute":   return dt.replace(second=0, microsecond=0, tzinfo=timezone.utc)
+    if bucket == "hour":     return dt.replace(minute=0, second=0, microsecond=0, tzinfo=timezone.utc)
+    if bucket == "day":      return dt.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone.utc)
+    return dt.replace(second=0, microsecond=0, tzinfo=timezone.utc)
+
+def bucket_key_for(dt: datetime, bucket: str) -> str:
+    dt = dt.astimezone(timezone.utc)
+    if bucket == "minute": tag = dt.strftime("%Y%m%d%H%M")
+    elif bucket == "hour": tag = dt.strftime("%Y%m%d%H")
+    elif bucket == "day":  tag = dt.strftime("%Y%m%d")
+    else:                  tag = dt.strftime("%Y%m%d%H%M")
+    return f"{settings.OFFENDERS_BUCKET_PREFIX}:{bucket}:{tag}"
+
+def bucket_ttl_seconds(bucket: str) -> int:
+    return {"minute": 60*90, "hour": 3600*48, "day": 86400*14}.get(bucket, 60*90)
+
+# Offender ZSETs only change names once a minute; rebuild the list lazily
+_offender_keys_cache: Tuple[int, List[Tuple[str, int]]] = (-1, [])
+
+def offender_keys() -> List[Tuple[str, int]]:
+    """(zset_key, ttl_seconds) pairs charged by the Lua scripts on every deny."""
+    global _offender_keys_cache
+    minute = int(time.time() // 60)
+    if _offender_keys_cache[0] != minute:
+        now = datetime.now(timezone.utc)
+        # hour and day ZSETs are filled by the rollup task, not per deny
+        keys = [(settings.OFFENDERS_ZSET, 0), (bucket_key_for(floor_time(now, "minute"), "minute"), bucket_ttl_seconds("minute"))]
+        _offender_keys_cache = (minute, keys)
+    return _offender_keys_cache[1]
@@ -0,0 +1,130 @@
+-- Token leasing: a replica withdraws a chunk of whole tokens from a bucket
+-- and serves decisions locally until the chunk runs out.
+--
+-- KEYS:
+--   KEYS[1] = bucket key, e.g., "rl:{user}:{resource}"
+--   KEYS[2] = optional owner index ZSET (see limiter.lua)
+--
+-- ARGV:
+--   [1] capacity_tokens              (int)
+--   [2] rate_subtokens_per_sec       (int)   -- refill_rate_per_sec * SCALE
+--   [3] scale                        (int)   -- e.g., 10000
+--   [4] ttl_seconds                  (int)
+--   [5] return_tokens                (int)   -- unused tokens handed back first (capped at capacity)
+--   [6] want_tokens                  (int)   -- lease size requested; 0 = release only
+--   [7] min_tokens                   (int)   -- grant nothing unless at least this many are available
+--
+-- Returns (array):
+--   [1] granted_tokens (int)
+--   [2] retry_after_seconds until min_tokens are available (string; 0 if granted)
+--   [3] remaining_tokens in the bucket after the grant (string; fractional)
+
+local bucket_key = KEYS[1]
+
+local capacity_tokens        = tonumber(ARGV[1])
+local rate_subtokens_per_sec = tonumber(ARGV[2])
+local SCALE                  = tonumber(ARGV[3])
+local ttl_seconds            = tonumber(ARGV[4])
+local return_tokens          = tonumber(ARGV[5])
+local want_tokens            = tonumber(ARGV[6])
+local min_tokens             = tonumber(ARGV[7])
+
+local now_time = redis.call('TIME')
+local now_ms = (tonumber(now_time[1]) * 1000) + math.floor(tonumber(now_time[2]) / 1000)
+
+-- Keep the bucket in its owner's index ZSET, as limiter.lua does
+local function index_bucket(index_key, expires_ms)
+    if redis.call('ZADD', index_key, expires_ms, bucket_key) == 1 then
+        redis.call('ZREMRANGEBYSCORE', index_key, '-inf', now_ms)
+    end
+    if redis.call('PTTL', index_key) < expires_ms - now_ms then
+        redis.call('PEXPIREAT', index_key, expires_ms)
+    end
+end
+
+local capacity_subtokens = capacity_tokens * SCALE
+
+-- Same compact "tokens:last_refill_ms" string state (and conversions) as limiter.lua
+local raw = redis.pcall('GET', bucket_key)
+local tokens, last_ms
+local legacy = type(raw) == 'table' and raw.err ~= nil
+if legacy then
+    local hvals = redis.call('HMGET', bucket_key, 'tokens', 'last_refill_ms')
+    tokens = tonumber(hvals[1])
+    last_ms = tonumber(hvals[2])
+elseif raw then
+    local sep = string.find(raw, ':', 1, true)
+    if sep then
+        tokens = tonumber(string.sub(raw, 1, sep - 1))
+        last_ms = tonumber(string.sub(raw, sep + 1))
+    else
+        -- GCRA state (gcra.lua): short by however far its TAT (in us) is ahead of now
+        legacy = true
+        local ahead_ms = tonumber(raw) / 1000 - now_ms
+        tokens = capacity_subtokens
+        if ahead_ms > 0 then
+            tokens = math.max(0, capacity_subtokens - math.ceil(ahead_ms * rate_subtokens_per_sec / 1000))
+        end
+        last_ms = now_ms
+    end
+end
+
+if (tokens == nil) or (last_ms == nil) then
+    tokens = capacity_subtokens
+    last_ms = now_ms
+end
+
+-- Refill
+local elapsed_ms = now_ms - last_ms
+if elapsed_ms < 0 then
+    elapsed_ms = 0
+end
+if elapsed_ms > 0 and tokens < capacity_subtokens then
+    local added = math.floor((rate_subtokens_per_sec * elapsed_ms) / 1000)
+    if added > 0 then
+        tokens = tokens + added
+        last_ms = now_ms
+    end
+end
+
+-- Hand back unused tokens from an expired lease
+tokens = tokens + return_tokens * SCALE
+if tokens > capacity_subtokens then
+    tokens = capacity_subtokens
+end
+
+-- Grant as many whole tokens as are available, up to want_tokens
+local granted = math.floor(tokens / SCALE)
+if granted > want_tokens then
+    granted = want_tokens
+end
+
+local retry_after_ms = 0
+if want_tokens > 0 and granted < min_tokens then
+    granted = 0
+    local deficit = min_tokens * SCALE - tokens
+    if rate_subtokens_per_sec <= 0 then
+        retry_after_ms = 2^31 - 1 -- effectively infinite
+    else
+        retry_after_ms = math.floor((deficit * 1000 + rate_subtokens_per_sec - 1) / rate_subtokens_per_sec) -- ceil
+    end
+end
+if granted > 0 and tokens >= capacity_subtokens then
+    last_ms = now_ms -- a full bucket's clock is stale; refill starts when it is drawn down
+end
+tokens = tokens - granted * SCALE
+
+-- Persist state + TTL (same layout as limiter.lua) only when it changed
+if legacy or granted > 0 or return_tokens > 0 then
+    local value = string.format('%d:%d', tokens, last_ms)
+    if ttl_seconds and ttl_seconds > 0 then
+        redis.call('SET', bucket_key, value, 'EX', ttl_seconds)
+        if KEYS[2] then
+            index_bucket(KEYS[2], now_ms + ttl_seconds * 1000)
+        end
+    else
+        redis.call('SET', bucket_key, value)
+    end
+end
+
+return { granted, tostring(retry_after_ms / 1000.0), tostring(tokens / SCALE) }
\ No newline at end of file
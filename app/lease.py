@@ -0,0 +1,169 @@
+from __future__ import annotations
+import asyncio
+import math
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from app.lua_limiter_async import AsyncLuaLimiter
+
+class _Lease:
+    __slots__ = ("balance", "expires_at", "rate", "consumed", "acquired_at", "cfg", "ttl", "index_key", "lock")
+
+    def __init__(self, now: float):
+        self.balance = 0              # whole tokens held locally
+        self.expires_at = 0.0         # monotonic seconds; 0 = no live lease
+        self.rate = 0.0               # EWMA of local consumption, tokens/sec
+        self.consumed = 0             # tokens spent since the last acquire
+        self.acquired_at = now
+        self.cfg = (0, 0)             # (capacity_tokens, rate_subtokens_per_sec) for releases
+        self.ttl = 0                  # the policy's bucket TTL, so releases keep it too
+        self.index_key = ""           # owner's bucket index, kept current by releases too
+        self.lock: Optional[asyncio.Lock] = None
+
+
+class LeaseManager:
+    """
+    Serves decisions for high-rate buckets from locally leased tokens.
+
+    Each bucket holds at most one lease per replica: a chunk of whole tokens
+    withdrawn from Redis through lease.lua. Decisions spend the local balance
+    without a round trip; when it runs dry (or the lease TTL passes) the
+    leftover is handed back and a new chunk is withdrawn in the same call.
+    Chunk size tracks the observed local rate over one lease TTL, so tokens
+    held away from Redis stay bounded by roughly one TTL of traffic per replica.
+    """
+
+    def __init__(
+        self,
+        limiter: AsyncLuaLimiter,
+        *,
+        scale: int,
+        bucket_ttl_seconds: int,
+        lease_ttl_ms: int,
+        min_tokens: int,
+        max_tokens: int,
+        now: Callable[[], float] = time.monotonic,
+    ):
+        if min_tokens <= 0 or max_tokens < min_tokens:
+            raise ValueError("need 0 < min_tokens <= max_tokens")
+        self._limiter = limiter
+        self._scale = scale
+        self._bucket_ttl = bucket_ttl_seconds
+        self._lease_ttl = lease_ttl_ms / 1000.0
+        self._min_tokens = min_tokens
+        self._max_tokens = max_tokens
+        self._now = now
+        self._leases: Dict[str, _Lease] = {}
+        self.stats = {"local": 0, "acquire": 0, "release": 0}
+
+    def __len__(self) -> int:
+        return len(self._leases)
+
+    def _chunk(self, lease: _Lease, capacity_tokens: int, need: int) -> int:
+        want = math.ceil(lease.rate * self._lease_ttl)
+        want = max(self._min_tokens, min(want, self._max_tokens, capacity_tokens))
+        return max(want, need)
+
+    async def allow(
+        self,
+        *,
+        bucket_key: str,
+        capacity_tokens: int,
+        rate_subtokens_per_sec: int,
+        cost_tokens: int,
+        ttl_seconds: Optional[int] = None,
+        index_key: str = "",
+    ) -> Tuple[bool, float, float, bool]:
+        """
+        Spend from the local lease, withdrawing a new chunk when it runs out.
+        `ttl_seconds` is the policy's bucket TTL (default: bucket_ttl_seconds),
+        so a long-window bucket isn't rewritten with a shorter one.
+        """
+        now = self._now()
+        lease = self._leases.get(bucket_key)
+        if lease is None:
+            lease = self._leases[bucket_key] = _Lease(now)
+        lease.cfg = (capacity_tokens, rate_subtokens_per_sec)
+        lease.ttl = self._bucket_ttl if ttl_seconds is None else ttl_seconds
+        lease.index_key = index_key
+
+        # Fast path: no await between check and spend, so this is atomic on the loop
+        if lease.expires_at > now and lease.balance >= cost_tokens:
+            lease.balance -= cost_tokens
+            lease.consumed += cost_tokens
+            self.stats["local"] += 1
+            return True, 0.0, float(lease.balance), False
+
+        if lease.lock is None:
+            lease.lock = asyncio.Lock()
+        async with lease.lock:
+            now = self._now()
+            if lease.expires_at > now and lease.balance >= cost_tokens:
+                lease.balance -= cost_tokens
+                lease.consumed += cost_tokens
+                self.stats["local"] += 1
+                return True, 0.0, float(lease.balance), False
+
+            # Fold the last lease's consumption into the rate estimate
+            elapsed = max(now - lease.acquired_at, 1e-3)
+            sample = lease.consumed / elapsed
+            lease.rate = sample if lease.rate == 0.0 else 0.5 * lease.rate + 0.5 * sample
+
+            expired = lease.expires_at <= now
+            return_tokens = lease.balance if expired else 0
+            held = 0 if expired else lease.balance
+            need = max(cost_tokens - held, 0)
+
+            granted, retry_after, remaining = await self._limiter.lease(
+                bucket_key=bucket_key,
+                capacity_tokens=capacity_tokens,
+                rate_subtokens_per_sec=rate_subtokens_per_sec,
+                scale=self._scale,
+                ttl_seconds=lease.ttl,
+                return_tokens=return_tokens,
+                want_tokens=self._chunk(lease, capacity_tokens, need),
+                min_tokens=need,
+                index_key=index_key,
+            )
+            self.stats["acquire"] += 1
+            lease.balance = held + granted
+            lease.consumed = 0
+            lease.acquired_at = now
+            lease.expires_at = now + self._lease_ttl
+
+            if lease.balance < cost_tokens:
+                return False, retry_after, remaining + lease.balance, False
+            lease.balance -= cost_tokens
+            lease.consumed += cost_tokens
+            return True, 0.0, float(lease.balance), False
+
+    async def release_expired(self, *, release_all: bool = False) -> int:
+        """
+        Hand unused tokens of expired leases back to Redis. Leases idle for
+        ten TTLs (or all of them, on shutdown) are forgotten along with their
+        rate estimate. Returns the number of leases whose tokens were returned.
+        """
+        now = self._now()
+        released = 0
+        for bucket_key, lease in list(self._leases.items()):
+            if not release_all and lease.expires_at > now:
+                continue
+            if lease.lock is not None and lease.lock.locked():
+                continue
+            balance, lease.balance = lease.balance, 0
+            capacity_tokens, rate_subtokens_per_sec = lease.cfg
+            if release_all or now - lease.expires_at > 10 * self._lease_ttl:
+                del self._leases[bucket_key]
+            if balance > 0:
+                await self._limiter.lease(
+                    bucket_key=bucket_key,
+                    capacity_tokens=capacity_tokens,
+                    rate_subtokens_per_sec=rate_subtokens_per_sec,
+                    scale=self._scale,
+                    ttl_seconds=lease.ttl,
+                    return_tokens=balance,
+                    index_key=lease.index_key,
+                )
+                self.stats["release"] += 1
+                released += 1
+        return released
@@ -1,6 +1,10 @@
 -- KEYS:
---   KEYS[1] = bucket hash key, e.g., "rl:{user}:{resource}"
---   KEYS[2] = optional idempotency key, e.g., "idem:{user}:{resource}:{idempotency}"
+--   KEYS[1] = bucket key, e.g., "rl:{user}:{resource}"
+--   KEYS[2] = idempotency key, e.g., "idem:{user}:{resource}:{idempotency}"; KEYS[1] if unused
+--   KEYS[3] = owner's bucket index ZSET, e.g., "rlidx:{user}"; KEYS[1] if unused
+--   KEYS[4..] = optional offender ZSETs, ZINCRBY'd by 1 for ARGV[7] on deny
+--   (Unused slots repeat the bucket key rather than being empty, so every key
+--   stays in the bucket's Redis Cluster slot.)
 --
 -- ARGV:
 --   [1] capacity_tokens              (int)
@@ -8,7 +12,9 @@
 --   [3] cost_tokens                  (int)
 --   [4] scale                        (int)   -- e.g., 10000
 --   [5] ttl_seconds                  (int)
---   [6] idempotency_ttl_seconds      (int)   -- if KEYS[2] present
+--   [6] idempotency_ttl_seconds      (int)   -- if KEYS[2] is used
+--   [7] offender member              (str)   -- e.g., user_id; if KEYS[4..] present
+--   [8..] offender key ttl_seconds   (int)   -- one per KEYS[4..]; 0 = no EXPIRE
 --
 -- Returns (array):
 --   [1] allowed (1/0)
@@ -17,7 +23,7 @@
 --   [4] used_idempotency (1/0)
 
 local bucket_key = KEYS[1]
-local idem_key   = KEYS[2]
+local idem_key   = KEYS[2] ~= bucket_key and KEYS[2] or nil
 
 local capacity_tokens        = tonumber(ARGV[1])
 local rate_subtokens_per_sec = tonumber(ARGV[2])
@@ -25,9 +31,21 @@ local cost_tokens            = tonumber(ARGV[3])
 local SCALE                  = tonumber(ARGV[4])
 local ttl_seconds            = tonumber(ARGV[5])
 local idem_ttl_seconds       = tonumber(ARGV[6])
+local offender_member        = ARGV[7]
+
+-- Count a deny against every offender ZSET in the same execution
+local function record_offense()
+    for i = 4, #KEYS do
+        redis.call('ZINCRBY', KEYS[i], 1, offender_member)
+        local ttl = tonumber(ARGV[i + 4])
+        if ttl and ttl > 0 then
+            redis.call('EXPIRE', KEYS[i], ttl)
+        end
+    end
+end
 
 -- If idempotency key exists, return cached result immediately
-if idem_key and idem_key ~= '' then
+if idem_key then
     local cached = redis.call('GET', idem_key)
     if cached then
     -- cached is "allowed,retry_after_ms,remaining_subtokens"
@@ -37,6 +55,9 @@ if idem_key and idem_key ~= '' then
     local retry_after_ms = tonumber(parts[2])
     local remaining_subtokens = tonumber(parts[3])
     local remaining_tokens = remaining_subtokens / SCALE
+    if allowed == 0 then
+        record_offense()
+    end
     return { allowed, tostring(retry_after_ms / 1000.0), tostring(remaining_tokens), 1}
     end
 end
@@ -45,24 +66,75 @@ end
 local now_time = redis.call('TIME')
 local now_ms = (tonumber(now_time[1]) * 1000) + math.floor(tonumber(now_time[2]) / 1000)
 
--- Load current bucket state
-local hvals = redis.call('HMGET', bucket_key, 'tokens', 'last_refill_ms', 'capacity_tokens', 'rate_subtokens_per_sec', 'scale')
-local tokens = tonumber(hvals[1])
-local last_ms = tonumber(hvals[2])
-local stored_capacity = tonumber(hvals[3])
-local stored_rate = tonumber(hvals[4])
-local stored_scale = tonumber(hvals[5])
+-- Record a written bucket in its owner's index (KEYS[3]), a ZSET of bucket
+-- key -> expiry in ms, so /admin/user reads it instead of SCANning. Expired
+-- members are pruned whenever a new one joins, and the index expires with its
+-- longest-lived bucket. KEYS[3] == KEYS[1] means no index.
+local function index_bucket(expires_ms)
+    local index_key = KEYS[3]
+    if not index_key or index_key == bucket_key then
+        return
+    end
+    if redis.call('ZADD', index_key, expires_ms, bucket_key) == 1 then
+        redis.call('ZREMRANGEBYSCORE', index_key, '-inf', now_ms)
+    end
+    if redis.call('PTTL', index_key) < expires_ms - now_ms then
+        redis.call('PEXPIREAT', index_key, expires_ms)
+    end
+end
+
+-- Bucket state is one string "tokens:last_refill_ms" (an embstr), written
+-- together with its TTL by a single SET. Buckets written by older versions are
+-- 5-field hashes: GET fails on them with WRONGTYPE, so read the hash instead
+-- and rewrite it in the compact form; a bare integer is gcra.lua state and is
+-- converted likewise. Capacity and rate come from ARGV; they are published
+-- once per resource by the app, not stored per bucket.
+local function load_bucket(key, capacity_subtokens, rate_subtokens_per_sec)
+    local raw = redis.pcall('GET', key)
+    if type(raw) == 'table' and raw.err then
+        local hvals = redis.call('HMGET', key, 'tokens', 'last_refill_ms')
+        return tonumber(hvals[1]), tonumber(hvals[2]), true
+    end
+    if not raw then
+        return nil, nil, false
+    end
+    local sep = string.find(raw, ':', 1, true)
+    if not sep then
+        -- GCRA state (gcra.lua): short by however far its TAT (in us) is ahead of now
+        local ahead_ms = tonumber(raw) / 1000 - now_ms
+        local tokens = capacity_subtokens
+        if ahead_ms > 0 then
+            tokens = math.max(0, capacity_subtokens - math.ceil(ahead_ms * rate_subtokens_per_sec / 1000))
+        end
+        return tokens, now_ms, true
+    end
+    return tonumber(string.sub(raw, 1, sep - 1)), tonumber(string.sub(raw, sep + 1)), false
+end
+
+local function store_bucket(key, tokens, last_ms)
+    local value = string.format('%d:%d', tokens, last_ms)
+    if ttl_seconds and ttl_seconds > 0 then
+        redis.call('SET', key, value, 'EX', ttl_seconds)
+        index_bucket(now_ms + ttl_seconds * 1000)
+    else
+        redis.call('SET', key, value)
+    end
+end
 
 local capacity_subtokens = capacity_tokens * SCALE
 local need_subtokens = cost_tokens * SCALE
 
--- Initialize if missing
+-- Load current bucket state
+local tokens, last_ms, legacy = load_bucket(bucket_key, capacity_subtokens, rate_subtokens_per_sec)
+
+-- Initialize if missing (a missing bucket is a full one)
 if (tokens == nil) or (last_ms == nil) then
     tokens = capacity_subtokens
     last_ms = now_ms
 end
 
--- Refill
+-- Refill. The clock only advances when whole subtokens are credited, so
+-- frequent calls never round a partial refill away.
 local elapsed_ms = now_ms - last_ms
 if elapsed_ms < 0 then
     elapsed_ms = 0
@@ -76,16 +148,26 @@ if elapsed_ms > 0 and tokens < capacity_subtokens then
         if tokens > capacity_subtokens then
             tokens = capacity_subtokens
         end
+        last_ms = now_ms
     end
-    last_ms = now_ms
 end
 
 local allowed = 0
 local retry_after_ms = 0
+-- Only a charge changes the bucket: a deny (or a free call) leaves the stored
+-- state valid, since the refill above is recomputed from it on the next read.
+local dirty = legacy
 
 -- needed tokens < tokens available -> allowed
 if tokens >= need_subtokens then
-    tokens = tokens - need_subtokens
+    if need_subtokens > 0 then
+        -- A full bucket's clock is stale; refill starts when it is drawn down
+        if tokens >= capacity_subtokens then
+            last_ms = now_ms
+        end
+        tokens = tokens - need_subtokens
+        dirty = true
+    end
     allowed = 1
     retry_after_ms = 0
 -- calculate the retry after a refill 
@@ -96,23 +178,17 @@ else
     else
         retry_after_ms = math.floor((deficit * 1000 + rate_subtokens_per_sec - 1) / rate_subtokens_per_sec) -- ceil
     end
+    record_offense()
 end
 
--- Persist state + TTL
-redis.call('HMSET', bucket_key, 
-    'tokens', tostring(tokens), 
-    'last_refill_ms', tostring(last_ms),
-    'capacity_tokens', tostring(capacity_tokens),
-    'rate_subtokens_per_sec', tostring(rate_subtokens_per_sec),
-    'scale', tostring(SCALE)
-)
-if ttl_seconds and ttl_seconds > 0 then
-    redis.call('EXPIRE', bucket_key, ttl_seconds)
+-- Persist state + TTL only when it changed
+if dirty then
+    store_bucket(bucket_key, tokens, last_ms)
 end
 
 -- Cache idempotent result if requested
 local used_idem = 0
-if idem_key and idem_key ~= '' then
+if idem_key then
     local value = tostring(allowed) .. ',' .. tostring(retry_after_ms) .. ',' .. tostring(tokens)
     redis.call('SET', idem_key, value, 'EX', idem_ttl_seconds)
     used_idem = 0 -- we just wrote it; indicates this response is fresh
@@ -0,0 +1,184 @@
+-- Multi-bucket variant of limiter.lua: evaluates N token buckets in one call.
+--
+-- KEYS:
+--   KEYS[1..N]       = bucket keys, e.g., "rl:{user}:{resource}" (may repeat)
+--   KEYS[N+1..2N]    = each item's owner index ZSET (see limiter.lua); its bucket key if unused
+--   KEYS[2N+1..2N+M] = optional offender ZSETs, ZINCRBY'd for every denied item
+--
+-- ARGV:
+--   [1] n_items                      (int)
+--   [2] scale                        (int)   -- e.g., 10000
+--   [3] ttl_seconds                  (int)
+--   [4] all_or_nothing               (1/0)   -- 1 = charge every item or none
+--   [5] n_offender_keys              (int)   -- M
+--   then, for item i (1-based), at base = 5 + 4 * (i - 1):
+--   [base+1] capacity_tokens         (int)
+--   [base+2] rate_subtokens_per_sec  (int)
+--   [base+3] cost_tokens             (int)
+--   [base+4] offender member         (str)   -- e.g., user_id
+--   then M offender key ttl_seconds at 5 + 4 * N + j (0 = no EXPIRE)
+--
+-- Items are charged in order; repeated keys see the balance left by earlier
+-- items. With all_or_nothing=1 a single deny rolls the whole batch back:
+-- nothing is persisted and every item reports allowed=0. Otherwise only
+-- buckets that were charged (or still use the legacy hash layout) are written.
+--
+-- Returns (flat array, 3 entries per item):
+--   allowed (1/0), retry_after_seconds (string), remaining_tokens (string)
+
+local n_items          = tonumber(ARGV[1])
+local SCALE            = tonumber(ARGV[2])
+local ttl_seconds      = tonumber(ARGV[3])
+local all_or_nothing   = tonumber(ARGV[4]) == 1
+local n_offender_keys  = tonumber(ARGV[5])
+
+local now_time = redis.call('TIME')
+local now_ms = (tonumber(now_time[1]) * 1000) + math.floor(tonumber(now_time[2]) / 1000)
+
+-- Keep a bucket in its owner's index ZSET, as limiter.lua does
+local function index_bucket(index_key, bucket_key, expires_ms)
+    if index_key == bucket_key then
+        return
+    end
+    if redis.call('ZADD', index_key, expires_ms, bucket_key) == 1 then
+        redis.call('ZREMRANGEBYSCORE', index_key, '-inf', now_ms)
+    end
+    if redis.call('PTTL', index_key) < expires_ms - now_ms then
+        redis.call('PEXPIREAT', index_key, expires_ms)
+    end
+end
+
+-- Same compact "tokens:last_refill_ms" string state (and conversions) as limiter.lua
+local function load_bucket(key, capacity_subtokens, rate_subtokens_per_sec)
+    local raw = redis.pcall('GET', key)
+    if type(raw) == 'table' and raw.err then
+        local hvals = redis.call('HMGET', key, 'tokens', 'last_refill_ms')
+        return tonumber(hvals[1]), tonumber(hvals[2]), true
+    end
+    if not raw then
+        return nil, nil, false
+    end
+    local sep = string.find(raw, ':', 1, true)
+    if not sep then
+        -- GCRA state (gcra.lua): short by however far its TAT (in us) is ahead of now
+        local ahead_ms = tonumber(raw) / 1000 - now_ms
+        local tokens = capacity_subtokens
+        if ahead_ms > 0 then
+            tokens = math.max(0, capacity_subtokens - math.ceil(ahead_ms * rate_subtokens_per_sec / 1000))
+        end
+        return tokens, now_ms, true
+    end
+    return tonumber(string.sub(raw, 1, sep - 1)), tonumber(string.sub(raw, sep + 1)), false
+end
+
+-- Per-key working state, loaded and refilled once per distinct key
+local states = {}
+local order = {}
+
+local function load_state(bucket_key, capacity_subtokens, rate_subtokens_per_sec)
+    local tokens, last_ms, legacy = load_bucket(bucket_key, capacity_subtokens, rate_subtokens_per_sec)
+    if (tokens == nil) or (last_ms == nil) then
+        tokens = capacity_subtokens
+        last_ms = now_ms
+    end
+    local elapsed_ms = now_ms - last_ms
+    if elapsed_ms < 0 then
+        elapsed_ms = 0
+    end
+    if elapsed_ms > 0 and tokens < capacity_subtokens then
+        local added = math.floor((rate_subtokens_per_sec * elapsed_ms) / 1000)
+        if added > 0 then
+            tokens = tokens + added
+            if tokens > capacity_subtokens then
+                tokens = capacity_subtokens
+            end
+            last_ms = now_ms
+        end
+    end
+    return { tokens = tokens, refilled = tokens, last_ms = last_ms, dirty = legacy,
+             capacity_subtokens = capacity_subtokens }
+end
+
+local results = {}
+local any_denied = false
+
+for i = 1, n_items do
+    local base = 5 + 4 * (i - 1)
+    local capacity_tokens        = tonumber(ARGV[base + 1])
+    local rate_subtokens_per_sec = tonumber(ARGV[base + 2])
+    local cost_tokens            = tonumber(ARGV[base + 3])
+    local bucket_key             = KEYS[i]
+
+    local st = states[bucket_key]
+    if st == nil then
+        st = load_state(bucket_key, capacity_tokens * SCALE, rate_subtokens_per_sec)
+        st.index_key = KEYS[n_items + i]
+        states[bucket_key] = st
+        table.insert(order, bucket_key)
+    end
+
+    local need_subtokens = cost_tokens * SCALE
+    local allowed = 0
+    local retry_after_ms = 0
+    if st.tokens >= need_subtokens then
+        if need_subtokens > 0 then
+            if st.tokens >= st.capacity_subtokens then
+                st.last_ms = now_ms
+            end
+            st.tokens = st.tokens - need_subtokens
+            st.dirty = true
+        end
+        allowed = 1
+    else
+        any_denied = true
+        local deficit = need_subtokens - st.tokens
+        if rate_subtokens_per_sec <= 0 then
+            retry_after_ms = 2^31 - 1 -- effectively infinite
+        else
+            retry_after_ms = math.floor((deficit * 1000 + rate_subtokens_per_sec - 1) / rate_subtokens_per_sec) -- ceil
+        end
+        -- Only items that were short count as offenses, even on rollback
+        local member = ARGV[base + 4]
+        for j = 1, n_offender_keys do
+            local zkey = KEYS[2 * n_items + j]
+            redis.call('ZINCRBY', zkey, 1, member)
+            local ttl = tonumber(ARGV[5 + 4 * n_items + j])
+            if ttl and ttl > 0 then
+                redis.call('EXPIRE', zkey, ttl)
+            end
+        end
+    end
+    results[i] = { allowed, retry_after_ms, st.tokens, bucket_key }
+end
+
+local rollback = all_or_nothing and any_denied
+
+if not rollback then
+    for _, bucket_key in ipairs(order) do
+        local st = states[bucket_key]
+        if st.dirty then
+            local value = string.format('%d:%d', st.tokens, st.last_ms)
+            if ttl_seconds and ttl_seconds > 0 then
+                redis.call('SET', bucket_key, value, 'EX', ttl_seconds)
+                index_bucket(st.index_key, bucket_key, now_ms + ttl_seconds * 1000)
+            else
+                redis.call('SET', bucket_key, value)
+            end
+        end
+    end
+end
+
+local out = {}
+for i = 1, n_items do
+    local res = results[i]
+    local allowed = res[1]
+    local remaining = res[3]
+    if rollback then
+        allowed = 0
+        remaining = states[res[4]].refilled
+    end
+    table.insert(out, allowed)
+    table.insert(out, tostring(res[2] / 1000.0))
+    table.insert(out, tostring(remaining / SCALE))
+end
+return out
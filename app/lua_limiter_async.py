@@ -1,13 +1,180 @@
 from __future__ import annotations
+import asyncio
 import hashlib
-from typing import Tuple
+import os
+import time
+from typing import Any, Callable, List, Optional, Sequence, Set, Tuple, Union
 import redis.asyncio as redis
+from redis.exceptions import NoScriptError
+
+# (bucket_key, capacity_tokens, rate_subtokens_per_sec, cost_tokens, offender_member[, index_key])
+BatchItem = Union[Tuple[str, int, int, int, str], Tuple[str, int, int, int, str, str]]
+# (zset_key, ttl_seconds); ttl 0 = never expire
+OffenderKey = Tuple[str, int]
+
+# Single-bucket engines selectable per resource, all behind allow()'s contract.
+# token_bucket and gcra read each other's state (see gcra.lua); sliding_window
+# counts tokens per rolling window_ms instead and is single-decision only.
+ALGORITHMS = ("token_bucket", "gcra", "sliding_window")
+
+# on_call(script, command, seconds) after every script round trip; command is
+# "evalsha", "noscript" (an EVALSHA the server no longer had cached) or "eval"
+CallObserver = Callable[[str, str, float], None]
+
+# on_flush(commands, queue_delay_seconds) for every pipeline an AutoPipeline sends;
+# the delay is how long its oldest command waited to go out
+FlushObserver = Callable[[int, float], None]
+
+class AutoPipeline:
+    """
+    Sends the EVALSHAs of concurrent callers as shared pipelines instead of
+    one command and one reply wait each.
+
+    A call is queued and a flush is scheduled for the next event-loop tick
+    (or `max_delay_ms` later); the queue is flushed early once `max_batch`
+    commands are waiting. Each flush writes every queued command in one go on
+    a pooled connection and hands every caller its own reply, or its own
+    error: a NOSCRIPT reply raises NoScriptError for that caller only, so
+    AsyncLuaLimiter's EVAL fallback still applies. Commands for different
+    keys are independent, and Redis runs a pipeline's scripts in the order
+    they were queued, so callers observe the same results as unpipelined.
+    Several flushes may be in flight at once.
+    """
+
+    def __init__(
+        self,
+        r: redis.Redis,
+        *,
+        max_batch: int = 128,
+        max_delay_ms: float = 0.0,
+        on_flush: Optional[FlushObserver] = None,
+    ):
+        self.r = r
+        self._max_batch = max(1, max_batch)
+        self._delay = max_delay_ms / 1000.0
+        self._on_flush = on_flush
+        # (sha, keys, argv, future), oldest first; _since is when the oldest was queued
+        self._queue: List[Tuple[str, Sequence[str], Sequence[str], asyncio.Future]] = []
+        self._since = 0.0
+        self._timer: Optional[asyncio.Handle] = None
+        self._tasks: Set[asyncio.Task] = set()  # the loop only keeps weak references
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    async def evalsha(self, sha: str, keys: Sequence[str], argv: Sequence[str]) -> Any:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        if not self._queue:
+            self._since = time.perf_counter()
+        self._queue.append((sha, keys, argv, fut))
+        if len(self._queue) >= self._max_batch:
+            self._flush()
+        elif self._timer is None:
+            if self._delay > 0:
+                self._timer = loop.call_later(self._delay, self._flush)
+            else:
+                self._timer = loop.call_soon(self._flush)
+        return await fut
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._queue:
+            return
+        batch, self._queue = self._queue, []
+        if self._on_flush is not None:
+            self._on_flush(len(batch), time.perf_counter() - self._since)
+        task = asyncio.get_running_loop().create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: List[Tuple[str, Sequence[str], Sequence[str], asyncio.Future]]) -> None:
+        pipe = self.r.pipeline(transaction=False)
+        for sha, keys, argv, _ in batch:
+            pipe.evalsha(sha, len(keys), *keys, *argv)
+        try:
+            replies = await pipe.execute(raise_on_error=False)
+        except BaseException as e:
+            for *_, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+        for (*_, fut), reply in zip(batch, replies):
+            if fut.done():
+                continue  # the caller was cancelled
+            if isinstance(reply, Exception):
+                fut.set_exception(reply)
+            else:
+                fut.set_result(reply)
+
 
 class AsyncLuaLimiter:
-    def __init__(self, r: redis.Redis, script_text: str):
+    def __init__(
+        self,
+        r: redis.Redis,
+        script_text: str,
+        batch_script_text: str = "",
+        lease_script_text: str = "",
+        gcra_script_text: str = "",
+        sliding_script_text: str = "",
+        on_call: Optional[CallObserver] = None,
+        pipeline: Optional[AutoPipeline] = None,
+    ):
         self.r = r
+        self.on_call = on_call
+        # EVALSHAs go through the shared pipeline when set; EVAL fallbacks go direct
+        self.pipeline = pipeline
         self.script_text = script_text
         self.sha = hashlib.sha1(script_text.encode("utf-8")).hexdigest()
+        self.batch_script_text = batch_script_text
+        self.batch_sha = hashlib.sha1(batch_script_text.encode("utf-8")).hexdigest()
+        self.lease_script_text = lease_script_text
+        self.lease_sha = hashlib.sha1(lease_script_text.encode("utf-8")).hexdigest()
+        self.gcra_script_text = gcra_script_text
+        self.gcra_sha = hashlib.sha1(gcra_script_text.encode("utf-8")).hexdigest()
+        self.sliding_script_text = sliding_script_text
+        self.sliding_sha = hashlib.sha1(sliding_script_text.encode("utf-8")).hexdigest()
+
+    async def load(self) -> None:
+        """Preload every script so the first calls hit EVALSHA (all primaries under Cluster)."""
+        for text in (
+            self.script_text,
+            self.batch_script_text,
+            self.lease_script_text,
+            self.gcra_script_text,
+            self.sliding_script_text,
+        ):
+            if text:
+                await self.r.script_load(text)
+
+    async def _evalsha(self, sha: str, keys: Sequence[str], argv: Sequence[str]):
+        if self.pipeline is not None:
+            return await self.pipeline.evalsha(sha, keys, argv)
+        return await self.r.evalsha(sha, len(keys), *keys, *argv)
+
+    async def _run(self, name: str, sha: str, script_text: str, keys: Sequence[str], argv: Sequence[str]):
+        on_call = self.on_call
+        if on_call is None:
+            try:
+                return await self._evalsha(sha, keys, argv)
+            except NoScriptError:
+                return await self.r.eval(script_text, len(keys), *keys, *argv)
+        t0 = time.perf_counter()
+        try:
+            res = await self._evalsha(sha, keys, argv)
+        except NoScriptError:
+            t1 = time.perf_counter()
+            on_call(name, "noscript", t1 - t0)
+            # EVAL also puts the script back in the server's cache
+            res = await self.r.eval(script_text, len(keys), *keys, *argv)
+            on_call(name, "eval", time.perf_counter() - t1)
+            return res
+        on_call(name, "evalsha", time.perf_counter() - t0)
+        return res
 
     async def allow(
         self,
@@ -20,22 +187,140 @@ class AsyncLuaLimiter:
         ttl_seconds: int,
         idem_key: str = "",
         idempotency_ttl_seconds: int = 60,
+        offender_member: str = "",
+        offender_keys: Sequence[OffenderKey] = (),
+        config_argv: Sequence[bytes] = (),
+        algorithm: str = "token_bucket",
+        window_ms: int = 0,
+        index_key: str = "",
     ) -> Tuple[bool, float, float, bool]:
-        keys = [bucket_key, idem_key]
+        """
+        One decision with the chosen engine. For sliding_window, capacity_tokens
+        is the per-window limit and ARGV[2] carries window_ms instead of the rate.
+        index_key is the owner's bucket index the script keeps up to date.
+        """
+        if algorithm == "sliding_window" and not config_argv:
+            config_argv = (str(capacity_tokens), str(window_ms))
+        # Unused KEYS[2]/KEYS[3] repeat the bucket key: an empty key would hash
+        # to another Redis Cluster slot than the bucket and fail with CROSSSLOT
+        keys = [bucket_key, idem_key or bucket_key, index_key or bucket_key]
+        # config_argv: ARGV[1..2] pre-encoded by the policy table (ResourcePolicy)
         argv = [
-            str(capacity_tokens),
-            str(rate_subtokens_per_sec),
+            *(config_argv or (str(capacity_tokens), str(rate_subtokens_per_sec))),
             str(cost_tokens),
             str(scale),
             str(ttl_seconds),
             str(idempotency_ttl_seconds),
+            offender_member,
         ]
-        try:
-            res = await self.r.evalsha(self.sha, len(keys), *keys, *argv)
-        except redis.ResponseError:
-            res = await self.r.eval(self.script_text, len(keys), *keys, *argv)
+        for zkey, zttl in offender_keys:
+            keys.append(zkey)
+            argv.append(str(zttl))
+        if algorithm == "gcra":
+            if not self.gcra_script_text:
+                raise RuntimeError("AsyncLuaLimiter was created without a GCRA script")
+            res = await self._run("gcra", self.gcra_sha, self.gcra_script_text, keys, argv)
+        elif algorithm == "sliding_window":
+            if not self.sliding_script_text:
+                raise RuntimeError("AsyncLuaLimiter was created without a sliding-window script")
+            res = await self._run("sliding_window", self.sliding_sha, self.sliding_script_text, keys, argv)
+        else:
+            res = await self._run("limiter", self.sha, self.script_text, keys, argv)
         allowed = bool(int(res[0]))
         retry_after = float(res[1])
         remaining = float(res[2])
         used_idem = bool(int(res[3]))
         return allowed, retry_after, remaining, used_idem
+
+    async def allow_many(
+        self,
+        items: Sequence[BatchItem],
+        *,
+        scale: int,
+        ttl_seconds: int,
+        all_or_nothing: bool = False,
+        offender_keys: Sequence[OffenderKey] = (),
+    ) -> List[Tuple[bool, float, float, bool]]:
+        """
+        Decide several buckets in one EVALSHA (see limiter_batch.lua).
+        Results are returned in item order with the same shape as allow();
+        used_idem is always False since batches do not take idempotency keys.
+        Denied items are counted against offender_keys in the same call.
+        """
+        if not items:
+            return []
+        if not self.batch_script_text:
+            raise RuntimeError("AsyncLuaLimiter was created without a batch script")
+        keys = [item[0] for item in items]
+        keys += [item[5] if len(item) > 5 and item[5] else item[0] for item in items]
+        argv = [
+            str(len(items)),
+            str(scale),
+            str(ttl_seconds),
+            "1" if all_or_nothing else "0",
+            str(len(offender_keys)),
+        ]
+        for _, capacity_tokens, rate_subtokens_per_sec, cost_tokens, member, *_ in items:
+            argv += [str(capacity_tokens), str(rate_subtokens_per_sec), str(cost_tokens), member]
+        for zkey, zttl in offender_keys:
+            keys.append(zkey)
+            argv.append(str(zttl))
+        res = await self._run("batch", self.batch_sha, self.batch_script_text, keys, argv)
+        return [
+            (bool(int(res[i])), float(res[i + 1]), float(res[i + 2]), False)
+            for i in range(0, len(res), 3)
+        ]
+
+    async def lease(
+        self,
+        *,
+        bucket_key: str,
+        capacity_tokens: int,
+        rate_subtokens_per_sec: int,
+        scale: int,
+        ttl_seconds: int,
+        return_tokens: int = 0,
+        want_tokens: int = 0,
+        min_tokens: int = 1,
+        index_key: str = "",
+    ) -> Tuple[int, float, float]:
+        """
+        Hand back `return_tokens` and withdraw up to `want_tokens` whole tokens
+        (see lease.lua). Returns (granted, retry_after, remaining_in_bucket);
+        granted is 0 when fewer than `min_tokens` are available.
+        """
+        if not self.lease_script_text:
+            raise RuntimeError("AsyncLuaLimiter was created without a lease script")
+        argv = [
+            str(capacity_tokens),
+            str(rate_subtokens_per_sec),
+            str(scale),
+            str(ttl_seconds),
+            str(return_tokens),
+            str(want_tokens),
+            str(min_tokens),
+        ]
+        keys = [bucket_key, index_key] if index_key else [bucket_key]
+        res = await self._run("lease", self.lease_sha, self.lease_script_text, keys, argv)
+        return int(res[0]), float(res[1]), float(res[2])
+
+def _read_script(name: str) -> str:
+    with open(os.path.join(os.path.dirname(__file__), name), "r") as f:
+        return f.read()
+
+def bundled_limiter(
+    r: redis.Redis,
+    on_call: Optional[CallObserver] = None,
+    pipeline: Optional[AutoPipeline] = None,
+) -> AsyncLuaLimiter:
+    """An AsyncLuaLimiter running the scripts shipped next to this module."""
+    return AsyncLuaLimiter(
+        r,
+        _read_script("limiter.lua"),
+        _read_script("limiter_batch.lua"),
+        _read_script("lease.lua"),
+        _read_script("gcra.lua"),
+        _read_script("sliding_window.lua"),
+        on_call=on_call,
+        pipeline=pipeline,
+    )
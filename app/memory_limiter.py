@@ -0,0 +1,287 @@
+from __future__ import annotations
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from app.lua_limiter_async import BatchItem, OffenderKey
+
+INFINITE_RETRY_MS = 2**31 - 1
+
+def _monotonic_ms() -> int:
+    return time.monotonic_ns() // 1_000_000
+
+
+class _Bucket:
+    __slots__ = ("tokens", "last_ms", "expires_ms")
+
+    def __init__(self, tokens: int, last_ms: int, expires_ms: int):
+        self.tokens = tokens          # subtokens (tokens * scale), like limiter.lua
+        self.last_ms = last_ms
+        self.expires_ms = expires_ms
+
+
+class _ExpiryQueues:
+    """
+    A table's keys in write order, one queue per TTL. Writes with the same TTL
+    expire in write order, so evicting only ever checks the front of each
+    queue, and a long-TTL entry never holds back expired short-TTL ones.
+    """
+
+    __slots__ = ("_queues", "_ttl")
+
+    def __init__(self):
+        self._queues: Dict[int, "OrderedDict[str, int]"] = {}  # ttl_ms -> key -> expires_ms
+        self._ttl: Dict[str, int] = {}
+
+    def touch(self, key: str, ttl_ms: int, expires_ms: int) -> None:
+        old = self._ttl.get(key)
+        if old is not None and old != ttl_ms:
+            del self._queues[old][key]
+        q = self._queues.get(ttl_ms)
+        if q is None:
+            q = self._queues[ttl_ms] = OrderedDict()
+        q[key] = expires_ms
+        q.move_to_end(key)
+        self._ttl[key] = ttl_ms
+
+    def pop_expired(self, now: int, budget: Optional[int]) -> List[str]:
+        out: List[str] = []
+        for q in self._queues.values():
+            while q and (budget is None or len(out) < budget):
+                key, expires_ms = next(iter(q.items()))
+                if expires_ms > now:
+                    break
+                del q[key]
+                del self._ttl[key]
+                out.append(key)
+        return out
+
+
+class AsyncMemoryLimiter:
+    """
+    In-process token buckets with the same allow()/allow_many()/lease()
+    contract as AsyncLuaLimiter, for edge deployments and Redis-less tests.
+
+    The limiter is confined to one event loop: no method awaits while it reads
+    or writes a bucket, so every decision is atomic without any locks. Refill
+    uses the same integer subtoken math as limiter.lua, so both backends agree
+    on allow/deny and retry_after. Like the scripts, only a charge writes a
+    bucket (and pushes out its expiry); per-policy TTLs differ, so expiry is
+    tracked in _ExpiryQueues and evict_expired() drops exactly the entries
+    whose TTL has passed. Offender keys, index keys and config_argv are
+    accepted for signature compatibility and ignored, and algorithm="gcra" is
+    served by the token bucket, whose decisions GCRA reproduces (up to refill
+    rounding). sliding_window mirrors its script.
+    """
+
+    def __init__(self, *, now_ms: Callable[[], int] = _monotonic_ms):
+        self._now_ms = now_ms
+        self._buckets: Dict[str, _Bucket] = {}
+        # idem_key -> (expires_ms, allowed, retry_after_ms, remaining_subtokens)
+        self._idem: Dict[str, Tuple[int, int, int, int]] = {}
+        # sliding_window key -> (window_index, cur, prev, expires_ms)
+        self._windows: Dict[str, Tuple[int, int, int, int]] = {}
+        self._expiry = {"buckets": _ExpiryQueues(), "idem": _ExpiryQueues(), "windows": _ExpiryQueues()}
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    async def load(self) -> None:
+        """No scripts to preload; present for AsyncLuaLimiter compatibility."""
+
+    def _refilled(self, bucket_key: str, capacity_subtokens: int, rate_subtokens_per_sec: int, now: int) -> _Bucket:
+        b = self._buckets.get(bucket_key)
+        if b is None or b.expires_ms <= now:
+            return _Bucket(capacity_subtokens, now, 0)
+        elapsed_ms = now - b.last_ms
+        if elapsed_ms > 0 and b.tokens < capacity_subtokens:
+            added = (rate_subtokens_per_sec * elapsed_ms) // 1000
+            if added > 0:
+                b.tokens = min(capacity_subtokens, b.tokens + added)
+                b.last_ms = now
+        return b
+
+    @staticmethod
+    def _charge(b: _Bucket, need: int, capacity_subtokens: int, now: int) -> None:
+        if b.tokens >= capacity_subtokens:
+            b.last_ms = now  # a full bucket's clock is stale; refill starts when it is drawn down
+        b.tokens -= need
+
+    def _store(self, bucket_key: str, b: _Bucket, ttl_seconds: int, now: int) -> None:
+        ttl_ms = ttl_seconds * 1000 if ttl_seconds > 0 else 2**62
+        b.expires_ms = now + ttl_ms
+        self._buckets[bucket_key] = b
+        self._expiry["buckets"].touch(bucket_key, ttl_ms, b.expires_ms)
+
+    def _remember(self, idem_key: str, ttl_seconds: int, now: int, allowed: int, retry_ms: int, remaining: int) -> None:
+        ttl_ms = ttl_seconds * 1000
+        self._idem[idem_key] = (now + ttl_ms, allowed, retry_ms, remaining)
+        self._expiry["idem"].touch(idem_key, ttl_ms, now + ttl_ms)
+
+    @staticmethod
+    def _retry_ms(deficit: int, rate_subtokens_per_sec: int) -> int:
+        if rate_subtokens_per_sec <= 0:
+            return INFINITE_RETRY_MS
+        return -(-deficit * 1000 // rate_subtokens_per_sec)  # ceil
+
+    async def allow(
+        self,
+        *,
+        bucket_key: str,
+        capacity_tokens: int,
+        rate_subtokens_per_sec: int,
+        cost_tokens: int,
+        scale: int,
+        ttl_seconds: int,
+        idem_key: str = "",
+        idempotency_ttl_seconds: int = 60,
+        offender_member: str = "",
+        offender_keys: Sequence[OffenderKey] = (),
+        config_argv: Sequence[bytes] = (),
+        algorithm: str = "token_bucket",
+        window_ms: int = 0,
+        index_key: str = "",
+    ) -> Tuple[bool, float, float, bool]:
+        now = self._now_ms()
+        if idem_key:
+            cached = self._idem.get(idem_key)
+            if cached is not None and cached[0] > now:
+                return bool(cached[1]), cached[2] / 1000.0, cached[3] / scale, True
+
+        if algorithm == "sliding_window":
+            allowed, retry_ms, remaining = self._sliding(bucket_key, capacity_tokens, window_ms, cost_tokens, now)
+            remaining_subtokens = int(remaining * scale)
+            if idem_key:
+                self._remember(idem_key, idempotency_ttl_seconds, now, allowed, retry_ms, remaining_subtokens)
+            return bool(allowed), retry_ms / 1000.0, remaining_subtokens / scale, False
+
+        capacity_subtokens = capacity_tokens * scale
+        b = self._refilled(bucket_key, capacity_subtokens, rate_subtokens_per_sec, now)
+        need = cost_tokens * scale
+        retry_ms = 0
+        if b.tokens >= need:
+            if need > 0:
+                self._charge(b, need, capacity_subtokens, now)
+                self._store(bucket_key, b, ttl_seconds, now)
+            allowed = 1
+        else:
+            allowed = 0
+            retry_ms = self._retry_ms(need - b.tokens, rate_subtokens_per_sec)
+
+        if idem_key:
+            self._remember(idem_key, idempotency_ttl_seconds, now, allowed, retry_ms, b.tokens)
+        return bool(allowed), retry_ms / 1000.0, b.tokens / scale, False
+
+    def _sliding(self, key: str, limit: int, window_ms: int, cost: int, now: int) -> Tuple[int, int, float]:
+        """sliding_window.lua in Python: (allowed, retry_after_ms, remaining_tokens)."""
+        idx, elapsed = divmod(now, window_ms)
+        cur = prev = 0
+        state = self._windows.get(key)
+        if state is not None and state[3] > now:
+            if state[0] == idx:
+                cur, prev = state[1], state[2]
+            elif state[0] == idx - 1:
+                prev = state[1]
+        estimate = prev * (window_ms - elapsed) / window_ms + cur
+        if estimate + cost <= limit:
+            if cost > 0:
+                cur += cost
+                estimate += cost
+                self._windows[key] = (idx, cur, prev, now + 2 * window_ms - elapsed)
+                self._expiry["windows"].touch(key, window_ms, now + 2 * window_ms - elapsed)
+            return 1, 0, max(0.0, limit - estimate)
+        if cost > limit:
+            retry_ms = INFINITE_RETRY_MS
+        elif cur + cost <= limit:
+            fits_at = window_ms - (limit - cur - cost) * window_ms / prev
+            retry_ms = max(1, math.ceil(fits_at - elapsed))
+        else:
+            fits_at = window_ms - (limit - cost) * window_ms / cur
+            retry_ms = math.ceil(window_ms - elapsed + max(0.0, fits_at))
+        return 0, retry_ms, max(0.0, limit - estimate)
+
+    async def allow_many(
+        self,
+        items: Sequence[BatchItem],
+        *,
+        scale: int,
+        ttl_seconds: int,
+        all_or_nothing: bool = False,
+        offender_keys: Sequence[OffenderKey] = (),
+    ) -> List[Tuple[bool, float, float, bool]]:
+        now = self._now_ms()
+        # Work on copies so an all-or-nothing rollback leaves the table untouched
+        work = {}
+        refilled = {}
+        charged = set()
+        out = []
+        any_denied = False
+        for bucket_key, capacity_tokens, rate_subtokens_per_sec, cost_tokens, *_ in items:
+            b = work.get(bucket_key)
+            if b is None:
+                cur = self._refilled(bucket_key, capacity_tokens * scale, rate_subtokens_per_sec, now)
+                b = work[bucket_key] = _Bucket(cur.tokens, cur.last_ms, cur.expires_ms)
+                refilled[bucket_key] = cur.tokens
+            need = cost_tokens * scale
+            if b.tokens >= need:
+                if need > 0:
+                    self._charge(b, need, capacity_tokens * scale, now)
+                    charged.add(bucket_key)
+                out.append([True, 0, b.tokens, bucket_key])
+            else:
+                any_denied = True
+                out.append([False, self._retry_ms(need - b.tokens, rate_subtokens_per_sec), b.tokens, bucket_key])
+
+        rollback = all_or_nothing and any_denied
+        if not rollback:
+            for bucket_key in charged:
+                self._store(bucket_key, work[bucket_key], ttl_seconds, now)
+        return [
+            (
+                False if rollback else allowed,
+                retry_ms / 1000.0,
+                (refilled[key] if rollback else remaining) / scale,
+                False,
+            )
+            for allowed, retry_ms, remaining, key in out
+        ]
+
+    async def lease(
+        self,
+        *,
+        bucket_key: str,
+        capacity_tokens: int,
+        rate_subtokens_per_sec: int,
+        scale: int,
+        ttl_seconds: int,
+        return_tokens: int = 0,
+        want_tokens: int = 0,
+        min_tokens: int = 1,
+        index_key: str = "",
+    ) -> Tuple[int, float, float]:
+        now = self._now_ms()
+        capacity_subtokens = capacity_tokens * scale
+        b = self._refilled(bucket_key, capacity_subtokens, rate_subtokens_per_sec, now)
+        b.tokens = min(capacity_subtokens, b.tokens + return_tokens * scale)
+        granted = min(b.tokens // scale, want_tokens)
+        retry_ms = 0
+        if want_tokens > 0 and granted < min_tokens:
+            granted = 0
+            retry_ms = self._retry_ms(min_tokens * scale - b.tokens, rate_subtokens_per_sec)
+        if granted > 0:
+            self._charge(b, granted * scale, capacity_subtokens, now)
+        if granted > 0 or return_tokens > 0:
+            self._store(bucket_key, b, ttl_seconds, now)
+        return granted, retry_ms / 1000.0, b.tokens / scale
+
+    def evict_expired(self, budget: Optional[int] = None) -> int:
+        """Drop idle buckets, windows and idempotency entries whose TTL has passed."""
+        now = self._now_ms()
+        evicted = 0
+        for name, table in (("buckets", self._buckets), ("idem", self._idem), ("windows", self._windows)):
+            keys = self._expiry[name].pop_expired(now, None if budget is None else budget - evicted)
+            for key in keys:
+                del table[key]
+            evicted += len(keys)
+        return evicted
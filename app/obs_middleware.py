@@ -0,0 +1,165 @@
+from __future__ import annotations
+import itertools
+import json
+import logging
+import os
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from prometheus_client import Histogram
+
+# Request IDs: a per-process random prefix plus a counter is unique enough for
+# log correlation and far cheaper than formatting a uuid4 per request.
+_RID_PREFIX = os.urandom(6).hex()
+_rid_counter = itertools.count(1)
+
+def new_request_id() -> str:
+    return f"{_RID_PREFIX}-{next(_rid_counter):x}"
+
+
+class RequestTimings:
+    """Redis round trips made on behalf of the current request."""
+
+    __slots__ = ("redis_calls", "redis_seconds")
+
+    def __init__(self):
+        self.redis_calls = 0
+        self.redis_seconds = 0.0
+
+    def log_fields(self) -> dict:
+        return {"redis_calls": self.redis_calls, "redis_ms": round(self.redis_seconds * 1000.0, 3)}
+
+
+# Set per HTTP request by ObsMiddleware; background tasks see None. Tasks a
+# handler spawns (asyncio.gather) inherit the same object and add to it.
+_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+def current_timings() -> Optional[RequestTimings]:
+    return _timings.get()
+
+def note_redis_call(seconds: float) -> None:
+    t = _timings.get()
+    if t is not None:
+        t.redis_calls += 1
+        t.redis_seconds += seconds
+
+def track_timings() -> RequestTimings:
+    """Give the current context its own RequestTimings, e.g. a task calling Redis for several requests."""
+    t = RequestTimings()
+    _timings.set(t)
+    return t
+
+def note_shared_calls(shared: RequestTimings) -> None:
+    """Charge round trips made on behalf of several requests (see track_timings) to this one too."""
+    t = _timings.get()
+    if t is not None:
+        t.redis_calls += shared.redis_calls
+        t.redis_seconds += shared.redis_seconds
+
+
+class ObsMiddleware:
+    """
+    Pure ASGI observability layer: latency histogram, X-Request-ID
+    propagation (request state + response header) and one JSON access log line.
+
+    Each request also gets a RequestTimings that the Redis layer adds to (see
+    note_redis_call); its call count and time go to the redis_calls/redis_latency
+    histograms and the access log, and with server_timing=True to a
+    Server-Timing header ("redis" and "app" = everything else).
+
+    Unlike a BaseHTTPMiddleware subclass it adds no task or memory-stream hop;
+    the status code is read from the http.response.start message as it passes.
+    """
+
+    def __init__(
+        self,
+        app,
+        *,
+        latency: Histogram,
+        logger: logging.Logger,
+        redis_calls: Optional[Histogram] = None,
+        redis_latency: Optional[Histogram] = None,
+        server_timing: bool = False,
+        max_paths: int = 1024,
+    ):
+        self.app = app
+        self._latency = latency
+        self._logger = logger
+        self._redis_calls = redis_calls
+        self._redis_latency = redis_latency
+        self._server_timing = server_timing
+        self._max_paths = max_paths
+        self._children: Dict[str, object] = {}
+
+    def _observe(self, path: str, seconds: float) -> None:
+        child = self._children.get(path)
+        if child is None:
+            child = self._latency.labels(endpoint=path)
+            # paths like /admin/user/{id} are unbounded; only cache the first few
+            if len(self._children) < self._max_paths:
+                self._children[path] = child
+        child.observe(seconds)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.monotonic_ns()
+        rid = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                rid = value.decode("latin-1")
+                break
+        if not rid:
+            rid = new_request_id()
+        scope.setdefault("state", {})["request_id"] = rid
+        rid_header = (b"x-request-id", rid.encode("latin-1"))
+        status = None
+        timings = RequestTimings()
+        token = _timings.set(timings)
+
+        async def send_with_rid(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", ()))
+                if not any(k.lower() == b"x-request-id" for k, _ in headers):
+                    headers.append(rid_header)
+                if self._server_timing:
+                    headers.append((b"server-timing", self._server_timing_value(timings, start)))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_rid)
+        finally:
+            _timings.reset(token)
+            took_ns = time.monotonic_ns() - start
+            path = scope["path"]
+            self._observe(path, took_ns / 1_000_000_000.0)
+            if self._redis_calls is not None:
+                self._redis_calls.observe(timings.redis_calls)
+            if self._redis_latency is not None and timings.redis_calls:
+                self._redis_latency.observe(timings.redis_seconds)
+            if self._logger.isEnabledFor(logging.INFO):
+                self._logger.info(json.dumps({
+                    "ts": time.time(),
+                    "request_id": rid,
+                    "method": scope["method"],
+                    "path": path,
+                    "status": status,
+                    "latency_ms": round(took_ns / 1_000_000.0, 3),
+                    **timings.log_fields(),
+                }))
+
+    @staticmethod
+    def _server_timing_value(timings: RequestTimings, start_ns: int) -> bytes:
+        # Measured when the response starts, so body streaming is not included
+        total_ms = (time.monotonic_ns() - start_ns) / 1_000_000.0
+        redis_ms = timings.redis_seconds * 1000.0
+        return (
+            f'redis;dur={redis_ms:.3f};desc="{timings.redis_calls} calls", '
+            f"app;dur={max(0.0, total_ms - redis_ms):.3f}, total;dur={total_ms:.3f}"
+        ).encode("latin-1")
@@ -0,0 +1,113 @@
+from __future__ import annotations
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+import redis.asyncio as redis
+
+from app.keys import bucket_key_for, bucket_ttl_seconds
+
+def offender_key_at(minute: int, bucket: str) -> str:
+    """The offender ZSET of `bucket` granularity holding epoch minute `minute`."""
+    return bucket_key_for(datetime.fromtimestamp(minute * 60, timezone.utc), bucket)
+
+def offender_cover(start: int, end: int, folded_min: int, folded_hour: int) -> List[str]:
+    """
+    The fewest offender ZSETs whose union holds the denies of minutes
+    [start, end): a day or hour ZSET wherever one begins at the cursor and
+    everything it holds lies inside the range, minute ZSETs elsewhere.
+    """
+    keys: List[str] = []
+    t = start
+    while t < end:
+        day_end = min(t + 1440, folded_hour)
+        hour_end = min(t + 60, folded_min)
+        if t % 1440 == 0 and t < day_end <= end:
+            keys.append(offender_key_at(t, "day"))
+            t = day_end
+        elif t % 60 == 0 and t < hour_end <= end:
+            keys.append(offender_key_at(t, "hour"))
+            t = hour_end
+        else:
+            keys.append(offender_key_at(t, "minute"))
+            t += 1
+    return keys
+
+
+class OffenderRollup:
+    """
+    Folds closed minute offender ZSETs into their hour ZSET and closed hours
+    into their day ZSET, so a time-windowed top-offenders query unions whole
+    days and hours plus the minutes at the window's edges.
+
+    Progress is two watermarks in epoch minutes: minutes before `minute_key`
+    are in their hour, hours before `hour_key` in their day. Any replica may
+    run a pass (a short lock keeps it to one at a time); folds and watermarks
+    move in one MULTI, so no minute is ever counted twice. On first start both
+    watermarks begin at the current minute/hour: earlier data is left where
+    older versions wrote it.
+    """
+
+    def __init__(
+        self,
+        r: redis.Redis,
+        *,
+        prefix: str,
+        grace_seconds: int = 10,
+        max_minutes: int = 1440,
+        on_pass: Optional[Callable[[float], None]] = None,
+    ):
+        self._r = r
+        self.minute_key = f"{prefix}:rollup:minute"
+        self.hour_key = f"{prefix}:rollup:hour"
+        self.lock_key = f"{prefix}:rollup:lock"
+        self.grace_seconds = grace_seconds  # a minute is closed this long after it ends (flush lag, clock skew)
+        self._max_minutes = max_minutes     # per pass, when catching up after downtime
+        self._on_pass = on_pass             # seconds spent in the fold transaction
+
+    async def watermarks(self, node: Optional[redis.Redis] = None) -> Tuple[Optional[int], Optional[int]]:
+        """(folded minute, folded hour) as stored on `node` (default: the writer); None before any pass."""
+        pipe = (node or self._r).pipeline(transaction=False)
+        pipe.get(self.minute_key)
+        pipe.get(self.hour_key)
+        folded_min, folded_hour = await pipe.execute()
+        return (int(folded_min) if folded_min else None, int(folded_hour) if folded_hour else None)
+
+    async def run(self, now: Optional[float] = None) -> bool:
+        """One rollup pass; False if another replica holds the lock."""
+        now = time.time() if now is None else now
+        closed = int((now - self.grace_seconds) // 60)   # minutes before this are final
+        if not await self._r.set(self.lock_key, b"1", nx=True, px=30_000):
+            return False
+        try:
+            folded_min, folded_hour = await self.watermarks()
+            if folded_min is None:
+                folded_min = closed
+            if folded_hour is None:
+                folded_hour = folded_min - folded_min % 60
+            upto_min = max(folded_min, min(closed, folded_min + self._max_minutes))
+            upto_hour = max(folded_hour, upto_min - upto_min % 60)   # hours whose minutes are all folded
+
+            # One ZUNIONSTORE per hour (day) touched, over everything newly closed in it
+            hours: Dict[int, List[str]] = {}
+            for m in range(folded_min, upto_min):
+                hours.setdefault(m - m % 60, []).append(offender_key_at(m, "minute"))
+            days: Dict[int, List[str]] = {}
+            for h in range(folded_hour, upto_hour, 60):
+                days.setdefault(h - h % 1440, []).append(offender_key_at(h, "hour"))
+
+            pipe = self._r.pipeline(transaction=True)
+            for bucket, groups in (("hour", hours), ("day", days)):
+                for start, sources in groups.items():
+                    dest = offender_key_at(start, bucket)
+                    pipe.zunionstore(dest, [dest, *sources])
+                    pipe.expire(dest, bucket_ttl_seconds(bucket))
+            pipe.set(self.minute_key, upto_min)
+            pipe.set(self.hour_key, upto_hour)
+            t0 = time.perf_counter()
+            await pipe.execute()
+            if self._on_pass is not None:
+                self._on_pass(time.perf_counter() - t0)
+            return True
+        finally:
+            await self._r.delete(self.lock_key)
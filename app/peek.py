@@ -0,0 +1,130 @@
+from __future__ import annotations
+import asyncio
+import math
+import time
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import redis.asyncio as redis
+
+from app.memory_limiter import INFINITE_RETRY_MS
+
+async def read_bucket(node: redis.Redis, key: bytes) -> Tuple[Optional[dict], dict]:
+    """
+    (state, legacy_config) for a bucket in any layout: the compact
+    "tokens:last_refill_ms" string -> {"tokens", "last_ms"}, a GCRA TAT in
+    microseconds -> {"tat_us"}, a sliding window "index:cur:prev" ->
+    {"window_idx", "cur", "prev"}, or the 5-field hash older versions wrote
+    (which also carried capacity/rate/scale). State is None if the key is gone.
+    """
+    try:
+        raw = await node.get(key)
+    except redis.ResponseError:  # WRONGTYPE: legacy hash
+        vals = await node.hmget(key, b"tokens", b"last_refill_ms", b"capacity_tokens", b"rate_subtokens_per_sec", b"scale")
+        cfg = {}
+        if vals[2] and vals[3] and vals[4]:
+            cfg = {"capacity": int(vals[2]), "rate_subtokens_per_sec": int(vals[3]), "scale": int(vals[4])}
+        if not vals[0]:
+            return None, cfg
+        return {"tokens": int(float(vals[0])), "last_ms": int(float(vals[1])) if vals[1] else None}, cfg
+    return parse_bucket(raw), {}
+
+def parse_bucket(raw: Optional[bytes]) -> Optional[dict]:
+    """State from a bucket's string value (see read_bucket)."""
+    if raw is None:
+        return None
+    parts = raw.split(b":")
+    if len(parts) == 1:
+        return {"tat_us": int(parts[0])}
+    if len(parts) == 3:
+        return {"window_idx": int(parts[0]), "cur": int(parts[1]), "prev": int(parts[2])}
+    return {"tokens": int(parts[0]), "last_ms": int(parts[1])}
+
+def window_counts(state: dict, window_ms: int, now_ms: float) -> Tuple[int, int, float]:
+    """(cur, prev, elapsed_ms) of a sliding window as of now_ms."""
+    idx, elapsed = divmod(now_ms, window_ms)
+    cur, prev = state["cur"], state["prev"]
+    if state["window_idx"] == idx - 1:
+        cur, prev = 0, cur
+    elif state["window_idx"] != idx:
+        cur, prev = 0, 0
+    return cur, prev, elapsed
+
+def current_subtokens(state: dict, cap_tokens: int, rate_sub: int, sc: int, window_ms: int, now_ms: float) -> float:
+    """Subtokens a bucket holds at now_ms, refill applied, for any state parse_bucket returns."""
+    if "window_idx" in state:
+        # Sliding window: the limit less the weighted two-window estimate
+        cur, prev, elapsed = window_counts(state, window_ms, now_ms)
+        estimate = prev * (window_ms - elapsed) / window_ms + cur
+        return max(0.0, cap_tokens - estimate) * sc
+    if "tat_us" in state:
+        # GCRA: short by however long the TAT is ahead of now
+        ahead_ms = max(0.0, state["tat_us"] / 1000.0 - now_ms)
+        return max(0.0, cap_tokens * sc - rate_sub * ahead_ms / 1000.0)
+    # Denies don't write, so apply the refill accrued since the last charge
+    tokens_sub, last_ms = state["tokens"], state["last_ms"]
+    if last_ms is not None and now_ms > last_ms:
+        tokens_sub = min(cap_tokens * sc, tokens_sub + rate_sub * (now_ms - last_ms) / 1000.0)
+    return tokens_sub
+
+def peek_decision(
+    state: Optional[dict], pol, sc: int, cost: int, now_ms: float,
+) -> Tuple[bool, float, float, bool]:
+    """
+    What the policy's script would answer for `cost` given a bucket's state
+    (None: no bucket yet), without charging anything. Same retry_after math as
+    the scripts; tokens are those available now, before the charge.
+    """
+    cap = pol.capacity
+    if pol.algorithm == "sliding_window":
+        window_ms = pol.window_ms
+        if state is not None and "window_idx" in state:
+            cur, prev, elapsed = window_counts(state, window_ms, now_ms)
+        else:
+            cur, prev, elapsed = 0, 0, now_ms % window_ms
+        estimate = prev * (window_ms - elapsed) / window_ms + cur
+        tokens = max(0.0, cap - estimate)
+        if estimate + cost <= cap:
+            return True, 0.0, tokens, False
+        if cost > cap:
+            retry_ms = INFINITE_RETRY_MS
+        elif cur + cost <= cap:
+            retry_ms = max(1, math.ceil(window_ms - (cap - cur - cost) * window_ms / prev - elapsed))
+        else:
+            retry_ms = math.ceil(window_ms - elapsed + max(0, window_ms - (cap - cost) * window_ms / cur))
+        return False, retry_ms / 1000.0, tokens, False
+
+    rate_sub = pol.rate_subtokens_per_sec
+    if state is None or "window_idx" in state:
+        tokens_sub = cap * sc  # no bucket (or another engine's): starts full
+    else:
+        tokens_sub = current_subtokens(state, cap, rate_sub, sc, 0, now_ms)
+    need = cost * sc
+    if tokens_sub >= need:
+        return True, 0.0, tokens_sub / sc, False
+    retry_ms = INFINITE_RETRY_MS if rate_sub <= 0 else math.ceil((need - tokens_sub) * 1000 / rate_sub)
+    return False, retry_ms / 1000.0, tokens_sub / sc, False
+
+
+class BucketPeeker:
+    """
+    Answers what the scripts would decide for a set of buckets without
+    charging them: every state is read concurrently from the node
+    `read_node` picks for its key, then run through peek_decision.
+    """
+
+    def __init__(
+        self,
+        read_node: Callable[[str], redis.Redis],
+        *,
+        scale: int,
+        now: Callable[[], float] = time.time,
+    ):
+        self._read_node = read_node
+        self._scale = scale
+        self._now = now
+
+    async def decisions(self, targets: Sequence[Tuple[str, object]], cost: int) -> List[Tuple[bool, float, float, bool]]:
+        """One peek_decision per (bucket key, policy) in `targets`, in order."""
+        found = await asyncio.gather(*(read_bucket(self._read_node(key), key.encode("utf-8")) for key, _ in targets))
+        now_ms = self._now() * 1000.0
+        return [peek_decision(state, pol, self._scale, cost, now_ms) for (_, pol), (state, _) in zip(targets, found)]
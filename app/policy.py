@@ -0,0 +1,313 @@
+from __future__ import annotations
+import fnmatch
+import hashlib
+import math
+import os
+import re
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import yaml
+
+from app.lua_limiter_async import ALGORITHMS
+
+# Key scopes a composite limit can be charged against
+SCOPES = ("user", "tenant", "global")
+
+class ResourcePolicy:
+    """
+    One resolved limit, with everything the hot path needs precomputed.
+    A composite policy has `limits`: every one of them is checked and charged
+    atomically, and the policy's own capacity/rate go unused.
+    """
+
+    __slots__ = (
+        "name", "capacity", "rate_tokens_per_sec", "rate_subtokens_per_sec",
+        "config_argv", "algorithm", "full_refill_seconds", "limits", "window_ms",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        capacity: int,
+        rate_tokens_per_sec: float,
+        scale: int,
+        algorithm: str = "token_bucket",
+        limits: Sequence["Limit"] = (),
+        window_ms: int = 0,
+    ):
+        if capacity <= 0 or rate_tokens_per_sec < 0:
+            raise ValueError(f"policy {name!r}: need capacity > 0 and rate_tokens_per_sec >= 0")
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"policy {name!r}: algorithm must be one of {', '.join(ALGORITHMS)}")
+        if algorithm in ("gcra", "sliding_window") and rate_tokens_per_sec * scale < 1:
+            raise ValueError(f"policy {name!r}: {algorithm} needs a positive rate_tokens_per_sec")
+        self.name = name
+        self.algorithm = algorithm
+        self.capacity = int(capacity)
+        self.rate_tokens_per_sec = float(rate_tokens_per_sec)
+        self.rate_subtokens_per_sec = int(self.rate_tokens_per_sec * scale)
+        # sliding_window: `capacity` tokens per window (exact when given as limit/window_seconds)
+        self.window_ms = 0
+        if algorithm == "sliding_window":
+            self.window_ms = int(window_ms) or round(self.capacity / self.rate_tokens_per_sec * 1000)
+        # ARGV[1..2] of the engine's script, encoded once instead of per call
+        self.config_argv: Tuple[bytes, bytes] = (
+            str(self.capacity).encode(),
+            str(self.window_ms if self.window_ms else self.rate_subtokens_per_sec).encode(),
+        )
+        self.limits: Tuple[Limit, ...] = tuple(limits)
+        # An idle bucket must outlive its refill, or expiring it would hand out a free reset
+        if self.limits:
+            refill = [l.full_refill_seconds for l in self.limits]
+        elif self.window_ms:
+            refill = [math.ceil(self.window_ms / 1000)]
+        else:
+            refill = [math.ceil(self.capacity * scale / self.rate_subtokens_per_sec) if self.rate_subtokens_per_sec > 0 else 0]
+        self.full_refill_seconds = max(refill)
+
+
+class Limit(ResourcePolicy):
+    """One member of a composite policy: a token bucket in a key scope."""
+
+    __slots__ = ("scope",)
+
+    def __init__(self, name: str, capacity: int, rate_tokens_per_sec: float, scale: int, scope: str):
+        if scope not in SCOPES:
+            raise ValueError(f"limit {name!r}: scope must be one of {', '.join(SCOPES)}")
+        super().__init__(name, capacity, rate_tokens_per_sec, scale)
+        self.scope = scope
+
+    @classmethod
+    def from_mapping(cls, entry: dict, scale: int) -> "Limit":
+        """{name, scope, capacity, rate_tokens_per_sec} or {name, scope, limit, window_seconds}."""
+        if not isinstance(entry, dict) or not entry.get("name"):
+            raise ValueError(f"policy limit entry needs a name: {entry!r}")
+        capacity, rate, _ = _sizing(entry, 0, 0.0)
+        return cls(str(entry["name"]), capacity, rate, scale, entry.get("scope", "user"))
+
+
+def fold_decisions(names: Sequence[str], decisions: list) -> Tuple[bool, float, float, str]:
+    """
+    Collapse one request's per-limit decisions: the binding limit is the one
+    with the longest retry_after on a deny, else the one with the fewest tokens left.
+    """
+    allowed = all(d[0] for d in decisions)
+    if allowed:
+        i = min(range(len(decisions)), key=lambda j: decisions[j][2])
+    else:
+        i = max(range(len(decisions)), key=lambda j: decisions[j][1])
+    return allowed, decisions[i][1], decisions[i][2], names[i]
+
+
+def _sizing(entry: dict, default_capacity: int, default_rate: float) -> Tuple[int, float, int]:
+    """(capacity, rate_tokens_per_sec, window_ms) from capacity/rate or limit/window_seconds."""
+    if "limit" in entry:
+        if not entry.get("window_seconds", 0) > 0:
+            raise ValueError(f"{entry['name']!r}: 'limit' needs window_seconds > 0")
+        window = float(entry["window_seconds"])
+        return entry["limit"], entry["limit"] / window, int(window * 1000)
+    return entry.get("capacity", default_capacity), entry.get("rate_tokens_per_sec", default_rate), 0
+
+
+class PolicyTable:
+    """
+    Immutable resource -> ResourcePolicy index for one policy version.
+
+    Exact names are a dict lookup. Entries containing glob characters
+    ("api/*", "search-?") are compiled into a single alternation regex and
+    tried in file order, so the first matching pattern wins. Results are
+    memoized (bounded) since the same few resource names repeat.
+    """
+
+    def __init__(
+        self,
+        version: str,
+        default: ResourcePolicy,
+        rules: Sequence[ResourcePolicy] = (),
+        *,
+        memo_size: int = 10_000,
+    ):
+        self.version = version
+        self.default = default
+        self.rules = list(rules)
+        self._exact: Dict[str, ResourcePolicy] = {}
+        self._patterns: List[ResourcePolicy] = []
+        for pol in self.rules:
+            if any(c in pol.name for c in "*?["):
+                self._patterns.append(pol)
+            else:
+                self._exact.setdefault(pol.name, pol)
+        self._matcher = re.compile("|".join(
+            f"(?P<p{i}>{fnmatch.translate(pol.name)})" for i, pol in enumerate(self._patterns)
+        )) if self._patterns else None
+        self._memo: Dict[str, ResourcePolicy] = {}
+        self._memo_size = memo_size
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def lookup(self, resource: str) -> ResourcePolicy:
+        pol = self._exact.get(resource)
+        if pol is not None:
+            return pol
+        pol = self._memo.get(resource)
+        if pol is not None:
+            return pol
+        pol = self.default
+        if self._matcher is not None:
+            m = self._matcher.match(resource)
+            if m is not None:
+                pol = self._patterns[int(m.lastgroup[1:])]
+        if len(self._memo) >= self._memo_size:
+            self._memo.clear()  # resource names come from clients; stay bounded
+        self._memo[resource] = pol
+        return pol
+
+    @classmethod
+    def from_mapping(
+        cls,
+        data: Optional[dict],
+        *,
+        scale: int,
+        default_capacity: int,
+        default_rate: float,
+        version: str,
+    ) -> "PolicyTable":
+        """
+        Build from the parsed policy.yaml:
+
+            version: "2024-06-01"          # optional label, prefixed to the content hash
+            defaults: {capacity: 10, rate_tokens_per_sec: 5.0}
+            resources:
+              - {name: read, capacity: 10, rate_tokens_per_sec: 5.0}
+              - {name: "search/*", capacity: 50, rate_tokens_per_sec: 25.0, algorithm: gcra}
+              - {name: export, limit: 1000, window_seconds: 3600, algorithm: sliding_window}
+              - name: api                  # composite: all limits, one atomic call
+                limits:
+                  - {name: per_sec, limit: 10, window_seconds: 1}
+                  - {name: per_day, limit: 20000, window_seconds: 86400}
+                  - {name: tenant, scope: tenant, capacity: 1000, rate_tokens_per_sec: 100}
+                  - {name: global, scope: global, capacity: 50000, rate_tokens_per_sec: 5000}
+        """
+        data = data or {}
+        if not isinstance(data, dict):
+            raise ValueError("policy must be a mapping")
+        defaults = data.get("defaults") or {}
+        default = ResourcePolicy(
+            "*",
+            defaults.get("capacity", default_capacity),
+            defaults.get("rate_tokens_per_sec", default_rate),
+            scale,
+            defaults.get("algorithm", "token_bucket"),
+        )
+        rules = []
+        for entry in data.get("resources") or []:
+            if not isinstance(entry, dict) or not entry.get("name"):
+                raise ValueError(f"policy resource entry needs a name: {entry!r}")
+            limits = [Limit.from_mapping(l, scale) for l in entry.get("limits") or []]
+            if len({l.name for l in limits}) != len(limits):
+                raise ValueError(f"policy {entry['name']!r}: limit names must be unique")
+            if limits and all(l.scope == "tenant" for l in limits):
+                raise ValueError(f"policy {entry['name']!r}: needs a user or global limit besides tenant ones")
+            capacity, rate, window_ms = _sizing(entry, default.capacity, default.rate_tokens_per_sec)
+            rules.append(ResourcePolicy(
+                str(entry["name"]),
+                capacity,
+                rate,
+                scale,
+                entry.get("algorithm", default.algorithm),
+                limits,
+                window_ms,
+            ))
+        label = data.get("version")
+        return cls(f"{label}@{version}" if label else version, default, rules)
+
+
+def _stat_sig(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(path)  # follows the ConfigMap ..data symlink swap
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+class PolicyLoader:
+    """
+    Owns the active PolicyTable and watches the policy file for changes.
+
+    poll() re-parses the file only when its inode/mtime/size changes and
+    returns the new table as `staged` without activating it; the caller
+    decides when to switch (see app_async.reload_policy). activate() swaps a
+    single reference, so in-flight requests finish on the table they started
+    with and none are dropped. A missing file means "defaults only"; a file
+    that fails to parse leaves the active table in place.
+    """
+
+    def __init__(self, path: str, *, scale: int, default_capacity: int, default_rate: float):
+        self.path = path
+        self._scale = scale
+        self._default_capacity = default_capacity
+        self._default_rate = default_rate
+        self._sig: Optional[Tuple[int, int, int]] = None
+        self.staged: Optional[PolicyTable] = None
+        self.active = self._defaults()
+        staged = self.poll()
+        if staged is not None:
+            self.activate()
+
+    def _defaults(self) -> PolicyTable:
+        return PolicyTable.from_mapping(
+            None,
+            scale=self._scale,
+            default_capacity=self._default_capacity,
+            default_rate=self._default_rate,
+            version="defaults",
+        )
+
+    def poll(self) -> Optional[PolicyTable]:
+        """Return the table waiting to be activated, if any (parses on file change)."""
+        sig = _stat_sig(self.path)
+        if sig == self._sig:
+            return self.staged
+        self._sig = sig
+        if sig is None:
+            table = self._defaults()
+        else:
+            with open(self.path, "rb") as f:
+                raw = f.read()
+            table = PolicyTable.from_mapping(
+                yaml.safe_load(raw),
+                scale=self._scale,
+                default_capacity=self._default_capacity,
+                default_rate=self._default_rate,
+                version=hashlib.sha1(raw).hexdigest()[:12],
+            )
+        self.staged = table if table.version != self.active.version else None
+        return self.staged
+
+    def activate(self) -> PolicyTable:
+        if self.staged is not None:
+            self.active, self.staged = self.staged, None
+        return self.active
+
+    async def activate_when_due(self, r, *, delay: float, key_prefix: str) -> Optional[PolicyTable]:
+        """
+        Poll, then activate a staged table at a shared instant: the first
+        process to see a version stores its activation time in Redis `r`
+        (SET NX) and every process switches once that time passes, or at once
+        if it loads the file later than that. Returns the table it activated.
+        """
+        staged = self.poll()
+        if staged is None:
+            return None
+        if delay > 0 and r is not None:
+            key = f"{key_prefix}:{staged.version}"
+            try:
+                await r.set(key, int((time.time() + delay) * 1000), nx=True, ex=int(delay) + 600)
+                activate_at_ms = int(await r.get(key) or 0)
+            except Exception:
+                activate_at_ms = 0  # Redis unreachable: don't hold the new policy back
+            if time.time() * 1000 < activate_at_ms:
+                return None
+        return self.activate()
@@ -0,0 +1,177 @@
+from __future__ import annotations
+import json
+import math
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import redis.asyncio as redis
+
+
+class ResourceRegistry:
+    """
+    What /admin/resources reports, kept by the replicas instead of found by
+    scanning buckets. Each replica tallies decisions locally and writes them
+    in one pipeline per flush:
+
+      <key>                    hash resource -> config JSON (only when it changes)
+      <key>:seen               hash resource -> last decision (ms)
+      <key>:allow|deny:<min>   hash resource -> decisions in that minute
+      <key>:live:{res}:<win>   HyperLogLog of users whose bucket was charged in
+                               that window; their union over `ttl_seconds`
+                               approximates the live bucket count
+
+    Resource names come from clients, so every local table is bounded. `key`
+    must lie outside the bucket namespace, or clients could name these keys.
+    """
+
+    def __init__(
+        self,
+        writer: redis.Redis,
+        reader: redis.Redis,
+        *,
+        key: str,
+        scale: int,
+        ttl_seconds: int,
+        max_resources: int = 10_000,
+        max_users: int = 100_000,
+        on_flush: Optional[Callable[[float], None]] = None,
+        now: Callable[[], float] = time.time,
+    ):
+        self._r = writer
+        self._rr = reader
+        self.key = key
+        self._scale = scale
+        self._ttl = ttl_seconds
+        self._max_resources = max_resources
+        self._max_users = max_users
+        self._on_flush = on_flush  # seconds spent in the flush pipeline
+        self._now = now
+        self.live_window_seconds = max(60, math.ceil(ttl_seconds / 6))
+        self.live_windows = math.ceil(ttl_seconds / self.live_window_seconds) + 1
+        self._published: Dict[str, Tuple[int, int]] = {}
+        self._pending: Dict[str, Tuple[int, int]] = {}
+        self._counts: Dict[str, List[int]] = {}   # resource -> [allows, denies] since the last flush
+        self._users: Dict[str, Set[str]] = {}     # resource -> users charged since the last flush
+        self._users_noted = 0
+
+    def note_cfg(self, resource: str, capacity: int, rate_subtokens_per_sec: int) -> None:
+        cfg = (capacity, rate_subtokens_per_sec)
+        if self._published.get(resource) != cfg:
+            if len(self._published) >= self._max_resources:
+                self._published.clear()
+            self._published[resource] = cfg
+            self._pending[resource] = cfg
+
+    def note_decision(self, resource: str, user_id: str, allowed: bool) -> None:
+        counts = self._counts.get(resource)
+        if counts is None:
+            if len(self._counts) >= self._max_resources:
+                return
+            counts = self._counts[resource] = [0, 0]
+        if allowed:
+            counts[0] += 1
+            if self._users_noted < self._max_users:
+                users = self._users.setdefault(resource, set())
+                if user_id not in users:
+                    users.add(user_id)
+                    self._users_noted += 1
+        else:
+            counts[1] += 1
+
+    def live_key(self, resource: str, window: int) -> str:
+        # The resource is the hash tag so one resource's windows share a Cluster slot
+        return f"{self.key}:live:{{{resource}}}:{window}"
+
+    def _cfg_json(self, capacity: int, rate: int) -> dict:
+        return {"capacity": capacity, "rate_subtokens_per_sec": rate, "scale": self._scale}
+
+    async def flush(self) -> None:
+        if not (self._pending or self._counts):
+            return
+        pending, self._pending = self._pending, {}
+        counts, self._counts = self._counts, {}
+        users, self._users = self._users, {}
+        self._users_noted = 0
+
+        now = self._now()
+        minute = int(now // 60)
+        window = int(now // self.live_window_seconds)
+        pipe = self._r.pipeline(transaction=False)
+        if pending:
+            pipe.hset(self.key, mapping={res: json.dumps(self._cfg_json(*cfg)) for res, cfg in pending.items()})
+        if counts:
+            pipe.hset(f"{self.key}:seen", mapping={res: int(now * 1000) for res in counts})
+            for kind, i in (("allow", 0), ("deny", 1)):
+                key = f"{self.key}:{kind}:{minute}"
+                for res, c in counts.items():
+                    if c[i]:
+                        pipe.hincrby(key, res, c[i])
+                pipe.expire(key, 180)
+        for res, members in users.items():
+            key = self.live_key(res, window)
+            pipe.pfadd(key, *members)
+            pipe.expire(key, self._ttl + self.live_window_seconds)
+        t0 = time.perf_counter()
+        try:
+            await pipe.execute()
+        except Exception:
+            # Config must eventually land; a lost interval of stats is tolerable
+            for res, cfg in pending.items():
+                self._pending.setdefault(res, cfg)
+            raise
+        finally:
+            if self._on_flush is not None:
+                self._on_flush(time.perf_counter() - t0)
+
+    async def resources(self, default_cfg: Callable[[str], Tuple[int, int]]) -> Dict[str, dict]:
+        """
+        Every resource seen by any replica: config, last decision, approximate
+        live buckets and allow/deny rates over the last complete minute. This
+        replica's unflushed tallies are merged in, so its own recent traffic
+        shows up at once. `default_cfg` gives (capacity, rate) for a resource
+        whose config was never published.
+        """
+        now = self._now()
+        last_minute = int(now // 60) - 1
+        pipe = self._rr.pipeline(transaction=False)
+        pipe.hgetall(self.key)
+        pipe.hgetall(f"{self.key}:seen")
+        pipe.hgetall(f"{self.key}:allow:{last_minute}")
+        pipe.hgetall(f"{self.key}:deny:{last_minute}")
+        try:
+            cfgs, seen, allows, denies = await pipe.execute()
+        except Exception:
+            cfgs, seen, allows, denies = {}, {}, {}, {}
+
+        last_seen: Dict[str, Optional[float]] = {k.decode(): int(v) / 1000.0 for k, v in seen.items()}
+        for res in self._counts:
+            last_seen[res] = now
+        configs = {k.decode(): json.loads(v) for k, v in cfgs.items()}
+        for res, cfg in self._published.items():
+            configs.setdefault(res, self._cfg_json(*cfg))
+
+        names = sorted(set(configs) | set(last_seen))
+        active = [res for res in names if res in last_seen]
+        live: Dict[str, int] = {}
+        if active:
+            window = int(now // self.live_window_seconds)
+            pipe = self._rr.pipeline(transaction=False)
+            for res in active:
+                pipe.pfcount(*(self.live_key(res, window - i) for i in range(self.live_windows)))
+            try:
+                live = dict(zip(active, await pipe.execute()))
+            except Exception:
+                pass
+
+        out = {}
+        for res in names:
+            cfg = configs.get(res) or self._cfg_json(*default_cfg(res))
+            out[res] = {
+                "capacity": cfg["capacity"],
+                "refill_rate_per_sec": round(cfg["rate_subtokens_per_sec"] / cfg["scale"], 6),
+                "last_seen": last_seen.get(res),
+                "live_buckets": live.get(res, 0),
+                "allow_per_sec": round(int(allows.get(res.encode(), 0)) / 60.0, 3),
+                "deny_per_sec": round(int(denies.get(res.encode(), 0)) / 60.0, 3),
+            }
+        return out
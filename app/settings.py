@@ -1,18 +1,112 @@
+from typing import List
 from pydantic_settings import BaseSettings
 from pydantic import Field
 
 class Settings(BaseSettings):
     REDIS_URL: str = Field(default="redis://redis:6379/0")
+    BACKEND: str = Field(default="redis")   # redis | memory (single-process, no Redis)
+    # single: everything on REDIS_URL; cluster: REDIS_URL is a Redis Cluster seed;
+    # ring: buckets hashed over REDIS_URLS (JSON list), REDIS_URL keeps admin/offender data
+    REDIS_MODE: str = Field(default="single")
+    REDIS_URLS: List[str] = Field(default_factory=list)
+    # Admin/observability reads (/admin/*, /peek, the active_keys SCAN) use a separate pool,
+    # on this replica of REDIS_URL when set (single and ring modes; cluster reads its replicas)
+    REDIS_REPLICA_URL: str = ""
+    READ_MAX_CONNECTIONS: int = 16
     BUCKET_KEY_FMT: str = Field(default="rl:{user}:{resource}")
+    # hash of resource -> JSON config, written once per resource (buckets only store tokens);
+    # also prefixes the registry keys, so keep it outside what BUCKET_KEY_FMT can produce
+    RESOURCES_KEY: str = Field(default="rlmeta:resources")
+    # per-owner ZSET of bucket key -> expiry kept by the scripts, read by /admin/user
+    # ("" = off, SCAN instead). Sharded modes need the same {user} hash tag as BUCKET_KEY_FMT.
+    USER_INDEX_KEY_FMT: str = Field(default="rlidx:{user}")
 
     OFFENDERS_ZSET: str = Field(default="rate:top_offenders")
     OFFENDERS_BUCKET_PREFIX: str = Field(default="rate:top_offenders")
 
+    # Per-resource limits (see app/policy.py); polled for changes, missing file = defaults only
+    POLICY_PATH: str = "/config/policy.yaml"
+    POLICY_RELOAD_SECONDS: float = 2.0
+    # a new version is activated by every replica at the same wall-clock instant,
+    # this long after the first replica sees it (0 = switch as soon as loaded)
+    POLICY_SWITCH_DELAY_SECONDS: float = 10.0
+    POLICY_ACTIVATE_KEY_PREFIX: str = "policy:activate"
+
     DEFAULT_CAPACITY: int = 10
     DEFAULT_RATE_TOKENS_PER_SEC: float = 5.0
     SCALE: int = 10_000
     TTL_SECONDS: int = 3600          # 1 hour idle cleanup
     IDEM_TTL_SECONDS: int = 60       # 60s to de-dup client retries
+    # Also answer from idempotency records in the old idem:{user}:{resource}:{id}
+    # layout (single mode only); new records are always written next to the bucket.
+    # Safe to turn off once IDEM_TTL_SECONDS have passed since every replica was upgraded.
+    IDEM_LEGACY_READ: bool = True
+    BATCH_MAX_ITEMS: int = 100       # upper bound for POST /allow/batch
+
+    # active_keys gauge: background SCAN, bounded keys examined per tick
+    ACTIVE_KEYS_SAMPLE_INTERVAL_SECONDS: float = 1.0
+    ACTIVE_KEYS_SCAN_BUDGET: int = 10_000
+
+    # Local deny cache: answer 429s until Retry-After minus a safety margin
+    DENY_CACHE_ENABLED: bool = True
+    DENY_CACHE_MAX_ENTRIES: int = 100_000
+    DENY_CACHE_MARGIN_MS: int = 5
+    DENY_CACHE_MAX_TTL_MS: int = 5_000
+    OFFENDERS_FLUSH_SECONDS: float = 1.0   # offender counts decided outside limiter.lua
+    OFFENDERS_ROLLUP_SECONDS: float = 15.0   # folds closed minutes into hours, hours into days
+    TOP_OFFENDERS_CACHE_SECONDS: float = 5.0   # /admin/top_offenders result cache per query
+    RESOURCE_STATS_FLUSH_SECONDS: float = 10.0   # resource registry writes per replica (/admin/resources)
+
+    # /admin/top_consumers: per-replica Space-Saving sketch of tokens charged per (user, resource),
+    # merged into Redis every CONSUMERS_FLUSH_SECONDS (0 entries = off). Like RESOURCES_KEY,
+    # the prefix must stay outside what BUCKET_KEY_FMT can produce.
+    CONSUMERS_SKETCH_SIZE: int = 1_000
+    CONSUMERS_FLUSH_SECONDS: float = 10.0
+    CONSUMERS_KEY_PREFIX: str = "rlmeta:consumers"
+
+    # Token leasing (opt-in per resource, JSON list in env: '["search","feed"]')
+    LEASE_RESOURCES: List[str] = Field(default_factory=list)
+    LEASE_TTL_MS: int = 1_000        # unused leased tokens go back to Redis after this
+    LEASE_MIN_TOKENS: int = 1
+    LEASE_MAX_TOKENS: int = 100
+
+    MEMORY_EVICT_BUDGET: int = 50_000     # BACKEND=memory: idle buckets dropped per sweep
+
+    # Binary /allow listener for sidecars (app/binary_server.py); off unless a path or port is set
+    BINARY_UDS_PATH: str = ""
+    BINARY_TCP_HOST: str = "127.0.0.1"
+    BINARY_TCP_PORT: int = 0
+    BINARY_MAX_INFLIGHT: int = 128   # pipelined requests decided concurrently per connection
+
+    # Script calls from concurrent requests (any keys) are sent as one Redis pipeline per
+    # event-loop tick, or after PIPELINE_MAX_DELAY_MS, or once PIPELINE_MAX_BATCH are queued.
+    # Single and ring modes; cluster clients send each call on its own.
+    PIPELINE_ENABLED: bool = True
+    PIPELINE_MAX_BATCH: int = 128
+    PIPELINE_MAX_DELAY_MS: float = 0.0
+
+    # Latency budget + circuit breaker per Redis node (app/breaker.py), opt-in. Script calls over
+    # budget or failing to connect are decided locally; after BREAKER_FAILURE_THRESHOLD in a row the
+    # node is skipped for BREAKER_RESET_SECONDS before a probe. Every replica decides on its own,
+    # so local buckets get BREAKER_LOCAL_SHARE of each capacity and rate: set it to 1 / replica
+    # count, or the fleet grants up to replicas x the limit while Redis is cut off. At most
+    # BREAKER_MAX_DEBTS buckets' local spend is remembered for reconciling afterwards.
+    BREAKER_ENABLED: bool = False
+    BREAKER_BUDGET_MS: float = 50.0
+    BREAKER_FAILURE_THRESHOLD: int = 5
+    BREAKER_RESET_SECONDS: float = 2.0
+    BREAKER_LOCAL_SHARE: float = 1.0
+    BREAKER_MAX_DEBTS: int = 100_000
+
+    # Concurrent /allow calls on the same bucket share one script call (app/coalesce.py);
+    # a window > 0 holds the first call that long to gather more (adds latency)
+    COALESCE_ENABLED: bool = True
+    COALESCE_WINDOW_MS: float = 0.0
+    COALESCE_MAX_BATCH: int = 64
+
+    # Server-Timing response header (redis/app/total) on every request; off by default
+    # since it exposes backend timing to clients
+    SERVER_TIMING_ENABLED: bool = False
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,160 @@
+from __future__ import annotations
+import asyncio
+import bisect
+import hashlib
+from typing import Callable, Dict, Hashable, List, Sequence, Tuple
+from urllib.parse import urlparse
+
+import redis.asyncio as redis
+from redis.crc import key_slot
+
+from app.lua_limiter_async import AsyncLuaLimiter, BatchItem, OffenderKey
+
+def hash_tag(key: str) -> str:
+    """The part of `key` Redis Cluster hashes: the first non-empty {...}, else the whole key."""
+    start = key.find("{")
+    if start != -1:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+def node_name(url: str) -> str:
+    """Stable ring identity for a Redis URL (credentials and options stripped)."""
+    u = urlparse(url)
+    return f"{u.hostname}:{u.port or 6379}{u.path or '/0'}"
+
+def _hash64(s: str) -> int:
+    return int.from_bytes(hashlib.md5(s.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent-hash ring over independent Redis nodes.
+
+    Keys are placed by their hash tag, so "rl:{alice}:read" and
+    "idem:rl:{alice}:read:x" always land on the same node. Adding or removing
+    a node only moves the keys on the arcs it gains or loses (~1/N of them).
+    """
+
+    def __init__(self, nodes: Sequence[str], vnodes: int = 160):
+        if not nodes:
+            raise ValueError("HashRing needs at least one node")
+        points = sorted((_hash64(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [n for _, n in points]
+
+    def node_for(self, key: str) -> str:
+        i = bisect.bisect(self._hashes, _hash64(hash_tag(key)))
+        return self._nodes[i % len(self._nodes)]
+
+
+# locate(bucket_key) -> (group, limiter). Keys in one group may share a script
+# call (same node, and same slot under Redis Cluster).
+Locator = Callable[[str], Tuple[Hashable, AsyncLuaLimiter]]
+
+
+class ShardedLuaLimiter:
+    """
+    AsyncLuaLimiter facade that routes each call to the shard owning its bucket.
+
+    allow() and lease() touch one key and go straight to its shard. allow_many()
+    runs one script call per group concurrently; with all_or_nothing each group
+    is atomic on its own and, if any group denies, the groups that were charged
+    are refunded through the lease script. Between charge and refund those
+    buckets are briefly lower than they should be, never higher.
+    """
+
+    def __init__(self, locate: Locator, limiters: Sequence[AsyncLuaLimiter]):
+        self._locate = locate
+        self.limiters = list(limiters)
+
+    async def load(self) -> None:
+        await asyncio.gather(*(lim.load() for lim in self.limiters))
+
+    def client_for(self, key: str) -> redis.Redis:
+        """The Redis client owning `key` (the cluster client under Redis Cluster)."""
+        return self._locate(key)[1].r
+
+    async def allow(self, *, bucket_key: str, **kwargs) -> Tuple[bool, float, float, bool]:
+        return await self._locate(bucket_key)[1].allow(bucket_key=bucket_key, **kwargs)
+
+    async def lease(self, *, bucket_key: str, **kwargs) -> Tuple[int, float, float]:
+        return await self._locate(bucket_key)[1].lease(bucket_key=bucket_key, **kwargs)
+
+    async def allow_many(
+        self,
+        items: Sequence[BatchItem],
+        *,
+        scale: int,
+        ttl_seconds: int,
+        all_or_nothing: bool = False,
+        offender_keys: Sequence[OffenderKey] = (),
+    ) -> List[Tuple[bool, float, float, bool]]:
+        groups: Dict[Hashable, Tuple[AsyncLuaLimiter, List[int]]] = {}
+        for i, item in enumerate(items):
+            group, lim = self._locate(item[0])
+            groups.setdefault(group, (lim, []))[1].append(i)
+
+        parts = list(groups.values())
+        results = await asyncio.gather(*(
+            lim.allow_many(
+                [items[i] for i in idx],
+                scale=scale,
+                ttl_seconds=ttl_seconds,
+                all_or_nothing=all_or_nothing,
+                offender_keys=offender_keys,
+            )
+            for lim, idx in parts
+        ))
+
+        out: List[Tuple[bool, float, float, bool]] = [None] * len(items)  # type: ignore[list-item]
+        for (_, idx), res in zip(parts, results):
+            for i, decision in zip(idx, res):
+                out[i] = decision
+
+        if all_or_nothing and len(parts) > 1 and not all(d[0] for d in out):
+            refunds = []
+            for (lim, idx), res in zip(parts, results):
+                if not all(d[0] for d in res):
+                    continue  # denied groups rolled themselves back
+                for i in idx:
+                    bucket_key, capacity_tokens, rate_subtokens_per_sec, cost_tokens, *_ = items[i]
+                    refunds.append(lim.lease(
+                        bucket_key=bucket_key,
+                        capacity_tokens=capacity_tokens,
+                        rate_subtokens_per_sec=rate_subtokens_per_sec,
+                        scale=scale,
+                        ttl_seconds=ttl_seconds,
+                        return_tokens=cost_tokens,
+                    ))
+                    _, _, remaining, _ = out[i]
+                    out[i] = (False, 0.0, min(remaining + cost_tokens, capacity_tokens), False)
+            await asyncio.gather(*refunds)
+        return out
+
+
+def ring_limiter(
+    urls: Sequence[str],
+    make_limiter: Callable[[redis.Redis], AsyncLuaLimiter],
+) -> Tuple[ShardedLuaLimiter, List[redis.Redis]]:
+    """Client-side consistent hashing over independent Redis URLs."""
+    clients = {node_name(url): redis.from_url(url, decode_responses=False) for url in urls}
+    shards = {name: make_limiter(c) for name, c in clients.items()}
+    ring = HashRing(list(shards))
+
+    def locate(bucket_key: str) -> Tuple[Hashable, AsyncLuaLimiter]:
+        name = ring.node_for(bucket_key)
+        return name, shards[name]
+
+    return ShardedLuaLimiter(locate, list(shards.values())), list(clients.values())
+
+
+def cluster_limiter(rc: redis.RedisCluster, make_limiter: Callable[[redis.Redis], AsyncLuaLimiter]) -> ShardedLuaLimiter:
+    """Redis Cluster routes single-slot calls itself; batches are split per slot."""
+    lim = make_limiter(rc)
+
+    def locate(bucket_key: str) -> Tuple[Hashable, AsyncLuaLimiter]:
+        return key_slot(bucket_key.encode("utf-8")), lim
+
+    return ShardedLuaLimiter(locate, [lim])
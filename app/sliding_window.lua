@@ -0,0 +1,133 @@
+-- Sliding-window counter: at most `limit` tokens per rolling window, for long
+-- quotas (per hour, per day) that a token bucket would need a huge capacity
+-- and a tiny refill rate for. A key holds two counters, the current fixed
+-- window's and the previous one's; the previous count is weighted by how much
+-- of it still overlaps the rolling window ending now:
+--
+--   estimate = prev * (window - elapsed_in_current) / window + cur
+--
+-- State is one string "window_index:cur:prev", expiring once both counters
+-- are out of range (end of the next window). O(1) memory per key whatever the
+-- window length. Token-bucket/GCRA state on the key is not converted: a
+-- resource switching to or from this algorithm starts from an empty window.
+--
+-- KEYS and the return value are identical to limiter.lua. ARGV too, except:
+--   [1] limit                        (int)   -- tokens per window
+--   [2] window_ms                    (int)
+--   [5] ttl_seconds                  unused
+
+local bucket_key = KEYS[1]
+local idem_key   = KEYS[2] ~= bucket_key and KEYS[2] or nil
+
+local limit            = tonumber(ARGV[1])
+local window_ms        = tonumber(ARGV[2])
+local cost_tokens      = tonumber(ARGV[3])
+local SCALE            = tonumber(ARGV[4])
+local idem_ttl_seconds = tonumber(ARGV[6])
+local offender_member  = ARGV[7]
+
+-- Count a deny against every offender ZSET in the same execution
+local function record_offense()
+    for i = 4, #KEYS do
+        redis.call('ZINCRBY', KEYS[i], 1, offender_member)
+        local ttl = tonumber(ARGV[i + 4])
+        if ttl and ttl > 0 then
+            redis.call('EXPIRE', KEYS[i], ttl)
+        end
+    end
+end
+
+-- If idempotency key exists, return cached result immediately
+if idem_key then
+    local cached = redis.call('GET', idem_key)
+    if cached then
+        -- cached is "allowed,retry_after_ms,remaining_subtokens"
+        local parts = {}
+        for s in string.gmatch(cached, '([^,]+)') do table.insert(parts, s) end
+        local allowed = tonumber(parts[1])
+        if allowed == 0 then
+            record_offense()
+        end
+        return { allowed, tostring(tonumber(parts[2]) / 1000.0), tostring(tonumber(parts[3]) / SCALE), 1 }
+    end
+end
+
+if window_ms <= 0 then
+    return redis.error_reply('sliding_window needs window_ms > 0')
+end
+
+local now_time = redis.call('TIME')
+local now_ms = (tonumber(now_time[1]) * 1000) + math.floor(tonumber(now_time[2]) / 1000)
+
+-- Keep the bucket in its owner's index ZSET (KEYS[3]), as limiter.lua does
+local function index_bucket(expires_ms)
+    local index_key = KEYS[3]
+    if not index_key or index_key == bucket_key then
+        return
+    end
+    if redis.call('ZADD', index_key, expires_ms, bucket_key) == 1 then
+        redis.call('ZREMRANGEBYSCORE', index_key, '-inf', now_ms)
+    end
+    if redis.call('PTTL', index_key) < expires_ms - now_ms then
+        redis.call('PEXPIREAT', index_key, expires_ms)
+    end
+end
+
+local idx = math.floor(now_ms / window_ms)
+local elapsed_ms = now_ms - idx * window_ms
+
+local cur, prev = 0, 0
+local raw = redis.pcall('GET', bucket_key)
+if type(raw) == 'string' then
+    local w, c, p = string.match(raw, '^(%d+):(%d+):(%d+)$')
+    if w then
+        w = tonumber(w)
+        if w == idx then
+            cur, prev = tonumber(c), tonumber(p)
+        elseif w == idx - 1 then
+            prev = tonumber(c)
+        end
+    end
+end
+
+local weight = (window_ms - elapsed_ms) / window_ms
+local estimate = prev * weight + cur
+
+local allowed = 0
+local retry_after_ms = 0
+if estimate + cost_tokens <= limit then
+    allowed = 1
+    if cost_tokens > 0 then
+        cur = cur + cost_tokens
+        estimate = estimate + cost_tokens
+        local px = 2 * window_ms - elapsed_ms
+        redis.call('SET', bucket_key, string.format('%d:%d:%d', idx, cur, prev), 'PX', px)
+        index_bucket(now_ms + px)
+    end
+else
+    if cost_tokens > limit then
+        retry_after_ms = 2^31 - 1 -- never fits
+    elseif cur + cost_tokens <= limit then
+        -- Only the fading previous window is in the way
+        local fits_at = window_ms - (limit - cur - cost_tokens) * window_ms / prev
+        retry_after_ms = math.max(1, math.ceil(fits_at - elapsed_ms))
+    else
+        -- Wait for the next window, where this window's count starts fading
+        local fits_at = window_ms - (limit - cost_tokens) * window_ms / cur
+        retry_after_ms = math.ceil(window_ms - elapsed_ms + math.max(0, fits_at))
+    end
+    record_offense()
+end
+
+local remaining_subtokens = math.floor((limit - estimate) * SCALE)
+if remaining_subtokens < 0 then
+    remaining_subtokens = 0
+end
+
+-- Cache idempotent result if requested
+if idem_key then
+    local value = tostring(allowed) .. ',' .. tostring(retry_after_ms) .. ',' .. tostring(remaining_subtokens)
+    redis.call('SET', idem_key, value, 'EX', idem_ttl_seconds)
+end
+
+return { allowed, tostring(retry_after_ms / 1000.0), tostring(remaining_subtokens / SCALE), 0 }
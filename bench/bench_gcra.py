@@ -0,0 +1,81 @@
+"""
+Token bucket (limiter.lua) vs GCRA (gcra.lua): throughput and memory per key.
+
+Runs the same allow() workload through AsyncLuaLimiter against a live Redis
+with each engine, then samples MEMORY USAGE over the keys it created.
+
+    REDIS_URL=redis://localhost:6379/0 python -m bench.bench_gcra --ops 50000 --keys 10000
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import redis.asyncio as redis
+
+from app.lua_limiter_async import AsyncLuaLimiter
+
+SCALE = 10_000
+
+
+def _read_lua(name: str) -> str:
+    with open(os.path.join(os.path.dirname(__file__), "..", "app", name), "r") as f:
+        return f.read()
+
+
+async def run_engine(r: redis.Redis, limiter: AsyncLuaLimiter, algorithm: str, ops: int, keys: int, concurrency: int) -> dict:
+    prefix = f"bench:{algorithm}:{os.getpid()}"
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> None:
+        async with sem:
+            await limiter.allow(
+                bucket_key=f"{prefix}:{i % keys}",
+                capacity_tokens=10,
+                rate_subtokens_per_sec=5 * SCALE,
+                cost_tokens=1,
+                scale=SCALE,
+                ttl_seconds=3600,
+                algorithm=algorithm,
+            )
+
+    await asyncio.gather(*(one(i) for i in range(min(ops, 1000))))  # warm-up
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(ops)))
+    took = time.perf_counter() - t0
+
+    sample = [f"{prefix}:{i}" for i in range(0, keys, max(1, keys // 500))]
+    sizes = [await r.memory_usage(k) or 0 for k in sample]
+    async for k in r.scan_iter(match=f"{prefix}:*", count=1000):
+        await r.unlink(k)
+    return {
+        "ops_per_sec": round(ops / took),
+        "bytes_per_key": round(sum(sizes) / max(len(sizes), 1), 1),
+    }
+
+
+async def main_async(args) -> dict:
+    r = redis.from_url(args.redis_url, decode_responses=False)
+    limiter = AsyncLuaLimiter(r, _read_lua("limiter.lua"), gcra_script_text=_read_lua("gcra.lua"))
+    await limiter.load()
+    out = {"ops": args.ops, "keys": args.keys, "concurrency": args.concurrency}
+    for algorithm in ("token_bucket", "gcra"):
+        out[algorithm] = await run_engine(r, limiter, algorithm, args.ops, args.keys, args.concurrency)
+    await r.aclose()
+    return out
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--redis-url", default=os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    ap.add_argument("--ops", type=int, default=50_000)
+    ap.add_argument("--keys", type=int, default=10_000)
+    ap.add_argument("--concurrency", type=int, default=64)
+    args = ap.parse_args()
+    print(json.dumps(asyncio.run(main_async(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+"""
+End-to-end load test of POST /allow against the README SLOs.
+
+Drives app.app_async:app in-process over ASGI (no sockets), behind a real
+uvicorn process over HTTP, and/or through the binary sidecar listener on a
+Unix socket (--mode binary: the same decisions without HTTP), against a
+Redis at --redis-url or a throwaway local redis-server (--start-redis). The workload mixes fresh
+users (key cardinality), a few drained hot users (deny ratio) and idempotency
+keys (idempotency ratio); the seed makes the request sequence reproducible.
+
+Reports throughput, p50/p99/p999 and Redis commands per decision (INFO
+commandstats delta on REDIS_URL), and prints one JSON document; --out
+appends it as a JSON line so runs can be compared across commits.
+
+    python -m bench.bench_load --start-redis --requests 20000 --keys 10000 \\
+        --deny-ratio 0.1 --idem-ratio 0.05 --concurrency 64 --mode asgi,uvicorn,binary \\
+        --out bench/results.jsonl --check-slo
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+import redis.asyncio as redis
+
+# README goals: p99 < 10ms in-memory, < 25ms with Redis
+SLO_P99_MS = {"memory": 10.0, "redis": 25.0}
+
+# Never denies at bench rates vs. one token then nothing: every request to it is a deny
+POLICY_YAML = """\
+version: bench
+resources:
+  - {name: bench, capacity: 1000000, rate_tokens_per_sec: 1000000}
+  - {name: bench-deny, capacity: 1, rate_tokens_per_sec: 0}
+"""
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _git_sha() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def start_redis() -> tuple:
+    """Launch a persistence-free redis-server on a free port: (process, url)."""
+    exe = shutil.which("redis-server")
+    if exe is None:
+        sys.exit("redis-server not found on PATH (or pass --redis-url)")
+    port = _free_port()
+    proc = subprocess.Popen(
+        [exe, "--port", str(port), "--save", "", "--appendonly", "no"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 5.0
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return proc, f"redis://127.0.0.1:{port}/0"
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    sys.exit("redis-server did not start")
+
+
+def build_workload(args) -> List[dict]:
+    """The query params of every request, warm-up first, from --seed."""
+    rng = random.Random(args.seed)
+    out = []
+    for _ in range(args.warmup + args.requests):
+        params = {"user_id": f"bench-{rng.randrange(args.keys)}", "resource": "bench", "cost": 1}
+        if rng.random() < args.deny_ratio:
+            # a few hot users, drained by their first request
+            params = {"user_id": f"hot-{rng.randrange(16)}", "resource": "bench-deny", "cost": 1}
+        if rng.random() < args.idem_ratio:
+            # a small pool per user, so some of these are replays served from the cache
+            params["idempotency"] = f"idem-{rng.randrange(4)}"
+        out.append(params)
+    return out
+
+
+async def redis_calls(url: str) -> Dict[str, int]:
+    r = redis.from_url(url)
+    try:
+        stats = await r.info("commandstats")
+    finally:
+        await r.aclose()
+    return {k.replace("cmdstat_", ""): int(v["calls"]) for k, v in stats.items()}
+
+
+def percentile(sorted_ms: List[float], q: float) -> float:
+    idx = min(len(sorted_ms) - 1, max(0, int(round(q * len(sorted_ms) + 0.5)) - 1))
+    return round(sorted_ms[idx], 3)
+
+
+def http_sender(client: httpx.AsyncClient) -> Callable[[dict], Awaitable[int]]:
+    async def send(params: dict) -> int:
+        return (await client.post("/allow", params=params)).status_code
+    return send
+
+def binary_sender(clients: list) -> Callable[[dict], Awaitable[int]]:
+    """Round-robin over pipelined binary connections; statuses mapped to their HTTP codes."""
+    from app.binary_server import ALLOWED, DENIED, REJECTED
+    codes = {ALLOWED: 200, DENIED: 429, REJECTED: 400}
+    turn = itertools.cycle(clients)
+
+    async def send(params: dict) -> int:
+        status = (await next(turn).allow(**params))[0]
+        return codes.get(status, 500)
+    return send
+
+async def drive(send: Callable[[dict], Awaitable[int]], workload: List[dict], concurrency: int) -> dict:
+    """Send workload with `concurrency` closed-loop workers."""
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    it = iter(workload)
+
+    async def worker() -> None:
+        for params in it:
+            t0 = time.perf_counter_ns()
+            status = await send(params)
+            latencies.append((time.perf_counter_ns() - t0) / 1_000_000.0)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - t0
+
+    latencies.sort()
+    n = len(latencies)
+    return {
+        "requests": n,
+        "throughput_rps": round(n / wall, 1),
+        "p50_ms": percentile(latencies, 0.50),
+        "p99_ms": percentile(latencies, 0.99),
+        "p999_ms": percentile(latencies, 0.999),
+        "max_ms": round(latencies[-1], 3),
+        "status": {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+async def run_asgi(args, workload: List[dict]) -> dict:
+    from app.app_async import app, logger
+
+    # Access/decision logs are still formatted and written, just not to the terminal
+    devnull = open(os.devnull, "w")
+    for h in logger.handlers:
+        if isinstance(h, logging.StreamHandler):
+            h.setStream(devnull)
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            return await measure(args, http_sender(client), workload)
+
+
+async def run_binary(args, workload: List[dict]) -> dict:
+    """The sidecar listener over a Unix socket, started by the app's lifespan."""
+    from app.app_async import app, logger
+    from app.binary_server import BinaryAllowClient
+    from app.settings import settings
+
+    devnull = open(os.devnull, "w")
+    for h in logger.handlers:
+        if isinstance(h, logging.StreamHandler):
+            h.setStream(devnull)
+    async with app.router.lifespan_context(app):
+        clients = [await BinaryAllowClient.connect(uds_path=settings.BINARY_UDS_PATH) for _ in range(args.connections)]
+        try:
+            return await measure(args, binary_sender(clients), workload)
+        finally:
+            for c in clients:
+                await c.close()
+
+
+async def run_uvicorn(args, workload: List[dict], env: Dict[str, str]) -> dict:
+    port = _free_port()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.app_async:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(args.workers), "--log-level", "warning", "--no-access-log"],
+        env={**os.environ, **env},
+        stderr=subprocess.DEVNULL,  # the app logs every decision there
+    )
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=10.0) as client:
+            deadline = time.monotonic() + 15.0
+            while True:
+                try:
+                    if (await client.get("/readyz")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if time.monotonic() > deadline or proc.poll() is not None:
+                    raise RuntimeError("uvicorn did not become ready")
+                await asyncio.sleep(0.1)
+            return await measure(args, http_sender(client), workload)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+async def measure(args, send: Callable[[dict], Awaitable[int]], workload: List[dict]) -> dict:
+    await drive(send, workload[:args.warmup], args.concurrency)
+    measured = workload[args.warmup:]
+    before = await redis_calls(args.redis_url) if args.backend == "redis" else None
+    result = await drive(send, measured, args.concurrency)
+    if before is not None:
+        after = await redis_calls(args.redis_url)
+        # includes background work (flushers, active_keys SCAN) over the run
+        delta = {k: after.get(k, 0) - before.get(k, 0) for k in after}
+        delta = {k: v for k, v in sorted(delta.items(), key=lambda kv: -kv[1]) if v > 0}
+        result["redis_commands_per_decision"] = round(sum(delta.values()) / len(measured), 3)
+        result["redis_commands"] = delta
+    slo = SLO_P99_MS[args.backend]
+    result["slo_p99_ms"] = slo
+    result["slo_ok"] = result["p99_ms"] < slo
+    return result
+
+
+async def main_async(args) -> dict:
+    workload = build_workload(args)
+    out = {
+        "git_sha": _git_sha(),
+        "ts": time.time(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("out", "check_slo", "start_redis", "policy_path", "uds_path")},
+    }
+    if args.backend == "redis":
+        r = redis.from_url(args.redis_url)
+        await r.flushdb()
+        await r.aclose()
+    env = {
+        "BACKEND": args.backend,
+        "REDIS_URL": args.redis_url,
+        "POLICY_PATH": args.policy_path,
+        "POLICY_SWITCH_DELAY_SECONDS": "0",
+        "DENY_CACHE_ENABLED": "false" if args.no_deny_cache else "true",
+        "BINARY_UDS_PATH": args.uds_path,
+    }
+    for mode in args.mode.split(","):
+        if mode == "asgi":
+            os.environ.update(env)  # read by app.settings at import
+            out["asgi"] = await run_asgi(args, workload)
+        elif mode == "binary":
+            os.environ.update(env)
+            out["binary"] = await run_binary(args, workload)
+        elif mode == "uvicorn":
+            out["uvicorn"] = await run_uvicorn(args, workload, env)
+        else:
+            raise SystemExit(f"unknown mode {mode!r} (asgi, uvicorn, binary)")
+        if args.backend == "redis":
+            r = redis.from_url(args.redis_url)
+            await r.flushdb()  # each mode starts from empty buckets
+            await r.aclose()
+    return out
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--mode", default="asgi", help="comma list of asgi, uvicorn, binary")
+    ap.add_argument("--backend", choices=("redis", "memory"), default="redis")
+    ap.add_argument("--redis-url", default=os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    ap.add_argument("--start-redis", action="store_true", help="run a throwaway redis-server on a free port")
+    ap.add_argument("--requests", type=int, default=20_000)
+    ap.add_argument("--warmup", type=int, default=1_000)
+    ap.add_argument("--keys", type=int, default=10_000, help="distinct user_ids")
+    ap.add_argument("--deny-ratio", type=float, default=0.1)
+    ap.add_argument("--idem-ratio", type=float, default=0.0)
+    ap.add_argument("--concurrency", type=int, default=64)
+    ap.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    ap.add_argument("--connections", type=int, default=4, help="binary mode: pipelined Unix socket connections")
+    ap.add_argument("--no-deny-cache", action="store_true", help="send every deny to Redis")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", help="append the result as one JSON line to this file")
+    ap.add_argument("--check-slo", action="store_true", help="exit 1 if any mode misses its p99 SLO")
+    args = ap.parse_args()
+
+    redis_proc = None
+    if args.start_redis and args.backend == "redis":
+        redis_proc, args.redis_url = start_redis()
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as f:
+        f.write(POLICY_YAML)
+        args.policy_path = f.name
+    args.uds_path = os.path.join(tempfile.gettempdir(), f"r8limiter-bench-{os.getpid()}.sock")
+    try:
+        out = asyncio.run(main_async(args))
+    finally:
+        os.unlink(args.policy_path)
+        if redis_proc is not None:
+            redis_proc.terminate()
+            redis_proc.wait(timeout=10)
+
+    print(json.dumps(out, indent=2))
+    if args.out:
+        with open(args.out, "a") as f:
+            f.write(json.dumps(out) + "\n")
+    if args.check_slo and not all(out[m]["slo_ok"] for m in args.mode.split(",")):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
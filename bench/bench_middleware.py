@@ -0,0 +1,123 @@
+"""
+Per-request overhead of the observability middleware.
+
+Drives a minimal Starlette app directly over ASGI (no HTTP client, no
+network) three ways: bare, behind the previous BaseHTTPMiddleware-based
+ObsMiddleware, and behind the pure-ASGI app.obs_middleware.ObsMiddleware.
+
+    python -m bench.bench_middleware --requests 20000
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+from prometheus_client import CollectorRegistry, Histogram
+from starlette.applications import Starlette
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from app.obs_middleware import ObsMiddleware
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def make_histogram() -> Histogram:
+    return Histogram("request_latency_seconds", "Latency", ["endpoint"],
+                     registry=CollectorRegistry(), buckets=BUCKETS)
+
+
+def make_logger() -> logging.Logger:
+    lg = logging.getLogger(f"bench.{uuid.uuid4().hex}")
+    lg.setLevel(logging.INFO)
+    lg.addHandler(logging.NullHandler())
+    lg.propagate = False
+    return lg
+
+
+class LegacyObsMiddleware(BaseHTTPMiddleware):
+    """The BaseHTTPMiddleware implementation ObsMiddleware replaced."""
+
+    def __init__(self, app, latency: Histogram, logger: logging.Logger):
+        super().__init__(app)
+        self.latency = latency
+        self.logger = logger
+
+    async def dispatch(self, request: Request, call_next):
+        start = time.monotonic_ns()
+        rid = request.headers.get("X-Request-ID") or str(uuid.uuid4())
+        request.state.request_id = rid
+        try:
+            return await call_next(request)
+        finally:
+            took_ms = (time.monotonic_ns() - start) / 1_000_000.0
+            self.latency.labels(endpoint=request.url.path).observe(took_ms / 1000.0)
+            self.logger.info(json.dumps({
+                "ts": time.time(),
+                "request_id": rid,
+                "method": request.method,
+                "path": request.url.path,
+                "status": getattr(request.state, "status_code", None),
+                "latency_ms": round(took_ms, 3),
+            }))
+
+
+async def allow(request: Request):
+    return JSONResponse({"allowed": True, "retry_after": 0.0, "tokens_left": 7.0})
+
+
+def build(variant: str):
+    app = Starlette(routes=[Route("/allow", allow, methods=["POST"])])
+    if variant == "legacy":
+        app.add_middleware(LegacyObsMiddleware, latency=make_histogram(), logger=make_logger())
+    elif variant == "asgi":
+        app.add_middleware(ObsMiddleware, latency=make_histogram(), logger=make_logger())
+    return app
+
+
+async def drive(app, n: int) -> float:
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": "/allow", "raw_path": b"/allow",
+        "query_string": b"user_id=a", "root_path": "",
+        "headers": [(b"host", b"bench")], "client": ("127.0.0.1", 1), "server": ("bench", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    for _ in range(min(n, 500)):  # warm-up
+        await app(dict(scope), receive, send)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--requests", type=int, default=20_000)
+    args = ap.parse_args()
+
+    results = {v: asyncio.run(drive(build(v), args.requests)) for v in ("bare", "legacy", "asgi")}
+    out = {
+        "requests": args.requests,
+        "us_per_request": {k: round(v, 2) for k, v in results.items()},
+        "overhead_us": {
+            "legacy": round(results["legacy"] - results["bare"], 2),
+            "asgi": round(results["asgi"] - results["bare"], 2),
+        },
+    }
+    print(json.dumps(out, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
 import asyncio
 import json
+import os
+
 import pytest
 
+APP_URL = os.getenv("APP_URL")
+
 @pytest.mark.anyio
 async def test_metrics_exposes_prometheus_text(client):
     r = await client.get("/metrics")
@@ -47,3 +51,229 @@ async def test_admin_stats_user_resources_and_offenders(client):
     assert "resources" in rd
     # Structure sanity: dict of resource -> object
     assert isinstance(rd["resources"], dict)
+
+@pytest.mark.anyio
+async def test_active_keys_sampler_counts_buckets(client, redis_client):
+    from app import app_async
+    await client.post("/allow", params={"user_id": "u_active", "resource": "r_active", "cost": 1})
+    # /allow no longer scans; the sampler finishes a pass within a few bounded ticks
+    cnt = None
+    for _ in range(10_000):
+        cnt = await app_async.count_active_keys(budget=10_000)
+        if cnt is not None:
+            break
+    assert cnt is not None and cnt >= 1
+    assert app_async.ACTIVE_KEYS_LAST == cnt
+
+@pytest.mark.anyio
+async def test_active_keys_pass_is_bounded_and_restarts_after_errors(monkeypatch):
+    from app import app_async
+    pages = [[b"rl:a:r"], [], [], [b"rl:b:r", b"rl:c:r"]]
+    calls = []
+    async def fake_pages(match, count, fail_at=None):
+        for i, keys in enumerate(pages):
+            calls.append(i)
+            if i == fail_at:
+                raise ConnectionError("reset")
+            yield None, keys
+    monkeypatch.setattr(app_async, "_active_scan", {"iter": None, "partial": 0})
+    monkeypatch.setattr(app_async, "scan_pages", lambda m, c: fake_pages(m, c, fail_at=2))
+    assert await app_async.count_active_keys(budget=2 * app_async.ACTIVE_KEYS_SCAN_COUNT) is None
+    assert calls == [0, 1]  # two SCAN calls, though only one key matched
+    with pytest.raises(ConnectionError):
+        await app_async.count_active_keys(budget=10_000)
+    assert app_async._active_scan == {"iter": None, "partial": 0}
+    monkeypatch.setattr(app_async, "scan_pages", fake_pages)
+    assert await app_async.count_active_keys(budget=10_000) == 3  # a fresh pass, not 1 + 3
+
+async def settle_local_offenses(redis_client, zkey, user, expected):
+    """Denies answered by the deny cache reach the offender ZSETs on the next flush."""
+    from app.settings import settings
+    if APP_URL is None:
+        from app.app_async import flush_local_offenses
+        await flush_local_offenses()
+        return
+    for _ in range(int(settings.OFFENDERS_FLUSH_SECONDS * 10) + 20):
+        if int(await redis_client.zscore(zkey, user) or 0) >= expected:
+            return
+        await asyncio.sleep(0.1)
+
+@pytest.mark.anyio
+@pytest.mark.skipif(APP_URL is not None, reason="inspects the in-process offense tally")
+async def test_cached_denies_reach_offender_zsets_on_flush(client, redis_client):
+    from app import app_async
+    from app.settings import settings
+    if app_async.deny_cache is None:
+        pytest.skip("DENY_CACHE_ENABLED is off")
+    user = "u_offender_cached"
+    statuses = [
+        (await client.post("/allow", params={"user_id": user, "resource": "r_offender_cached", "cost": 1})).status_code
+        for _ in range(15)
+    ]
+    denies = statuses.count(429)
+    assert denies > 1
+    # Denies the script decided are counted at once; cached ones wait for the flush
+    scripted = int(await redis_client.zscore(settings.OFFENDERS_ZSET, user) or 0)
+    assert scripted < denies
+    assert scripted + app_async._local_offenses[user] == denies
+    await app_async.flush_local_offenses()
+    assert int(await redis_client.zscore(settings.OFFENDERS_ZSET, user)) == denies
+    assert app_async._local_offenses[user] == 0
+
+@pytest.mark.anyio
+async def test_deny_updates_offender_zsets_atomically(client, redis_client):
+    from app.app_async import offender_keys
+    from app.settings import settings
+    user = "u_offender"
+    denies = 0
+    for _ in range(15):
+        r = await client.post("/allow", params={"user_id": user, "resource": "r_offender", "cost": 1})
+        denies += r.status_code == 429
+    assert denies > 0
+    await settle_local_offenses(redis_client, settings.OFFENDERS_ZSET, user, denies)
+    assert int(await redis_client.zscore(settings.OFFENDERS_ZSET, user)) >= denies
+    for zkey, ttl in offender_keys()[1:]:
+        assert await redis_client.zscore(zkey, user) is not None
+        assert 0 < await redis_client.ttl(zkey) <= ttl
+
+def test_offender_cover_uses_rollups_between_minute_edges():
+    from app.offender_rollup import offender_cover, offender_key_at
+    day = 20_000 * 1440
+    start, end = day - 30, day + 1440 + 125
+    folded_min = end - 2
+    keys = offender_cover(start, end, folded_min, folded_min - folded_min % 60)
+    assert keys == (
+        [offender_key_at(m, "minute") for m in range(start, day)]
+        + [offender_key_at(day, "day"), offender_key_at(day + 1440, "day"), offender_key_at(day + 1560, "hour")]
+        + [offender_key_at(m, "minute") for m in (folded_min, folded_min + 1)]
+    )
+    # nothing folded yet: minutes only
+    assert len(offender_cover(start, start + 90, start, start)) == 90
+
+@pytest.mark.anyio
+async def test_top_offenders_reads_rollups(client, redis_client):
+    import time
+    from app import app_async
+    from app.offender_rollup import offender_key_at
+    rollups = app_async.offender_rollups
+    user = "u_rollup"
+    for _ in range(15):
+        await client.post("/allow", params={"user_id": user, "resource": "r_rollup", "cost": 1})
+    await app_async.flush_local_offenses()
+    minute = int(time.time() // 60)
+    denies = int(await redis_client.zscore(offender_key_at(minute, "minute"), user))
+    assert denies > 0
+
+    # fold as if the current minute had closed
+    await redis_client.delete(rollups.minute_key, rollups.hour_key)
+    await redis_client.set(rollups.minute_key, minute)
+    await redis_client.set(rollups.hour_key, minute - minute % 60)
+    assert await rollups.run(now=time.time() + 60 + rollups.grace_seconds)
+    hour_key = offender_key_at(minute - minute % 60, "hour")
+    assert int(await redis_client.zscore(hour_key, user)) >= denies
+    assert int(await redis_client.get(rollups.minute_key)) > minute
+
+    app_async._top_offenders_cache.clear()
+    data = (await client.get("/admin/top_offenders", params={"window": "24h", "bucket": "hour", "top_n": 50})).json()
+    assert {o["user_id"]: o["denies"] for o in data["top_offenders"]}[user] >= denies
+    # served from the cache until TOP_OFFENDERS_CACHE_SECONDS pass
+    await redis_client.zincrby(hour_key, 1000, user)
+    again = (await client.get("/admin/top_offenders", params={"window": "24h", "bucket": "hour", "top_n": 50})).json()
+    assert again == data
+
+@pytest.mark.anyio
+async def test_top_consumers_merges_flushed_sketches(client, redis_client):
+    from app.app_async import consumers
+    for user, n in (("u_heavy", 6), ("u_light", 1)):
+        for _ in range(n):
+            await client.post("/allow", params={"user_id": user, "resource": "r_consumers", "cost": 1})
+    await consumers.flush()
+
+    data = (await client.get("/admin/top_consumers", params={"window": "15m", "top_n": 100})).json()
+    rows = {(c["user_id"], c["resource"]): c for c in data["top_consumers"]}
+    assert rows[("u_heavy", "r_consumers")]["tokens"] >= 6
+    assert rows[("u_light", "r_consumers")]["tokens"] >= 1
+    assert data["max_untracked"] >= 0
+    assert (await client.get("/admin/top_consumers", params={"window": "3d"})).status_code == 400
+
+@pytest.mark.anyio
+async def test_resource_registry_counts_live_buckets_without_scanning(client, redis_client):
+    from app.app_async import resource_registry
+    from app.settings import settings
+    for user in ("u_reg1", "u_reg2", "u_reg3", "u_reg1"):
+        await client.post("/allow", params={"user_id": user, "resource": "r_registry", "cost": 1})
+    await resource_registry.flush()
+    assert await redis_client.hget(f"{settings.RESOURCES_KEY}:seen", "r_registry")
+
+    rd = (await client.get("/admin/resources")).json()["resources"]["r_registry"]
+    assert rd["live_buckets"] == 3
+    assert rd["capacity"] == settings.DEFAULT_CAPACITY
+    assert rd["last_seen"] > 0
+    assert {"allow_per_sec", "deny_per_sec", "refill_rate_per_sec"} <= rd.keys()
+
+@pytest.mark.anyio
+async def test_request_id_is_propagated_or_created(client):
+    r = await client.get("/livez", headers={"X-Request-ID": "rid-abc"})
+    assert r.status_code == 200
+    assert r.headers["X-Request-ID"] == "rid-abc"
+    r2 = await client.get("/livez")
+    assert r2.headers.get("X-Request-ID")
+    assert r2.headers["X-Request-ID"] != "rid-abc"
+
+@pytest.mark.anyio
+async def test_server_timing_and_histograms_split_out_redis_time():
+    import httpx
+    import logging
+    from prometheus_client import CollectorRegistry, Histogram
+    from starlette.applications import Starlette
+    from starlette.responses import PlainTextResponse
+    from starlette.routing import Route
+    from app.obs_middleware import ObsMiddleware, note_redis_call
+
+    async def handler(request):
+        note_redis_call(0.002)
+        await asyncio.gather(asyncio.sleep(0), asyncio.sleep(0))
+        note_redis_call(0.003)
+        return PlainTextResponse("ok")
+
+    reg = CollectorRegistry()
+    calls = Histogram("calls", "c", registry=reg, buckets=(0, 1, 2, 3))
+    redis_lat = Histogram("redis", "r", registry=reg)
+    app = ObsMiddleware(
+        Starlette(routes=[Route("/x", handler)]),
+        latency=Histogram("lat", "l", ["endpoint"], registry=reg),
+        logger=logging.getLogger("test_server_timing"),
+        redis_calls=calls,
+        redis_latency=redis_lat,
+        server_timing=True,
+    )
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t") as c:
+        r = await c.get("/x")
+    parts = dict(p.split(";", 1) for p in r.headers["Server-Timing"].split(", "))
+    assert parts["redis"] == 'dur=5.000;desc="2 calls"'
+    assert {"app", "total"} <= parts.keys()
+    assert reg.get_sample_value("calls_bucket", {"le": "2.0"}) == 1
+    assert reg.get_sample_value("redis_sum") == pytest.approx(0.005)
+    note_redis_call(1.0)  # outside a request: ignored
+
+@pytest.mark.anyio
+async def test_memory_backend_counts_active_keys_in_process(monkeypatch):
+    from app import app_async
+    from app.memory_limiter import AsyncMemoryLimiter
+    rl = AsyncMemoryLimiter()
+    for user in ("a", "b"):
+        await rl.allow(
+            bucket_key=f"rl:{user}:r", capacity_tokens=5, rate_subtokens_per_sec=10_000, cost_tokens=1,
+            scale=10_000, ttl_seconds=60,
+        )
+    monkeypatch.setattr(app_async, "limiter", rl)
+    monkeypatch.setattr(app_async, "ACTIVE_KEYS_LAST", None)
+    monkeypatch.setattr(app_async, "OFFENSES_TRACKED", False)
+    monkeypatch.setattr(app_async, "_local_offenses", app_async.TallyCounter())
+    task = asyncio.ensure_future(app_async.active_keys_sampler())
+    await asyncio.sleep(0)
+    task.cancel()
+    assert app_async.ACTIVE_KEYS_LAST == 2
+    # no offender ZSETs to flush to: nothing piles up in-process
+    app_async.note_offense("a")
+    assert not app_async._local_offenses
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+from redis.exceptions import NoScriptError
+from app.lua_limiter_async import AutoPipeline
+
+class FakePipeline:
+    def __init__(self, owner):
+        self.owner = owner
+        self.commands = []
+
+    def evalsha(self, sha, numkeys, *args):
+        self.commands.append((sha, args[0]))
+
+    async def execute(self, raise_on_error=True):
+        self.owner.sent.append([key for _, key in self.commands])
+        if self.owner.down:
+            raise ConnectionError("down")
+        return [NoScriptError("NOSCRIPT") if sha == "missing" else f"ok:{key}" for sha, key in self.commands]
+
+class FakeRedis:
+    def __init__(self):
+        self.sent = []
+        self.down = False
+
+    def pipeline(self, transaction=True):
+        assert not transaction
+        return FakePipeline(self)
+
+@pytest.mark.anyio
+async def test_calls_in_one_tick_share_a_pipeline():
+    r = FakeRedis()
+    flushes = []
+    p = AutoPipeline(r, on_flush=lambda n, delay: flushes.append((n, delay)))
+    replies = await asyncio.gather(*(p.evalsha("sha", [f"k{i}"], ["1"]) for i in range(5)))
+    assert replies == [f"ok:k{i}" for i in range(5)]
+    assert r.sent == [[f"k{i}" for i in range(5)]]
+    assert flushes[0][0] == 5 and flushes[0][1] >= 0
+    assert len(p) == 0
+
+@pytest.mark.anyio
+async def test_max_batch_flushes_early():
+    r = FakeRedis()
+    p = AutoPipeline(r, max_batch=3, max_delay_ms=10_000)
+    await asyncio.wait_for(asyncio.gather(*(p.evalsha("sha", [f"k{i}"], []) for i in range(6))), 1.0)
+    assert r.sent == [["k0", "k1", "k2"], ["k3", "k4", "k5"]]
+
+@pytest.mark.anyio
+async def test_errors_go_to_their_own_callers():
+    r = FakeRedis()
+    p = AutoPipeline(r)
+    ok, missing = await asyncio.gather(
+        p.evalsha("sha", ["a"], []), p.evalsha("missing", ["b"], []), return_exceptions=True,
+    )
+    assert ok == "ok:a" and isinstance(missing, NoScriptError)
+    r.down = True
+    results = await asyncio.gather(*(p.evalsha("sha", [k], []) for k in "cd"), return_exceptions=True)
+    assert all(isinstance(e, ConnectionError) for e in results)
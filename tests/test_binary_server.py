@@ -0,0 +1,75 @@
+import asyncio
+import struct
+import pytest
+from app.binary_server import (
+    ALLOWED, DENIED, FAILED, REJECTED, BinaryAllowClient, BinaryAllowServer,
+    decode_request, decode_response, encode_request, encode_response,
+)
+from app.client import Decision
+
+def test_frames_round_trip():
+    frame = encode_request("alice", "search", 3, idempotency="k1")
+    assert struct.unpack(">I", frame[:4])[0] == len(frame) - 4
+    assert decode_request(frame[4:]) == ("alice", "search", 3, "k1", None)
+    assert decode_request(encode_request("bob", "")[4:]) == ("bob", "default", 1, None, None)
+    assert decode_response(encode_response(DENIED, 0.25, 1.5, "per_sec")[4:]) == (DENIED, 0.25, 1.5, "per_sec")
+    with pytest.raises(ValueError):
+        decode_request(encode_request("")[4:])
+
+async def fake_decide(user_id, resource, cost, idempotency, tenant):
+    if resource == "boom":
+        raise RuntimeError("redis down")
+    if idempotency and resource == "composite":
+        raise ValueError("idempotency is not supported for composite resources")
+    # later requests finish first: replies must still come back in order
+    await asyncio.sleep(0.02 / cost)
+    return Decision(cost < 5, 0.5, float(10 - cost), "per_sec" if resource == "composite" else None)
+
+@pytest.fixture
+async def uds_server(tmp_path):
+    path = str(tmp_path / "allow.sock")
+    server = BinaryAllowServer(fake_decide, max_inflight=4)
+    await server.start(uds_path=path)
+    yield path
+    await server.close()
+
+@pytest.mark.anyio
+async def test_pipelined_replies_keep_request_order(uds_server):
+    c = await BinaryAllowClient.connect(uds_path=uds_server)
+    replies = await asyncio.gather(*(c.allow(f"u{i}", "r", cost=i) for i in range(1, 9)))
+    assert [r[2] for r in replies] == [float(10 - i) for i in range(1, 9)]
+    assert [r[0] for r in replies] == [ALLOWED] * 4 + [DENIED] * 4
+    assert replies[0][1] == 0.0 and replies[-1][1] == 0.5
+    await c.close()
+
+@pytest.mark.anyio
+async def test_errors_are_answered_in_band(uds_server):
+    c = await BinaryAllowClient.connect(uds_path=uds_server)
+    assert (await c.allow("u", "composite", idempotency="k"))[0] == REJECTED
+    assert (await c.allow("u", "boom"))[0] == FAILED
+    assert await c.allow("u", "composite", cost=2) == (ALLOWED, 0.0, 8.0, "per_sec")
+    await c.close()
+
+@pytest.mark.anyio
+async def test_oversized_frame_closes_the_connection(uds_server):
+    reader, writer = await asyncio.open_unix_connection(uds_server)
+    writer.write(struct.pack(">I", 1 << 20))
+    assert await reader.read() == b""
+    writer.close()
+
+@pytest.mark.anyio
+async def test_binary_listener_matches_http(client, redis_client, tmp_path):
+    from app import app_async
+    server = BinaryAllowServer(app_async.binary_decide)
+    path = str(tmp_path / "app.sock")
+    await server.start(uds_path=path)
+    c = await BinaryAllowClient.connect(uds_path=path)
+    try:
+        replies = await asyncio.gather(*(c.allow("u_binary", "r_binary") for _ in range(12)))
+        assert [r[0] for r in replies].count(ALLOWED) >= 1
+        assert replies[-1][0] == DENIED and replies[-1][1] > 0
+        http = await client.post("/allow", params={"user_id": "u_binary", "resource": "r_binary"})
+        assert http.status_code == 429
+    finally:
+        await c.close()
+        await server.close()
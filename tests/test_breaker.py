@@ -0,0 +1,151 @@
+import asyncio
+
+import pytest
+import redis.exceptions
+from app.breaker import CLOSED, HALF_OPEN, OPEN, BreakerLimiter, CircuitBreaker
+
+SCALE = 10_000
+
+class Clock:
+    def __init__(self):
+        self.t = 100.0
+    def __call__(self):
+        return self.t
+
+class FlakyRedis:
+    """Stands in for AsyncLuaLimiter: answers, hangs or fails on demand."""
+
+    def __init__(self):
+        self.mode = "up"
+        self.calls = 0
+        self.leases = []
+
+    async def _io(self):
+        self.calls += 1
+        if self.mode == "hang":
+            await asyncio.sleep(10)
+        if self.mode == "down":
+            raise redis.exceptions.ConnectionError("refused")
+
+    async def allow(self, **kw):
+        await self._io()
+        return True, 0.0, 99.0, False
+
+    async def allow_many(self, items, **kw):
+        await self._io()
+        return [(True, 0.0, 99.0, False) for _ in items]
+
+    async def lease(self, **kw):
+        await self._io()
+        self.leases.append((kw["bucket_key"], kw["want_tokens"], kw.get("return_tokens", 0)))
+        return kw.get("want_tokens", 0), 0.0, 0.0
+
+def call(key="rl:u:r", cost=1, cap=10, **extra):
+    return dict(
+        bucket_key=key, capacity_tokens=cap, rate_subtokens_per_sec=SCALE, cost_tokens=cost,
+        scale=SCALE, ttl_seconds=60, **extra,
+    )
+
+def test_breaker_opens_probes_and_closes():
+    clk = Clock()
+    states = []
+    b = CircuitBreaker(failure_threshold=2, reset_seconds=5, now=clk, on_state=states.append)
+    b.failure()
+    assert b.state == CLOSED and b.admit()
+    b.failure()
+    assert b.state == OPEN and not b.admit()
+    clk.t += 5
+    assert b.admit() and b.state == HALF_OPEN
+    assert not b.admit()  # one probe at a time
+    b.failure()
+    assert b.state == OPEN
+    clk.t += 5
+    assert b.admit()
+    assert b.success() and b.state == CLOSED
+    assert not b.success()
+    assert states == [OPEN, HALF_OPEN, OPEN, HALF_OPEN, CLOSED]
+
+@pytest.mark.anyio
+async def test_overrun_is_decided_locally_within_budget():
+    inner = FlakyRedis()
+    inner.mode = "hang"
+    overruns = []
+    lim = BreakerLimiter(inner, budget_ms=20, on_overrun=lambda: overruns.append(1))
+    allowed, _, remaining, _ = await asyncio.wait_for(lim.allow(**call(cost=3)), 1.0)
+    assert allowed and remaining == 7.0
+    assert overruns == [1] and lim.breaker.state == CLOSED
+
+@pytest.mark.anyio
+async def test_open_breaker_skips_redis_with_a_share_of_capacity():
+    inner = FlakyRedis()
+    inner.mode = "down"
+    fallbacks = []
+    lim = BreakerLimiter(inner, failure_threshold=2, local_share=0.5, on_fallback=lambda: fallbacks.append(1))
+    decisions = [await lim.allow(**call()) for _ in range(6)]
+    assert [d[0] for d in decisions] == [True] * 5 + [False]  # half of capacity 10
+    assert inner.calls == 2 and lim.breaker.state == OPEN
+    assert len(fallbacks) == 6
+
+@pytest.mark.anyio
+async def test_recovery_withdraws_local_spend_from_redis():
+    clk = Clock()
+    inner = FlakyRedis()
+    inner.mode = "down"
+    lim = BreakerLimiter(inner, failure_threshold=1, reset_seconds=1, now=clk)
+    await lim.allow(**call("rl:a:r", cost=2))
+    await lim.allow(**call("rl:a:r", cost=3))
+    await lim.allow_many([("rl:b:r", 10, SCALE, 4, "b")], scale=SCALE, ttl_seconds=60)
+    await lim.allow(**call("rl:c:r", algorithm="sliding_window", window_ms=1_000))
+    inner.mode = "up"
+    assert (await lim.allow(**call("rl:d:r")))[2] == 9.0  # still open: local
+    clk.t += 1
+    assert (await lim.allow(**call("rl:d:r")))[2] == 99.0  # the probe reaches Redis
+    assert lim.breaker.state == CLOSED
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert sorted(inner.leases) == [("rl:a:r", 5, 0), ("rl:b:r", 4, 0), ("rl:d:r", 1, 0)]
+
+@pytest.mark.anyio
+async def test_failed_reconcile_keeps_the_debt():
+    inner = FlakyRedis()
+    inner.mode = "down"
+    lim = BreakerLimiter(inner, failure_threshold=1)
+    await lim.allow(**call(cost=2))
+    assert await lim.reconcile() == 0
+    inner.mode = "up"
+    assert await lim.reconcile() == 1
+    assert inner.leases == [("rl:u:r", 2, 0)]
+
+@pytest.mark.anyio
+async def test_script_errors_propagate_without_tripping():
+    class Broken(FlakyRedis):
+        async def allow(self, **kw):
+            raise redis.exceptions.ResponseError("sliding_window needs window_ms > 0")
+    lim = BreakerLimiter(Broken(), failure_threshold=1)
+    with pytest.raises(redis.exceptions.ResponseError):
+        await lim.allow(**call())
+    assert lim.breaker.state == CLOSED
+
+@pytest.mark.anyio
+async def test_local_denies_are_reported_as_offenses():
+    inner = FlakyRedis()
+    inner.mode = "down"
+    offenders = []
+    lim = BreakerLimiter(inner, failure_threshold=1, on_local_deny=offenders.append)
+    for _ in range(2):
+        await lim.allow(**call(cap=1, offender_member="alice", offender_keys=[("rl:offenders", 0)]))
+    await lim.allow(**call(cap=1, offender_member="bob"))  # sharded path: counted by the caller
+    assert offenders == ["alice"]
+
+@pytest.mark.anyio
+async def test_debts_are_capped_while_open():
+    inner = FlakyRedis()
+    inner.mode = "down"
+    dropped = []
+    lim = BreakerLimiter(inner, failure_threshold=1, max_debts=2, on_debt_dropped=lambda: dropped.append(1))
+    for key in ("rl:a:r", "rl:b:r", "rl:c:r", "rl:a:r"):
+        assert (await lim.allow(**call(key)))[0]
+    assert dropped == [1]  # rl:c:r is granted but not remembered; rl:a:r still adds up
+    inner.mode = "up"
+    assert await lim.reconcile() == 2
+    assert sorted(inner.leases) == [("rl:a:r", 2, 0), ("rl:b:r", 1, 0)]
@@ -0,0 +1,66 @@
+import os
+import pytest
+from app.client import Decision, RateLimitClient, SyncRateLimitClient
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+COMPOSITE_POLICY = """\
+resources:
+  - name: api
+    limits:
+      - {name: per_sec, limit: 10, window_seconds: 1}
+"""
+
+def test_decision_body_matches_the_http_response():
+    assert Decision(True, 1.5, 4.0).as_dict() == {"allowed": True, "retry_after": 0.0, "tokens_left": 4.0}
+    assert Decision(False, 0.2, 0.0, "per_sec", composite=True).as_dict() == {
+        "allowed": False, "retry_after": 0.2, "tokens_left": 0.0, "limit": "per_sec",
+    }
+
+@pytest.mark.anyio
+async def test_composite_idempotency_is_rejected_before_redis(tmp_path):
+    path = tmp_path / "policy.yaml"
+    path.write_text(COMPOSITE_POLICY)
+    limiter = RateLimitClient("redis://127.0.0.1:1/0", policy_path=str(path))
+    with pytest.raises(ValueError):
+        await limiter.allow("u", "api", idempotency="k1")
+    await limiter.close()
+
+@pytest.mark.anyio
+async def test_client_and_http_share_buckets(client, redis_client):
+    user, resource = "u_embedded", "r_embedded"
+    async with RateLimitClient(REDIS_URL) as limiter:
+        decisions = [await limiter.allow(user, resource) for _ in range(8)]
+        assert all(d.allowed for d in decisions)
+        assert decisions[-1].tokens_left < decisions[0].tokens_left
+        # the HTTP service sees what the client spent, and the reverse
+        http = [(await client.post("/allow", params={"user_id": user, "resource": resource})).json() for _ in range(4)]
+        assert [b["allowed"] for b in http].count(False) >= 1
+        denied = await limiter.allow(user, resource)
+        assert not denied.allowed and denied.retry_after > 0
+        assert set(denied.as_dict()) == set(http[-1])
+
+        replay = await limiter.allow("u_embedded_idem", resource, idempotency="once")
+        again = await limiter.allow("u_embedded_idem", resource, idempotency="once")
+        assert again.idempotent_replay and again.as_dict() == replay.as_dict()
+
+@pytest.mark.anyio
+async def test_sync_client(redis_client):
+    # blocks this loop; the client runs on its own
+    with SyncRateLimitClient(REDIS_URL) as limiter:
+        assert limiter.allow("u_embedded_sync", "r_embedded").allowed
+
+@pytest.mark.anyio
+async def test_records_in_the_old_idempotency_layout_still_replay(client, redis_client):
+    from app.settings import settings
+    if settings.REDIS_MODE != "single":
+        pytest.skip("old records only exist in single mode")
+    # written before idempotency keys moved next to the bucket: denied, retry in 1.5 s
+    await redis_client.set("idem:u_legacy_idem:r_legacy:k1", f"0,1500,{2 * settings.SCALE}", ex=60)
+    http = (await client.post("/allow", params={"user_id": "u_legacy_idem", "resource": "r_legacy", "idempotency": "k1"}))
+    assert http.status_code == 429 and http.headers["Retry-After"] == "1.5"
+    async with RateLimitClient(REDIS_URL) as limiter:
+        d = await limiter.allow("u_legacy_idem", "r_legacy", idempotency="k1")
+        assert d.idempotent_replay and not d.allowed and d.retry_after == 1.5 and d.tokens_left == 2.0
+        fresh = await limiter.allow("u_legacy_idem", "r_legacy", idempotency="k2")
+        assert fresh.allowed and not fresh.idempotent_replay
@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+from app.coalesce import BucketCoalescer
+from app.memory_limiter import AsyncMemoryLimiter
+
+SCALE = 10_000
+
+class Recording:
+    """AsyncMemoryLimiter that logs every call and can hold them until released."""
+
+    def __init__(self):
+        self.inner = AsyncMemoryLimiter(now_ms=lambda: 1_000)
+        self.calls = []
+        self.gate = None
+
+    async def _wait(self):
+        if self.gate is not None:
+            await self.gate.wait()
+
+    async def allow(self, **kw):
+        self.calls.append(("allow", kw["bucket_key"], 1))
+        await self._wait()
+        return await self.inner.allow(**kw)
+
+    async def allow_many(self, items, **kw):
+        self.calls.append(("allow_many", items[0][0], len(items)))
+        await self._wait()
+        return await self.inner.allow_many(items, **kw)
+
+def call(key="rl:u:r", cost=1, cap=3, **extra):
+    return dict(
+        bucket_key=key,
+        capacity_tokens=cap,
+        rate_subtokens_per_sec=SCALE,
+        cost_tokens=cost,
+        scale=SCALE,
+        ttl_seconds=60,
+        **extra,
+    )
+
+@pytest.mark.anyio
+async def test_same_tick_calls_share_one_batch_in_order():
+    rl = Recording()
+    c = BucketCoalescer(rl)
+    results = await asyncio.gather(*(c.allow(**call()) for _ in range(5)))
+    assert rl.calls == [("allow_many", "rl:u:r", 5)]
+    assert [r[0] for r in results] == [True, True, True, False, False]
+    assert [r[2] for r in results[:3]] == [2.0, 1.0, 0.0]
+    assert len(c) == 0
+
+@pytest.mark.anyio
+async def test_decisions_match_uncoalesced_calls():
+    costs = [2, 1, 3, 1, 1, 2]
+    plain = AsyncMemoryLimiter(now_ms=lambda: 1_000)
+    expected = [await plain.allow(**call(cost=n, cap=5)) for n in costs]
+    c = BucketCoalescer(Recording())
+    assert await asyncio.gather(*(c.allow(**call(cost=n, cap=5)) for n in costs)) == expected
+
+@pytest.mark.anyio
+async def test_calls_arriving_while_in_flight_form_the_next_batch():
+    rl = Recording()
+    rl.gate = asyncio.Event()
+    c = BucketCoalescer(rl)
+    first = asyncio.ensure_future(c.allow(**call()))
+    while not rl.calls:
+        await asyncio.sleep(0)
+    assert rl.calls == [("allow", "rl:u:r", 1)]
+    later = [asyncio.ensure_future(c.allow(**call())) for _ in range(3)]
+    for _ in range(5):
+        await asyncio.sleep(0)
+    assert len(rl.calls) == 1  # held back until the first call returns
+    rl.gate.set()
+    results = await asyncio.gather(first, *later)
+    assert rl.calls == [("allow", "rl:u:r", 1), ("allow_many", "rl:u:r", 3)]
+    assert [r[0] for r in results] == [True, True, True, False]
+
+@pytest.mark.anyio
+async def test_max_batch_splits_a_burst():
+    rl = Recording()
+    sizes = []
+    c = BucketCoalescer(rl, max_batch=4, on_batch=sizes.append)
+    await asyncio.gather(*(c.allow(**call(cap=20)) for _ in range(10)))
+    assert sizes == [4, 4, 2]
+    assert [n for _, _, n in rl.calls] == sizes
+
+@pytest.mark.anyio
+async def test_different_buckets_are_not_merged():
+    rl = Recording()
+    c = BucketCoalescer(rl)
+    await asyncio.gather(c.allow(**call("rl:a:r")), c.allow(**call("rl:b:r")))
+    assert sorted(rl.calls) == [("allow", "rl:a:r", 1), ("allow", "rl:b:r", 1)]
+
+@pytest.mark.anyio
+async def test_idempotent_and_other_algorithms_pass_through():
+    rl = Recording()
+    c = BucketCoalescer(rl)
+    await asyncio.gather(
+        c.allow(**call(idem_key="idem:rl:u:r:x", idempotency_ttl_seconds=15)),
+        c.allow(**call(idem_key="idem:rl:u:r:y", idempotency_ttl_seconds=15)),
+        c.allow(**call(algorithm="sliding_window", window_ms=1_000)),
+    )
+    assert [kind for kind, _, _ in rl.calls] == ["allow"] * 3
+    assert len(c) == 0
+
+@pytest.mark.anyio
+async def test_errors_reach_every_caller_and_the_next_batch_still_runs():
+    class Failing(Recording):
+        async def allow_many(self, items, **kw):
+            raise ConnectionError("down")
+    c = BucketCoalescer(Failing())
+    results = await asyncio.gather(*(c.allow(**call()) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(r, ConnectionError) for r in results)
+    assert (await c.allow(**call()))[0]
+
+@pytest.mark.anyio
+async def test_every_waiter_is_charged_the_shared_call():
+    from app.obs_middleware import note_redis_call, track_timings
+    class Timed(Recording):
+        async def allow_many(self, items, **kw):
+            note_redis_call(0.002)
+            return await super().allow_many(items, **kw)
+    c = BucketCoalescer(Timed())
+    async def request():
+        timings = track_timings()  # what ObsMiddleware sets up per request
+        await c.allow(**call())
+        return timings
+    timings = await asyncio.gather(*(request() for _ in range(3)))
+    assert [(t.redis_calls, t.redis_seconds) for t in timings] == [(1, 0.002)] * 3
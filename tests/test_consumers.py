@@ -0,0 +1,42 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+from app.consumers import TopConsumers
+
+class FakeRedis:
+    """Records pipelined commands."""
+
+    def __init__(self):
+        self.commands = []
+
+    def pipeline(self, transaction=False):
+        return self
+
+    def __getattr__(self, name):
+        return lambda *args, **kw: self.commands.append((name, args, kw))
+
+    async def execute(self):
+        return []
+
+@pytest.mark.anyio
+async def test_flush_hands_the_sketch_to_minute_and_hour_zsets():
+    r = FakeRedis()
+    now = datetime(2026, 1, 2, 3, 4, tzinfo=timezone.utc)
+    flushes = []
+    store = TopConsumers(r, r, prefix="rlc", sketch_size=1, on_flush=flushes.append, now=lambda: now)
+    store.note("a", "read", 3)
+    store.note("b", "read", 2)   # evicts a: count 5, error 3
+    store.note("c", "read", 0)   # free calls aren't tracked
+    await store.flush()
+    assert len(store) == 0 and len(flushes) == 1
+
+    member = json.dumps(["b", "read"])
+    incrs = {(name, args[0]): args[1:] for name, args, _ in r.commands if name in ("zincrby", "incrby")}
+    assert incrs[("zincrby", "rlc:tokens:minute:202601020304")] == (5, member)
+    assert incrs[("zincrby", "rlc:err:hour:2026010203")] == (3, member)
+    assert incrs[("incrby", "rlc:floor:minute:202601020304")] == (5,)
+
+    r.commands.clear()
+    await store.flush()  # nothing new
+    assert r.commands == []
@@ -0,0 +1,47 @@
+import pytest
+from app.deny_cache import DenyCache
+
+class FakeClock:
+    def __init__(self, start: float = 100.0):
+        self._now = start
+    def now(self) -> float:
+        return self._now
+    def advance(self, seconds: float) -> None:
+        self._now += seconds
+
+def test_hit_until_retry_after_minus_margin():
+    clk = FakeClock()
+    cache = DenyCache(10, margin_ms=10, max_ttl_ms=5_000, now=clk.now)
+    cache.put("rl:u:r", 1, retry_after=0.5, remaining=0.2)
+
+    retry_after, remaining = cache.get("rl:u:r", 1)
+    assert retry_after == pytest.approx(0.5)
+    assert remaining == 0.2
+
+    clk.advance(0.3)
+    assert cache.get("rl:u:r", 1)[0] == pytest.approx(0.2)
+    # keyed by cost: a cheaper request may still fit
+    assert cache.get("rl:u:r", 0) is None
+
+    clk.advance(0.19)  # inside the 10ms safety margin
+    assert cache.get("rl:u:r", 1) is None
+    assert len(cache) == 0
+
+def test_ttl_is_capped_and_tiny_retries_are_not_cached():
+    clk = FakeClock()
+    cache = DenyCache(10, margin_ms=5, max_ttl_ms=1_000, now=clk.now)
+    cache.put("rl:u:slow", 1, retry_after=60.0, remaining=0.0)
+    cache.put("rl:u:fast", 1, retry_after=0.004, remaining=0.9)
+    assert cache.get("rl:u:fast", 1) is None
+    assert cache.get("rl:u:slow", 1) is not None
+    clk.advance(1.0)
+    assert cache.get("rl:u:slow", 1) is None
+
+def test_bounded_size_evicts_oldest():
+    clk = FakeClock()
+    cache = DenyCache(2, margin_ms=0, max_ttl_ms=5_000, now=clk.now)
+    for i in range(3):
+        cache.put(f"rl:u{i}:r", 1, retry_after=1.0, remaining=0.0)
+    assert len(cache) == 2
+    assert cache.get("rl:u0:r", 1) is None
+    assert cache.get("rl:u2:r", 1) is not None
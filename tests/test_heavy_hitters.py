@@ -0,0 +1,45 @@
+import random
+from collections import Counter
+
+import pytest
+from app.heavy_hitters import SpaceSaving
+
+def test_exact_until_full():
+    s = SpaceSaving(4)
+    for key, w in (("a", 3), ("b", 1), ("a", 2), ("c", 5)):
+        s.add(key, w)
+    assert {k: (c, e) for k, c, e in s.items()} == {"a": (5, 0), "c": (5, 0), "b": (1, 0)}
+    assert s.items()[-1][0] == "b"
+    assert s.min_count() == 0
+
+def test_new_key_replaces_the_minimum_and_inherits_it_as_error():
+    s = SpaceSaving(2)
+    s.add("a", 10)
+    s.add("b", 2)
+    s.add("b", 1)
+    s.add("c", 1)  # evicts b (3)
+    assert {k: (c, e) for k, c, e in s.items()} == {"a": (10, 0), "c": (4, 3)}
+    assert s.min_count() == 4
+
+def test_heavy_hitters_are_tracked_within_bounds():
+    rng = random.Random(7)
+    s = SpaceSaving(50)
+    true = Counter()
+    for _ in range(50_000):
+        # a few heavy keys over a long tail of distinct ones
+        key = f"hot-{rng.randrange(5)}" if rng.random() < 0.3 else f"tail-{rng.randrange(20_000)}"
+        w = rng.randrange(1, 4)
+        s.add(key, w)
+        true[key] += w
+    tracked = {k: (c, e) for k, c, e in s.items()}
+    assert len(tracked) == 50
+    for key, (count, error) in tracked.items():
+        assert count - error <= true[key] <= count
+    for i in range(5):
+        assert f"hot-{i}" in tracked
+    assert [k for k, _, _ in s.items()[:5]] == [k for k, _ in true.most_common(5)]
+    assert all(true[k] <= s.min_count() for k in true if k not in tracked)
+
+def test_capacity_must_be_positive():
+    with pytest.raises(ValueError):
+        SpaceSaving(0)
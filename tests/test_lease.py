@@ -0,0 +1,77 @@
+import pytest
+from app.lease import LeaseManager
+
+class FakeClock:
+    def __init__(self, start: float = 100.0):
+        self._now = start
+    def now(self) -> float:
+        return self._now
+    def advance(self, seconds: float) -> None:
+        self._now += seconds
+
+class FakeLeaseLimiter:
+    """Stands in for AsyncLuaLimiter.lease with a single whole-token bucket (no refill)."""
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+        self.calls = []
+        self.ttls = []
+    async def lease(self, *, bucket_key, capacity_tokens, rate_subtokens_per_sec, scale, ttl_seconds,
+                    return_tokens=0, want_tokens=0, min_tokens=1, index_key=""):
+        self.calls.append((return_tokens, want_tokens, min_tokens))
+        self.ttls.append(ttl_seconds)
+        self.tokens = min(capacity_tokens, self.tokens + return_tokens)
+        granted = min(self.tokens, want_tokens)
+        if want_tokens > 0 and granted < min_tokens:
+            return 0, 0.5, float(self.tokens)
+        self.tokens -= granted
+        return granted, 0.0, float(self.tokens)
+
+def make(tokens=100, **kw):
+    clk = FakeClock()
+    lim = FakeLeaseLimiter(tokens)
+    opts = dict(scale=10_000, bucket_ttl_seconds=60, lease_ttl_ms=1_000, min_tokens=1, max_tokens=50)
+    opts.update(kw)
+    return clk, lim, LeaseManager(lim, now=clk.now, **opts)
+
+async def spend(mgr, cost=1):
+    return await mgr.allow(bucket_key="rl:u:hot", capacity_tokens=100, rate_subtokens_per_sec=0, cost_tokens=cost)
+
+@pytest.mark.anyio
+async def test_decisions_are_served_from_the_local_balance():
+    clk, lim, mgr = make()
+    for _ in range(10):
+        clk.advance(0.01)
+        assert (await spend(mgr))[0]
+    # lease size adapts to the observed rate, so Redis sees far fewer calls than decisions
+    assert len(lim.calls) < 10
+    assert mgr.stats["local"] + mgr.stats["acquire"] == 10
+
+@pytest.mark.anyio
+async def test_denies_when_redis_has_too_few_tokens():
+    clk, lim, mgr = make(tokens=2)
+    assert (await spend(mgr, cost=2))[0]
+    allowed, retry_after, _, _ = await spend(mgr, cost=1)
+    assert not allowed and retry_after > 0
+
+@pytest.mark.anyio
+async def test_expired_lease_returns_unused_tokens():
+    clk, lim, mgr = make(min_tokens=10)
+    assert (await spend(mgr))[0]
+    assert lim.tokens == 90
+    clk.advance(1.5)
+    assert await mgr.release_expired() == 1
+    assert lim.tokens == 99
+    # the next decision starts a fresh lease
+    assert (await spend(mgr))[0]
+    assert lim.calls[-1][0] == 0
+
+@pytest.mark.anyio
+async def test_withdrawals_and_releases_keep_the_policy_ttl():
+    clk, lim, mgr = make(min_tokens=5)
+    await mgr.allow(
+        bucket_key="rl:u:daily", capacity_tokens=100, rate_subtokens_per_sec=0, cost_tokens=1, ttl_seconds=86_400,
+    )
+    await spend(mgr)  # no policy TTL given: bucket_ttl_seconds
+    clk.advance(2)
+    assert await mgr.release_expired() == 2
+    assert sorted(lim.ttls) == [60, 60, 86_400, 86_400]
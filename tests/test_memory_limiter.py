@@ -0,0 +1,145 @@
+import pytest
+from app.memory_limiter import AsyncMemoryLimiter
+
+SCALE = 10_000
+
+class FakeClock:
+    def __init__(self, start_ms: int = 1_000):
+        self._now = start_ms
+    def now_ms(self) -> int:
+        return self._now
+    def advance(self, seconds: float) -> None:
+        self._now += int(seconds * 1000)
+
+async def run(rl, user="u", res="r", cost=1, cap=4, rate=2.0, ttl=60, idem=""):
+    allowed, retry_after, remaining, used_idem = await rl.allow(
+        bucket_key=f"rl:{user}:{res}",
+        capacity_tokens=cap,
+        rate_subtokens_per_sec=int(rate * SCALE),
+        cost_tokens=cost,
+        scale=SCALE,
+        ttl_seconds=ttl,
+        idem_key=idem,
+        idempotency_ttl_seconds=15,
+    )
+    return allowed, retry_after, remaining, used_idem
+
+@pytest.mark.anyio
+async def test_single_user_steady_rate():
+    clk = FakeClock()
+    rl = AsyncMemoryLimiter(now_ms=clk.now_ms)
+    for _ in range(4):
+        ok, ra, _, _ = await run(rl)
+        assert ok and ra == 0.0
+    ok, ra, _, _ = await run(rl)
+    assert not ok and ra == pytest.approx(0.5)
+    clk.advance(0.5)
+    assert (await run(rl))[0]
+
+@pytest.mark.anyio
+async def test_refill_is_capped_at_capacity():
+    clk = FakeClock()
+    rl = AsyncMemoryLimiter(now_ms=clk.now_ms)
+    for _ in range(5):
+        assert (await run(rl, cap=5))[0]
+    clk.advance(30)
+    for _ in range(5):
+        assert (await run(rl, cap=5))[0]
+    assert not (await run(rl, cap=5))[0]
+
+@pytest.mark.anyio
+async def test_idempotency_replays_without_spending():
+    clk = FakeClock()
+    rl = AsyncMemoryLimiter(now_ms=clk.now_ms)
+    ok1, _, rem1, used1 = await run(rl, idem="idem:u:r:abc", cap=2)
+    ok2, _, rem2, used2 = await run(rl, idem="idem:u:r:abc", cap=2)
+    assert ok1 and ok2 and rem1 == rem2 == 1.0
+    assert not used1 and used2
+
+@pytest.mark.anyio
+async def test_allow_many_all_or_nothing_rolls_back():
+    clk = FakeClock()
+    rl = AsyncMemoryLimiter(now_ms=clk.now_ms)
+    items = [("rl:u:a", 4, 2 * SCALE, 1, "u"), ("rl:u:b", 4, 2 * SCALE, 10, "u")]
+    res = await rl.allow_many(items, scale=SCALE, ttl_seconds=60, all_or_nothing=True)
+    assert [r[0] for r in res] == [False, False]
+    assert res[0][2] == 4.0
+    # nothing was charged
+    assert (await run(rl, res="a", cost=4))[0]
+
+@pytest.mark.anyio
+async def test_idle_buckets_are_evicted_after_ttl():
+    clk = FakeClock()
+    rl = AsyncMemoryLimiter(now_ms=clk.now_ms)
+    await run(rl, user="old", ttl=10)
+    clk.advance(5)
+    await run(rl, user="new", ttl=10)
+    clk.advance(6)
+    assert rl.evict_expired() == 1
+    assert len(rl) == 1
+    # an evicted bucket starts full again
+    assert (await run(rl, user="old", ttl=10))[2] == 3.0
+
+@pytest.mark.anyio
+async def test_long_ttl_buckets_do_not_hold_back_eviction():
+    clk = FakeClock()
+    rl = AsyncMemoryLimiter(now_ms=clk.now_ms)
+    await run(rl, user="daily", ttl=86_400)
+    await run(rl, user="a", ttl=10)
+    await run(rl, user="daily", ttl=86_400)
+    await run(rl, user="b", ttl=10)
+    clk.advance(11)
+    assert rl.evict_expired(budget=1) == 1
+    assert rl.evict_expired() == 1
+    assert len(rl) == 1
+    await run(rl, user="a", ttl=86_400)  # a bucket's TTL can change with its policy
+    clk.advance(20)
+    assert rl.evict_expired() == 0 and len(rl) == 2
+
+@pytest.mark.anyio
+async def test_idle_full_bucket_does_not_refill_twice():
+    clk = FakeClock()
+    rl = AsyncMemoryLimiter(now_ms=clk.now_ms)
+    for _ in range(4):
+        assert (await run(rl))[0]
+    clk.advance(10)
+    assert (await run(rl, cost=0))[0]  # refills to full without drawing it down
+    clk.advance(10)
+    burst = [(await run(rl))[0] for _ in range(6)]
+    assert burst == [True] * 4 + [False] * 2
+
+def sliding_reference(events, limit, window_ms):
+    """Exact two-window estimate with Fractions: [(now_ms, cost)] -> [allowed]."""
+    from fractions import Fraction
+    counts = {}
+    out = []
+    for now, cost in events:
+        idx, elapsed = divmod(now, window_ms)
+        cur, prev = counts.get(idx, 0), counts.get(idx - 1, 0)
+        ok = prev * Fraction(window_ms - elapsed, window_ms) + cur + cost <= limit
+        if ok:
+            counts[idx] = cur + cost
+        out.append(ok)
+    return out
+
+@pytest.mark.anyio
+async def test_sliding_window_smooths_the_fixed_window_boundary():
+    clk = FakeClock(start_ms=1_000)
+    rl = AsyncMemoryLimiter(now_ms=clk.now_ms)
+    events, got, retries = [], [], []
+    # 10 at the very end of one window, then probes straddling the boundary
+    for at_ms, n in ((1_990, 11), (2_000, 1), (2_100, 1), (2_500, 6)):
+        clk._now = at_ms
+        for _ in range(n):
+            allowed, retry_after, _, _ = await rl.allow(
+                bucket_key="rl:u:daily", capacity_tokens=10, rate_subtokens_per_sec=0,
+                cost_tokens=1, scale=SCALE, ttl_seconds=60,
+                algorithm="sliding_window", window_ms=1_000,
+            )
+            events.append((at_ms, 1))
+            got.append(allowed)
+            retries.append(retry_after)
+    assert got == sliding_reference(events, 10, 1_000)
+    assert got[:12] == [True] * 10 + [False, False]  # no double burst at the boundary
+    assert retries[11] == pytest.approx(0.1)  # 10 * (1 - t) + 0 + 1 <= 10 at t = 0.1
+    assert got[12] and sum(got[13:]) == 4
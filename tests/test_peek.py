@@ -0,0 +1,78 @@
+import os
+
+import pytest
+from app.policy import ResourcePolicy
+
+SCALE = 10_000
+REPLICA_URL = os.getenv("REDIS_REPLICA_URL")
+
+def test_peek_decision_matches_the_scripts():
+    from app.peek import peek_decision
+    tb = ResourcePolicy("r", 5, 2.0, SCALE)
+    assert peek_decision(None, tb, SCALE, 1, 10_000.0) == (True, 0.0, 5.0, False)
+    # 1 token left 250 ms ago at 2/s -> 1.5 now; 3 more need 0.75 s
+    state = {"tokens": 1 * SCALE, "last_ms": 9_750}
+    assert peek_decision(state, tb, SCALE, 1, 10_000.0) == (True, 0.0, 1.5, False)
+    assert peek_decision(state, tb, SCALE, 3, 10_000.0) == (False, 0.75, 1.5, False)
+
+    gcra = ResourcePolicy("g", 5, 2.0, SCALE, algorithm="gcra")
+    # TAT 1 s ahead: 2 tokens short of full
+    assert peek_decision({"tat_us": 11_000_000}, gcra, SCALE, 4, 10_000.0) == (False, 0.5, 3.0, False)
+
+    sw = ResourcePolicy("s", 10, 10.0, SCALE, algorithm="sliding_window", window_ms=1_000)
+    # Window 10 at 250 ms in: previous window (8) weighs 6, current holds 3 -> estimate 9
+    state = {"window_idx": 10, "cur": 3, "prev": 8}
+    allowed, retry_after, tokens, _ = peek_decision(state, sw, SCALE, 2, 10_250.0)
+    assert not allowed and tokens == pytest.approx(1.0)
+    assert retry_after == pytest.approx(0.125)  # once prev weighs 5, at 375 ms
+    assert peek_decision(state, sw, SCALE, 11, 10_250.0)[1] == (2**31 - 1) / 1000.0
+
+@pytest.mark.anyio
+async def test_peeker_reads_each_bucket_on_its_node():
+    from app.peek import BucketPeeker
+
+    class Node:
+        def __init__(self, values):
+            self.values = values
+
+        async def get(self, key):
+            return self.values.get(key)
+
+    nodes = {"a": Node({b"a": b"10000:9750"}), "b": Node({})}
+    peeker = BucketPeeker(lambda key: nodes[key], scale=SCALE, now=lambda: 10.0)
+    tb = ResourcePolicy("r", 5, 2.0, SCALE)
+    assert await peeker.decisions([("a", tb), ("b", tb)], 3) == [(False, 0.75, 1.5, False), (True, 0.0, 5.0, False)]
+
+@pytest.mark.anyio
+async def test_peek_does_not_charge(client, redis_client):
+    for _ in range(3):
+        await client.post("/allow", params={"user_id": "u_peek", "resource": "r_peek", "cost": 2})
+    first = (await client.get("/peek", params={"user_id": "u_peek", "resource": "r_peek", "cost": 2})).json()
+    second = (await client.get("/peek", params={"user_id": "u_peek", "resource": "r_peek", "cost": 2})).json()
+    assert first["tokens_left"] == pytest.approx(second["tokens_left"], abs=0.1)
+    allowed = (await client.post("/allow", params={"user_id": "u_peek", "resource": "r_peek", "cost": 2})).json()
+    assert allowed["allowed"] == first["allowed"]
+    fresh = (await client.get("/peek", params={"user_id": "u_nobody", "resource": "r_peek"})).json()
+    assert fresh["allowed"] and fresh["retry_after"] == 0.0
+
+@pytest.mark.anyio
+@pytest.mark.skipif(not REPLICA_URL, reason="set REDIS_REPLICA_URL to a replica of REDIS_URL")
+async def test_reads_are_served_by_the_replica(client, redis_client):
+    from app import app_async
+    replica = app_async.rr
+    assert app_async.REPLICA_READS
+    assert replica.connection_pool is not app_async.r.connection_pool
+    assert (await replica.info("replication"))["role"] in ("slave", "replica")
+
+    for _ in range(12):
+        await client.post("/allow", params={"user_id": "u_replica", "resource": "r_replica"})
+    await redis_client.execute_command("WAIT", 1, 1_000)
+    d = (await client.get("/peek", params={"user_id": "u_replica", "resource": "r_replica"})).json()
+    assert not d["allowed"] and d["retry_after"] > 0
+
+    # Multi-key unions run as ZUNION on the replica, which rejects ZUNIONSTORE
+    app_async._top_offenders_cache.clear()
+    r = await client.get("/admin/top_offenders", params={"window": "2h", "bucket": "minute"})
+    assert r.status_code == 200
+    r = await client.get("/admin/top_consumers", params={"window": "15m"})
+    assert r.status_code == 200
@@ -0,0 +1,145 @@
+import os
+import pytest
+
+from app.policy import PolicyLoader, PolicyTable
+
+SCALE = 10_000
+
+def table(data):
+    return PolicyTable.from_mapping(data, scale=SCALE, default_capacity=10, default_rate=5.0, version="v")
+
+def test_exact_names_then_patterns_in_file_order_then_defaults():
+    t = table({"resources": [
+        {"name": "search/s*", "capacity": 3},
+        {"name": "search/*", "capacity": 50, "rate_tokens_per_sec": 25},
+        {"name": "search/slow", "capacity": 2, "rate_tokens_per_sec": 0.5},
+    ]})
+    assert t.lookup("search/slow").capacity == 2            # exact beats any pattern
+    assert t.lookup("search/sort").capacity == 3            # first matching pattern wins
+    assert t.lookup("read").capacity == 10                  # defaults
+    pol = t.lookup("search/x")
+    assert pol.rate_subtokens_per_sec == 250_000
+    assert pol.config_argv == (b"50", b"250000")
+    assert t.lookup("search/s1").rate_tokens_per_sec == 5.0  # unset fields inherit defaults
+
+def test_invalid_entries_are_rejected():
+    with pytest.raises(ValueError):
+        table({"resources": [{"capacity": 3}]})
+    with pytest.raises(ValueError):
+        table({"resources": [{"name": "x", "capacity": 0}]})
+    with pytest.raises(ValueError):
+        table({"resources": [{"name": "x", "algorithm": "leaky"}]})
+    with pytest.raises(ValueError):
+        table({"resources": [{"name": "x", "algorithm": "gcra", "rate_tokens_per_sec": 0}]})
+    assert table({"resources": [{"name": "x", "algorithm": "gcra"}]}).lookup("x").algorithm == "gcra"
+
+def test_sliding_window_takes_its_window_from_limit_and_window_seconds():
+    t = table({"resources": [
+        {"name": "export", "limit": 1000, "window_seconds": 86400, "algorithm": "sliding_window"},
+        {"name": "search", "capacity": 20, "rate_tokens_per_sec": 10, "algorithm": "sliding_window"},
+    ]})
+    pol = t.lookup("export")
+    assert pol.window_ms == 86_400_000
+    assert pol.config_argv == (b"1000", b"86400000")
+    assert pol.full_refill_seconds == 86400
+    assert t.lookup("search").window_ms == 2_000
+
+def test_loader_stages_changes_and_keeps_active_on_bad_file(tmp_path):
+    path = tmp_path / "policy.yaml"
+    path.write_text("resources:\n  - {name: read, capacity: 3, rate_tokens_per_sec: 1}\n")
+    loader = PolicyLoader(str(path), scale=SCALE, default_capacity=10, default_rate=5.0)
+    assert loader.active.lookup("read").capacity == 3
+    assert loader.poll() is None  # unchanged file is not re-parsed
+
+    path.write_text("version: v2\nresources:\n  - {name: read, capacity: 7}\n")
+    os.utime(path, ns=(1, 1))
+    staged = loader.poll()
+    assert staged is not None and staged.version.startswith("v2@")
+    assert loader.active.lookup("read").capacity == 3  # staged, not active yet
+    loader.activate()
+    assert loader.active.lookup("read").capacity == 7
+
+    path.write_text("resources: [{name: read, capacity: -1}]\n")
+    os.utime(path, ns=(2, 2))
+    with pytest.raises(ValueError):
+        loader.poll()
+    assert loader.active.lookup("read").capacity == 7
+
+def test_missing_file_means_defaults(tmp_path):
+    loader = PolicyLoader(str(tmp_path / "nope.yaml"), scale=SCALE, default_capacity=10, default_rate=5.0)
+    assert loader.active.version == "defaults"
+    assert loader.active.lookup("anything").capacity == 10
+
+COMPOSITE = {"resources": [{"name": "api", "limits": [
+    {"name": "per_sec", "limit": 3, "window_seconds": 1},
+    {"name": "per_min", "limit": 5, "window_seconds": 60},
+    {"name": "tenant", "scope": "tenant", "capacity": 100, "rate_tokens_per_sec": 1},
+]}]}
+
+def test_composite_limits_parse_with_window_sugar_and_scopes():
+    pol = table(COMPOSITE).lookup("api")
+    assert [(l.name, l.scope, l.capacity) for l in pol.limits] == [
+        ("per_sec", "user", 3), ("per_min", "user", 5), ("tenant", "tenant", 100),
+    ]
+    assert pol.limits[1].rate_subtokens_per_sec == 5 * SCALE // 60
+    assert pol.full_refill_seconds >= 60  # idle buckets outlive the slowest refill
+    with pytest.raises(ValueError):
+        table({"resources": [{"name": "t", "limits": [{"name": "a", "scope": "tenant", "capacity": 1}]}]})
+    with pytest.raises(ValueError):
+        table({"resources": [{"name": "t", "limits": [{"name": "a", "limit": 1}]}]})
+
+@pytest.mark.anyio
+async def test_composite_limits_charge_atomically_and_report_the_binding_limit():
+    from app.app_async import composite_items, fold_decisions
+    from app.memory_limiter import AsyncMemoryLimiter
+    rl = AsyncMemoryLimiter()
+    pol = table(COMPOSITE).lookup("api")
+
+    async def call(tenant=None):
+        names, items = composite_items(pol, "alice", tenant, "api", 1)
+        return names, fold_decisions(names, await rl.allow_many(items, scale=SCALE, ttl_seconds=60, all_or_nothing=True))
+
+    names, (allowed, _, left, bound_by) = await call()
+    assert names == ["per_sec", "per_min"]  # no tenant given
+    assert allowed and bound_by == "per_sec" and left == pytest.approx(2.0)
+    for _ in range(2):
+        await call(tenant="acme")
+    names, (allowed, retry_after, _, bound_by) = await call(tenant="acme")
+    assert not allowed and bound_by == "per_sec" and retry_after > 0
+    # the deny charged nothing: the tenant bucket only paid for the 2 admitted calls
+    _, items = composite_items(pol, "alice", "acme", "api", 0)
+    remaining = [d[2] for d in await rl.allow_many(items, scale=SCALE, ttl_seconds=60)]
+    assert remaining[2] == pytest.approx(98.0, abs=0.01)
+
+@pytest.mark.anyio
+async def test_composite_denies_are_not_served_from_the_deny_cache(monkeypatch):
+    from app import app_async
+    from app.deny_cache import DenyCache
+    from app.memory_limiter import AsyncMemoryLimiter
+    monkeypatch.setattr(app_async, "limiter", AsyncMemoryLimiter())
+    monkeypatch.setattr(app_async, "deny_cache", DenyCache(100, 0, 5_000))
+    monkeypatch.setattr(app_async.policy, "active", table({"resources": [{"name": "api_t", "limits": [
+        {"name": "per_user", "capacity": 100, "rate_tokens_per_sec": 1},
+        {"name": "tenant", "scope": "tenant", "capacity": 1, "rate_tokens_per_sec": 0.01},
+    ]}]}))
+    assert (await app_async.decide("alice", "api_t", 1, None, "a")).allowed
+    denied = await app_async.decide("alice", "api_t", 1, None, "a")
+    assert not denied.allowed and denied.limit == "tenant"
+    # tenant a's deny says nothing about tenant b
+    assert (await app_async.decide("alice", "api_t", 1, None, "b")).allowed
+    again = await app_async.decide("alice", "api_t", 1, None, "a")
+    assert again.limit == "tenant" and not again.deny_cache
+
+@pytest.mark.anyio
+@pytest.mark.skipif(bool(os.getenv("APP_URL")), reason="patches the in-process policy")
+async def test_batch_rejects_resources_it_would_decide_as_a_token_bucket(client, monkeypatch):
+    from app import app_async
+    monkeypatch.setattr(app_async.policy, "active", table({"resources": [
+        {"name": "g", "capacity": 5, "algorithm": "gcra"},
+        {"name": "w", "limit": 5, "window_seconds": 60, "algorithm": "sliding_window"},
+    ]}))
+    for resource in ("g", "w"):
+        r = await client.post("/allow/batch", json={"items": [
+            {"user_id": "u", "resource": "plain"}, {"user_id": "u", "resource": resource},
+        ]})
+        assert r.status_code == 400 and resource in r.json()["error"]
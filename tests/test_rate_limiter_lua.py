@@ -1,5 +1,6 @@
 import asyncio
 import os
+import time
 import pytest
 
 @pytest.mark.anyio
@@ -71,3 +72,160 @@ async def test_idempotency_key_spends_once(client, redis_client):
     # Second response should be the cached decision (no double spend)
     assert d1["allowed"] == d2["allowed"]
     assert abs(float(d1["retry_after"]) - float(d2["retry_after"])) < 1e-6
+
+@pytest.mark.anyio
+async def test_batch_reports_per_item_results(client, redis_client):
+    items = [
+        {"user_id": "u_batch", "resource": "r_batch_a", "cost": 1},
+        {"user_id": "u_batch", "resource": "r_batch_b", "cost": 1000},
+    ]
+    r = await client.post("/allow/batch", json={"items": items})
+    assert r.status_code == 200
+    data = r.json()
+    assert data["allowed"] is False
+    assert [res["allowed"] for res in data["results"]] == [True, False]
+    assert data["results"][1]["retry_after"] > 0
+
+@pytest.mark.anyio
+async def test_batch_all_or_nothing_never_half_charges(client, redis_client):
+    user = "u_batch_atomic"
+    items = [
+        {"user_id": user, "resource": "r_atomic_a", "cost": 1},
+        {"user_id": user, "resource": "r_atomic_b", "cost": 1000},
+    ]
+    r = await client.post("/allow/batch", json={"items": items, "all_or_nothing": True})
+    assert r.status_code == 429
+    assert "Retry-After" in r.headers
+    assert all(res["allowed"] is False for res in r.json()["results"])
+
+    # The first bucket was not charged: a lone request still sees a full bucket
+    r2 = await client.post("/allow/batch", json={"items": items[:1]})
+    first = r2.json()["results"][0]
+    assert first["allowed"] is True
+    assert first["tokens_left"] == pytest.approx(r.json()["results"][0]["tokens_left"] - 1, abs=0.01)
+
+@pytest.mark.anyio
+async def test_batch_repeated_bucket_is_charged_in_order(client, redis_client):
+    item = {"user_id": "u_batch_repeat", "resource": "r_repeat", "cost": 4}
+    r = await client.post("/allow/batch", json={"items": [item] * 3})
+    results = r.json()["results"]
+    # default capacity 10: 4 + 4 fit, the third 4 does not
+    assert [res["allowed"] for res in results] == [True, True, False]
+
+@pytest.mark.anyio
+async def test_bucket_is_a_compact_string_and_denies_do_not_write(client, redis_client):
+    from app.settings import settings
+    key = settings.BUCKET_KEY_FMT.format(user="u_compact", resource="r_compact")
+    for _ in range(20):
+        r = await client.post("/allow", params={"user_id": "u_compact", "resource": "r_compact", "cost": 1})
+        if r.status_code == 429:
+            break
+    assert await redis_client.type(key) == "string"
+    tokens, last_ms = (await redis_client.get(key)).split(":")
+    assert int(tokens) >= 0 and int(last_ms) > 0
+
+    await redis_client.set(key, "0:1", keepttl=True)  # ancient clock: would refill on any write
+    await client.post("/allow", params={"user_id": "u_compact", "resource": "r_compact", "cost": 1000})
+    assert await redis_client.get(key) == "0:1"
+
+@pytest.mark.anyio
+async def test_legacy_hash_bucket_is_migrated_on_read(client, redis_client):
+    from app.settings import settings
+    key = settings.BUCKET_KEY_FMT.format(user="u_legacy", resource="r_legacy")
+    sec, usec = await redis_client.time()
+    now_ms = sec * 1000 + usec // 1000
+    await redis_client.hset(key, mapping={
+        "tokens": 3 * settings.SCALE,
+        "last_refill_ms": now_ms,
+        "capacity_tokens": 10,
+        "rate_subtokens_per_sec": 5 * settings.SCALE,
+        "scale": settings.SCALE,
+    })
+    r = await client.post("/allow", params={"user_id": "u_legacy", "resource": "r_legacy", "cost": 1})
+    assert r.status_code == 200
+    assert r.json()["tokens_left"] == pytest.approx(2.0, abs=0.5)
+    assert await redis_client.type(key) == "string"
+
+    ru = await client.get("/admin/user/u_legacy")
+    assert [res["resource"] for res in ru.json()["resources"]] == ["r_legacy"]
+
+def _engine(redis_client):
+    from app.app_async import _lua_limiter
+    return _lua_limiter(redis_client)
+
+async def _allow(lim, key, algorithm, cost=1):
+    return await lim.allow(
+        bucket_key=key, capacity_tokens=5, rate_subtokens_per_sec=10_000, cost_tokens=cost,
+        scale=10_000, ttl_seconds=3600, algorithm=algorithm,
+    )
+
+@pytest.mark.anyio
+async def test_gcra_matches_token_bucket_burst_and_expires_when_full(redis_client):
+    lim = _engine(redis_client)
+    for algorithm in ("token_bucket", "gcra"):
+        key = f"rl:u_gcra:{algorithm}"
+        decisions = [await _allow(lim, key, algorithm) for _ in range(6)]
+        assert [d[0] for d in decisions] == [True] * 5 + [False]
+        assert decisions[-1][1] == pytest.approx(1.0, abs=0.05)
+        assert decisions[4][2] == pytest.approx(0.0, abs=0.01)
+    value = await redis_client.get("rl:u_gcra:gcra")
+    assert ":" not in value
+    assert 0 < await redis_client.pttl("rl:u_gcra:gcra") <= 5_000
+
+@pytest.mark.anyio
+async def test_switching_algorithms_keeps_the_balance(redis_client):
+    lim = _engine(redis_client)
+    key = "rl:u_switch:r"
+    assert (await _allow(lim, key, "token_bucket", cost=4))[0]
+    allowed, _, remaining, _ = await _allow(lim, key, "gcra")
+    assert allowed and remaining == pytest.approx(0.0, abs=0.05)
+    allowed, retry_after, _, _ = await _allow(lim, key, "token_bucket")
+    assert not allowed and retry_after > 0.5
+
+@pytest.mark.anyio
+async def test_sliding_window_counts_per_window_and_expires(redis_client):
+    lim = _engine(redis_client)
+    key = "rl:u_sliding:export"
+    decisions = [
+        await lim.allow(
+            bucket_key=key, capacity_tokens=5, rate_subtokens_per_sec=0, cost_tokens=1,
+            scale=10_000, ttl_seconds=3600, algorithm="sliding_window", window_ms=60_000,
+        )
+        for _ in range(6)
+    ]
+    assert [d[0] for d in decisions] == [True] * 5 + [False]
+    assert 0 < decisions[-1][1] <= 120.0
+    assert decisions[4][2] == pytest.approx(0.0, abs=0.01)
+    assert (await redis_client.get(key)).count(":") == 2
+    assert 60_000 < await redis_client.pttl(key) <= 120_000
+
+@pytest.mark.anyio
+async def test_admin_user_reads_the_bucket_index_instead_of_scanning(client, redis_client):
+    from app.app_async import user_index_key
+    for resource in ("r_idx_a", "r_idx_b"):
+        await client.post("/allow", params={"user_id": "u_idx", "resource": resource, "cost": 1})
+    index_key = user_index_key("u_idx")
+    members = await redis_client.zrange(index_key, 0, -1, withscores=True)
+    assert sorted(m for m, _ in members) == ["rl:u_idx:r_idx_a", "rl:u_idx:r_idx_b"]
+    for member, expires_ms in members:
+        assert abs(expires_ms / 1000 - time.time() - await redis_client.ttl(member)) <= 2
+    assert 0 < await redis_client.ttl(index_key) <= 3600
+
+    indexed = (await client.get("/admin/user/u_idx")).json()["resources"]
+    scanned = (await client.get("/admin/user/u_idx", params={"scan": "true"})).json()["resources"]
+    assert sorted(r["resource"] for r in indexed) == ["r_idx_a", "r_idx_b"]
+    assert sorted(r["resource"] for r in indexed) == sorted(r["resource"] for r in scanned)
+
+@pytest.mark.anyio
+async def test_auto_pipeline_sends_concurrent_calls_together(redis_client):
+    from app.lua_limiter_async import AutoPipeline, bundled_limiter
+    flushes = []
+    lim = bundled_limiter(redis_client, pipeline=AutoPipeline(redis_client, on_flush=lambda n, _: flushes.append(n)))
+    await redis_client.script_flush()  # every caller takes the EVAL fallback on its own
+    keys = [f"rl:u_pipe{i}:r" for i in range(20)]
+    decisions = await asyncio.gather(*(_allow(lim, key, "token_bucket", cost=i % 7) for i, key in enumerate(keys)))
+    assert [d[0] for d in decisions] == [i % 7 <= 5 for i in range(20)]
+    assert flushes == [20]
+    decisions = await asyncio.gather(*(_allow(lim, key, "gcra") for key in keys))
+    assert [d[0] for d in decisions] == [i % 7 != 5 for i in range(20)]  # cost 6 was denied, not charged
+    assert flushes == [20, 20]
@@ -0,0 +1,55 @@
+import pytest
+from app.resource_registry import ResourceRegistry
+
+class FakeRedis:
+    """Records pipelined commands; fails execute() on demand."""
+
+    def __init__(self):
+        self.commands = []
+        self.fail = False
+
+    def pipeline(self, transaction=False):
+        return self
+
+    def __getattr__(self, name):
+        return lambda *args, **kw: self.commands.append((name, args, kw))
+
+    async def execute(self):
+        if self.fail:
+            raise ConnectionError("down")
+        return []
+
+def make(**kw):
+    r = FakeRedis()
+    return r, ResourceRegistry(r, r, key="rlmeta:resources", scale=10_000, ttl_seconds=3600, now=lambda: 6_000.0, **kw)
+
+@pytest.mark.anyio
+async def test_flush_writes_config_once_and_tallies_per_minute():
+    r, reg = make()
+    reg.note_cfg("read", 10, 50_000)
+    reg.note_cfg("read", 10, 50_000)
+    for user, allowed in (("a", True), ("b", True), ("a", False)):
+        reg.note_decision("read", user, allowed)
+    await reg.flush()
+    names = [(name, args[0]) for name, args, _ in r.commands]
+    assert names.count(("hset", "rlmeta:resources")) == 1
+    assert ("hincrby", "rlmeta:resources:allow:100") in names and ("hincrby", "rlmeta:resources:deny:100") in names
+    assert ("pfadd", "rlmeta:resources:live:{read}:10") in names
+    r.commands.clear()
+    await reg.flush()  # nothing new
+    assert r.commands == []
+
+@pytest.mark.anyio
+async def test_failed_flush_keeps_configs_and_tables_stay_bounded():
+    r, reg = make(max_resources=2)
+    for res in ("a", "b", "c"):
+        reg.note_decision(res, "u", True)
+    reg.note_cfg("a", 1, 1)
+    r.fail = True
+    with pytest.raises(ConnectionError):
+        await reg.flush()
+    assert len(reg._counts) == 0 and reg._pending == {"a": (1, 1)}
+    r.fail = False
+    r.commands.clear()
+    await reg.flush()
+    assert [args[0] for name, args, _ in r.commands if name == "hset"] == ["rlmeta:resources"]